@@ -0,0 +1,99 @@
+"""
+Compare the per-run latency of the encryption backends, encrypting and then decrypting
+an archive of a given size, as the backup and restore commands do.
+
+    python -m devex.cli.benchmark_encryption --gpg-recipient john@doe.com --runs 20
+"""
+import argparse
+import logging
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from direnv_backup.encrypt import EncryptionBackend, EncryptionError, GPGBackend
+
+logger = logging.getLogger(__name__)
+
+
+def parse_arguments(args: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--gpg-recipient",
+        type=str,
+        help="Email of an existing GPG key. If missing the gpg backend is skipped",
+    )
+    parser.add_argument("--runs", type=int, default=10, help="Runs per backend")
+    parser.add_argument(
+        "--size", type=int, default=256, help="Size of the archive in KiB"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show debug logs")
+    arguments = parser.parse_args(args)
+    return arguments
+
+
+def time_run(backend: EncryptionBackend, archive: Path, encrypted: Path) -> float:
+    start = time.perf_counter()
+
+    backend.encrypt(path_to_encrypt=archive, encrypted_path=encrypted)
+    with backend.decrypt_stream(encrypted) as stream:
+        stream.read()
+
+    elapsed = time.perf_counter() - start
+    encrypted.unlink()
+    return elapsed
+
+
+def benchmark_encryption(args: list[str] | None = None) -> str | None:
+    arguments = parse_arguments(args=args)
+
+    if arguments.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+    logging.basicConfig(level=log_level, format="%(message)s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_dir = Path(tmp)
+        archive = tmp_dir / "archive.tar"
+        archive.write_bytes(b"export FOO=bar\n" * (arguments.size * 1024 // 15))
+
+        backends: dict[str, EncryptionBackend] = {}
+
+        if arguments.gpg_recipient:
+            backends["gpg"] = GPGBackend(recipient=arguments.gpg_recipient)
+
+        try:
+            from direnv_backup.x25519 import X25519Backend, generate_identity
+
+            identity = tmp_dir / "identity"
+            recipient = generate_identity(path=identity)
+            backends["x25519"] = X25519Backend(recipient=recipient, identity=identity)
+        except ImportError:
+            logger.info("cryptography is not installed, skipping x25519 backend")
+
+        if not backends:
+            return "No backend to benchmark"
+
+        for name, backend in backends.items():
+            try:
+                timings = [
+                    time_run(backend, archive=archive, encrypted=tmp_dir / name)
+                    for _ in range(arguments.runs)
+                ]
+            except EncryptionError as error:
+                return f"{name}: {error}"
+
+            logger.info(
+                f"{name:>8}: median {statistics.median(timings) * 1000:8.2f} ms,"
+                f" min {min(timings) * 1000:8.2f} ms,"
+                f" max {max(timings) * 1000:8.2f} ms"
+            )
+
+    return None
+
+
+if __name__ == "__main__":
+    if exit_value := benchmark_encryption():
+        sys.exit(exit_value)
@@ -1,12 +1,26 @@
+import io
+import json
 import logging
-import subprocess
+import stat
 import tarfile
+from dataclasses import dataclass
 from pathlib import Path
+from typing import IO, Iterator
+
+from direnv_backup.io import hash_file
 
 logger = logging.getLogger(__name__)
 
+# Name of the archive member that lists the hash of every other member. It is always
+# the last member, so it can be checked while the archive is read as a stream.
+MANIFEST_NAME = ".direnv-backup-manifest.json"
+
+Manifest = dict[str, str]  # member name -> sha256 hex digest
+
 
-def archive_dir(dir: Path, base: Path, output: Path) -> Path:
+def archive_dir(
+    dir: Path, base: Path, output: Path, hashes: Manifest | None = None
+) -> Path:
     """
     Build an archive that includes the `dir` directory and every file inside. Every file
     will be added to the archive with its relative path from the `base` path:
@@ -19,40 +33,121 @@ def archive_dir(dir: Path, base: Path, output: Path) -> Path:
     file 2: /foo/bar/baz/kk.2      baz/kk.2
     file 3: /foo/bar/kk.3          kk.3
     file 4: /foo/kk.4              (not included, it's outside `dir`)
+
+    A manifest with the hash of every file is added at the end of the archive, see
+    `MANIFEST_NAME`. Files in `hashes` (already known hashes, by name in the archive)
+    are not hashed again.
+
+    The archive is reproducible: the same files, with the same content and permissions,
+    always produce the same bytes. Files are added sorted by name, in PAX format, and
+    their owner and modification time are not kept (see `normalize_tarinfo`), so sync
+    tools only transfer what actually changed and archives can be compared by hash.
     """
 
     assert output.suffixes == [".tar"]
 
-    with tarfile.open(output, "w") as tar:
-        files = (path for path in dir.rglob("*") if path.is_file())
+    manifest: Manifest = {}
+
+    with tarfile.open(output, "w", format=tarfile.PAX_FORMAT) as tar:
+        files = sorted(path for path in dir.rglob("*") if path.is_file())
         for file_path in files:
             file_path_in_archive = file_path.relative_to(base)
-            logger.debug(f"Adding file to archive as {file_path_in_archive}")
-            tar.add(file_path, arcname=file_path_in_archive)
+            logger.debug("Adding file to archive as %s", file_path_in_archive)
+            tar.add(file_path, arcname=file_path_in_archive, filter=normalize_tarinfo)
+            manifest[str(file_path_in_archive)] = known_hash(
+                file_path, name=str(file_path_in_archive), hashes=hashes
+            )
+
+        add_manifest(tar=tar, manifest=manifest)
 
     return output
 
 
-def extract(path: Path, extract_to_dir: Path) -> None:
-    # tar --extract --verbose -f $decrypted_file --directory $test_dir
-    cmd = [
-        "tar",
-        "--extract",
-        "--verbose",
-        "-f",
-        str(path),
-        "--directory",
-        str(extract_to_dir),
-    ]
-    proc = subprocess.run(cmd, capture_output=True)
-    stdout = proc.stdout.decode("utf-8")
-    stderr = proc.stderr.decode("utf-8")
-
-    something_went_wrong = stdout or stderr
-
-    if something_went_wrong:
-        # TODO: handle this with the corresponding exceptions - if key missing, etc.
-        print(f"{stdout=}")
-        print(f"{stderr=}")
-
-    logger.debug(f"Extraction output: {extract_to_dir}")
+def known_hash(path: Path, name: str, hashes: Manifest | None) -> str:
+    if hashes and name in hashes:
+        return hashes[name]
+    return hash_file(path)
+
+
+def normalize_tarinfo(info: tarfile.TarInfo) -> tarfile.TarInfo:
+    """
+    Drop the metadata that changes between runs, and that restoring does not use.
+    """
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    info.mtime = 0
+    info.mode = stat.S_IMODE(info.mode)
+    info.pax_headers = {}
+    return info
+
+
+def add_manifest(tar: tarfile.TarFile, manifest: Manifest) -> None:
+    data = json.dumps({"files": manifest}, indent=2, sort_keys=True).encode("utf-8")
+
+    info = tarfile.TarInfo(name=MANIFEST_NAME)
+    info.size = len(data)
+    info.mode = 0o600
+
+    tar.addfile(normalize_tarinfo(info), io.BytesIO(data))
+
+
+class ManifestError(Exception):
+    ...
+
+
+def parse_manifest(content: bytes) -> Manifest:
+    try:
+        data = json.loads(content)
+    except ValueError:
+        raise ManifestError("Corrupt manifest")
+
+    files = data.get("files") if isinstance(data, dict) else None
+    if not isinstance(files, dict) or not all(
+        isinstance(name, str) and isinstance(digest, str)
+        for name, digest in files.items()
+    ):
+        raise ManifestError("Corrupt manifest")
+
+    return files
+
+
+@dataclass(frozen=True)
+class ArchiveMember:
+    name: str
+    content: bytes
+    mode: int
+
+
+def iter_members(
+    fileobj: IO[bytes], names: set[str] | None = None
+) -> Iterator[ArchiveMember]:
+    """
+    Read the archive as a stream and yield its regular files as soon as they are read,
+    without ever writing them to disk. The stream does not need to be seekable, so it
+    can be the stdout of another process.
+
+    If `names` is set, only those members are yielded, and the iteration stops once all
+    of them are found.
+    """
+    pending = set(names) if names is not None else None
+
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            if pending is not None:
+                if member.name not in pending:
+                    continue
+                pending.remove(member.name)
+
+            content = tar.extractfile(member)
+            assert content, f"{member.name} is not a regular file"
+
+            logger.debug("Read %s from archive", member.name)
+            yield ArchiveMember(
+                name=member.name, content=content.read(), mode=member.mode
+            )
+
+            if pending is not None and not pending:
+                return
@@ -1,18 +1,35 @@
 import datetime
+import heapq
 import json
 import logging
+import os
 import shutil
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
 
-from direnv_backup.archive import archive_dir
-from direnv_backup.config import Config
-from direnv_backup.encrypt import EncryptionError, encrypt
-from direnv_backup.io import copy_file
-from direnv_backup.restore import find_all_backups
+from direnv_backup.archive import Manifest, archive_dir
+from direnv_backup.config import SEEKABLE_EXTENSION, SNAPSHOT_EXTENSION, Config
+from direnv_backup.dedup import DedupStore
+from direnv_backup.encrypt import get_encryption_backend
+from direnv_backup.hashcache import HASH_CACHE_NAME, HashCache, open_hash_cache
+from direnv_backup.io import atomic_write_bytes, copy_file, hash_file
+from direnv_backup.metrics import metrics
+from direnv_backup.progress import Progress
+from direnv_backup.replicate import (
+    ReplicationError,
+    missing_destinations,
+    replicate_backup,
+)
+from direnv_backup.restore import find_all_backups, list_backups
+from direnv_backup.seekable import write_seekable_archive
+from direnv_backup.store import PackStore
+from direnv_backup.throttle import LoadThrottle
 
 logger = logging.getLogger(__name__)
 
+SCAN_CHECKPOINT_NAME = ".scan-checkpoint.json"
+
 
 @dataclass(frozen=True)
 class Snapshot:
@@ -20,37 +37,233 @@ class Snapshot:
     timestamp: datetime.datetime
 
 
-def scan_direnv_files(config: Config) -> Snapshot:
-    start_path = config.root_dir
-    logger.debug(f"Scanning direnv files in {start_path}")
+@dataclass
+class ScanCheckpoint:
+    """
+    Progress of a time-budgeted scan, saved between runs in `SCAN_CHECKPOINT_NAME`, see
+    `scan_direnv_files`.
+    """
+
+    root_dir: Path
+    # heap of the directories left to visit, as (-mtime, path): most recently modified
+    # first. Empty once the scan is complete
+    pending: list[tuple[float, str]]
+    found: set[Path]  # direnv files found so far by this scan
+    previous: set[Path]  # direnv files found by the last complete scan
+    # (device, inode) of the directories already queued by this scan
+    visited: set[tuple[int, int]] = field(default_factory=set)
+
+
+def load_scan_checkpoint(config: Config) -> ScanCheckpoint | None:
+    path = config.backup_dir / SCAN_CHECKPOINT_NAME
+    if not path.exists():
+        return None
+
+    data = json.loads(path.read_text())
+    if Path(data["root_dir"]) != config.root_dir:
+        logger.debug(f"Ignoring scan checkpoint of {data['root_dir']}")
+        return None
+
+    return ScanCheckpoint(
+        root_dir=config.root_dir,
+        pending=[(priority, path) for priority, path in data["pending"]],
+        found={Path(file) for file in data["found"]},
+        previous={Path(file) for file in data["previous"]},
+        visited={(dev, ino) for dev, ino in data.get("visited", [])},
+    )
 
-    direnv_files: set[Path] = set()
 
-    stack: list[Path] = [start_path]
-    while True:
-        if not stack:
-            break
+def save_scan_checkpoint(config: Config, checkpoint: ScanCheckpoint) -> None:
+    data = {
+        "root_dir": str(checkpoint.root_dir),
+        "pending": checkpoint.pending,
+        "found": sorted(str(file) for file in checkpoint.found),
+        "previous": sorted(str(file) for file in checkpoint.previous),
+        "visited": sorted(checkpoint.visited),
+    }
+    content = json.dumps(data).encode("utf-8")
+    path = config.backup_dir / SCAN_CHECKPOINT_NAME
+    atomic_write_bytes(path=path, content=content, mode=0o600)
+
+
+@dataclass(frozen=True)
+class DirListing:
+    """
+    What the scanner found in a directory, see `ScanIndex`.
+    """
+
+    mtime_ns: int  # of the directory when it was listed
+    envrcs: list[str]
+    subdirs: list[tuple[int, int, float, str]]  # (device, inode, mtime, path)
+
 
-        curr_path = stack.pop()
-        if curr_path.stem in config.exclude:
+# Listing of each directory by path. A directory's mtime changes whenever an entry is
+# added, removed or renamed in it, so while it does not, its listing is still valid and
+# a scan only needs to `stat` it. Kept in memory by `direnv_backup.daemon`.
+ScanIndex = dict[str, DirListing]
+
+
+def _list_dir(dir: str, config: Config, root_dev: int) -> DirListing | None:
+    try:
+        mtime_ns = os.stat(dir).st_mtime_ns
+        entries = list(os.scandir(dir))
+    except OSError as error:
+        logger.debug("Cannot scan %s: %s", dir, error)
+        return None
+
+    envrcs: list[str] = []
+    subdirs: list[tuple[int, int, float, str]] = []
+
+    # Real folders first, so a folder that is also reachable through a symlink in the
+    # same parent is backed up under its real path
+    for entry in sorted(entries, key=lambda entry: (entry.is_symlink(), entry.name)):
+        stem = Path(entry.name).stem
+
+        if stem == ".envrc":
+            envrcs.append(entry.path)
             continue
 
-        for path in curr_path.glob("*"):
-            stem = path.stem
+        if stem in config.exclude:
+            continue
 
-            if stem == ".envrc":
-                direnv_files.add(path)
+        try:
+            if not entry.is_dir(follow_symlinks=config.follow_symlinks):
                 continue
+            stat = entry.stat(follow_symlinks=True)
+        except OSError:
+            continue  # removed since it was listed, or a dangling symlink
 
-            if stem in config.exclude:
-                continue
+        if config.one_file_system and stat.st_dev != root_dev:
+            logger.debug("Skipping %s, it is on another file system", entry.path)
+            continue
 
-            stack.append(path)
+        subdirs.append((stat.st_dev, stat.st_ino, stat.st_mtime, entry.path))
+
+    return DirListing(mtime_ns=mtime_ns, envrcs=envrcs, subdirs=subdirs)
+
+
+def _mtime_ns(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _scan_dir(
+    dir: str,
+    config: Config,
+    root_dev: int,
+    checkpoint: ScanCheckpoint,
+    index: ScanIndex | None,
+) -> None:
+    """
+    Add the direnv files of `dir` to the checkpoint, and queue its subdirectories.
+    """
+    listing = index.get(dir) if index is not None else None
+    if listing is None or _mtime_ns(dir) != listing.mtime_ns:
+        listing = _list_dir(dir, config=config, root_dev=root_dev)
+        if index is not None:
+            if listing is None:
+                index.pop(dir, None)
+            else:
+                index[dir] = listing
+
+    if listing is None:
+        return
+
+    checkpoint.found.update(Path(envrc) for envrc in listing.envrcs)
+
+    for dev, ino, mtime, path in listing.subdirs:
+        # Breaks symlink cycles, and visits bind mounts and symlinked folders once
+        if (dev, ino) in checkpoint.visited:
+            continue
+        checkpoint.visited.add((dev, ino))
+
+        heapq.heappush(checkpoint.pending, (-mtime, path))
+
+
+def scan_direnv_files(config: Config, index: ScanIndex | None = None) -> Snapshot:
+    """
+    Find the direnv files inside `Config.root_dir`.
+
+    Each physical directory is visited once, however many symlinks or bind mounts lead
+    to it, see `Config.follow_symlinks` and `Config.one_file_system`.
+
+    With an `index`, directories that did not change since the previous scan are not
+    listed again.
+
+    With a `Config.scan_time_budget` the scan stops when the budget runs out, and the
+    next run resumes it from a checkpoint, visiting the most recently modified
+    directories first. Until a scan is complete, the files that it has not reached yet
+    are taken from the last complete scan.
+    """
+    start_path = config.root_dir
+    logger.debug(f"Scanning direnv files in {start_path}")
+    try:
+        root_stat = start_path.stat()
+    except OSError as error:
+        logger.debug(f"Cannot scan {start_path}: {error}")
+        return Snapshot(files=[], timestamp=datetime.datetime.now())
+
+    budget = config.scan_time_budget
+    checkpoint = load_scan_checkpoint(config=config) if budget is not None else None
+    if checkpoint is None:
+        checkpoint = ScanCheckpoint(
+            root_dir=start_path, pending=[], found=set(), previous=set()
+        )
+    if not checkpoint.pending:
+        checkpoint.pending = [(0, str(start_path))]
+        checkpoint.found = set()
+        checkpoint.visited = {(root_stat.st_dev, root_stat.st_ino)}
+
+    deadline = time.monotonic() + budget if budget is not None else None
+    throttle = LoadThrottle(
+        max_load=config.throttle_load,
+        max_io_pressure=config.throttle_io_pressure,
+        max_total_pause=config.throttle_time_budget,
+    )
+
+    pending = checkpoint.pending
+    while pending:
+        throttle.pause_if_busy(deadline=deadline)
+        curr_path = heapq.heappop(pending)[1]
+        if Path(curr_path).stem in config.exclude:
+            continue
+
+        _scan_dir(
+            curr_path,
+            config=config,
+            root_dev=root_stat.st_dev,
+            checkpoint=checkpoint,
+            index=index,
+        )
+
+        # Checked after visiting a directory, so every run makes some progress
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+
+    direnv_files = checkpoint.found
+    if pending:
+        logger.info(
+            f"Scan time budget exhausted, {len(pending)} directories left for the"
+            " next run"
+        )
+        files = direnv_files | {file for file in checkpoint.previous if file.exists()}
+    else:
+        checkpoint.previous = set(direnv_files)
+        checkpoint.visited = set()
+        files = direnv_files
 
-    logger.debug(f"Found {len(direnv_files)} direnv files")
+    if budget is not None:
+        save_scan_checkpoint(config=config, checkpoint=checkpoint)
+
+    # Hard linked and symlinked direnv files are kept under each of their paths, so a
+    # restore puts all of them back. Their content is stored once by the seekable and
+    # dedup formats, see `write_seekable_archive` and `DedupStore`.
+    logger.debug(f"Found {len(files)} direnv files")
 
     snapshot = Snapshot(
-        files=sorted(list(direnv_files)),
+        files=sorted(files),
         timestamp=datetime.datetime.now(),
     )
 
@@ -75,72 +288,249 @@ def build_backup_filename() -> str:
     return filename
 
 
-def copy_snapshot_files(*, snapshot: Snapshot, config: Config) -> None:
+def copy_snapshot_files(
+    *, snapshot: Snapshot, config: Config, cache: HashCache | None = None
+) -> Manifest:
+    """
+    Copy the files of the snapshot to the temporary dir, and return their hashes by
+    name in the backup. With a `cache`, unchanged files are not hashed again.
+    """
     config.tmp_dir.mkdir(parents=True, exist_ok=True)
+    hashes: Manifest = {}
 
     # When mirroring the original file structure, you want to include the `root_dir` dir
     # name in the file structure
     base_path = config.root_dir.parent
 
-    total = len(snapshot.files)
-    for i, path in enumerate(snapshot.files):
-        partial = path.relative_to(base_path)
-        backup_path = config.tmp_dir / partial
-        copy_file(src=path, dst=backup_path)
-        logger.info(f"{i+1}/{total}  {partial} backed up")
+    with Progress(stage="backup", total=len(snapshot.files)) as progress:
+        for path in snapshot.files:
+            partial = path.relative_to(base_path)
+            backup_path = config.tmp_dir / partial
+
+            before = path.stat()
+            digest = cache.hash_file(path, stat=before) if cache else None
+            copy_file(src=path, dst=backup_path)
+            after = path.stat()
+
+            if digest is None or (before.st_size, before.st_mtime_ns) != (
+                after.st_size,
+                after.st_mtime_ns,
+            ):
+                # Changed while it was copied, the copy is what gets backed up
+                digest = hash_file(backup_path)
+
+            hashes[str(partial)] = digest
+            # Formatted only when debug logs are enabled
+            logger.debug(
+                "%s backed up",
+                partial,
+                extra={"stage": "backup", "path": str(path), "bytes": after.st_size},
+            )
+            progress.advance(bytes=after.st_size)
+
+    return hashes
 
 
-def archive_snapshot(config: Config) -> Path:
+def archive_snapshot(config: Config, hashes: Manifest | None = None) -> Path:
     archive_filename = build_backup_filename()
     archive_path = config.backup_dir / f"{archive_filename}.tar"
 
-    archive_dir(dir=config.tmp_dir, base=config.tmp_dir, output=archive_path)
+    archive_dir(
+        dir=config.tmp_dir, base=config.tmp_dir, output=archive_path, hashes=hashes
+    )
 
     shutil.rmtree(path=config.tmp_dir)
 
     return archive_path
 
 
-def encrypt_archive(archive_path: Path, config: Config) -> None:
-    if not config.encryption_recipient:
-        raise EncryptionError("Config must specify a recipient to run encryption")
-
-    encrypted_path = archive_path.with_suffix(".gpg")
+def encrypt_archive(archive_path: Path, config: Config) -> Path:
+    encrypted_path = archive_path.with_suffix(config.backup_extension)
 
     logger.debug(f"Attempting to encrypt {archive_path}")
-    encrypt(
-        path_to_encrypt=archive_path,
-        encrypted_path=encrypted_path,
-        recipient=config.encryption_recipient,
-    )
+    backend = get_encryption_backend(config=config)
+    backend.encrypt(path_to_encrypt=archive_path, encrypted_path=encrypted_path)
 
+    return encrypted_path
 
-def backup(config: Config) -> None:
-    snapshot = scan_direnv_files(config=config)
 
-    copy_snapshot_files(snapshot=snapshot, config=config)
+def build_seekable_backup(config: Config, hashes: Manifest | None = None) -> Path:
+    archive_filename = build_backup_filename()
+    archive_path = config.backup_dir / f"{archive_filename}{SEEKABLE_EXTENSION}"
 
-    archive_path = archive_snapshot(config=config)
+    backend = get_encryption_backend(config=config) if config.encrypt_backup else None
 
-    if config.encrypt_backup:
-        try:
-            encrypt_archive(archive_path=archive_path, config=config)
-        except EncryptionError:
-            raise
-        finally:
-            logger.debug(f"Cleaning up temporary archive: {archive_path}")
-            archive_path.unlink()
+    try:
+        write_seekable_archive(
+            dir=config.tmp_dir,
+            base=config.tmp_dir,
+            output=archive_path,
+            backend=backend,
+            hashes=hashes,
+        )
+    finally:
+        shutil.rmtree(path=config.tmp_dir)
+
+    return archive_path
+
+
+def store_in_pack(backup_path: Path, config: Config) -> None:
+    """
+    Move a finished backup into the pack store, see `direnv_backup.store`.
+    """
+    store = PackStore(dir=config.backup_dir)
+    try:
+        store.add(name=backup_path.name, source=backup_path)
+    finally:
+        backup_path.unlink()
+
+
+def build_backup(config: Config, hashes: Manifest | None = None) -> Path:
+    if config.archive_format == "seekable":
+        # Members are encrypted one by one, there is no archive to encrypt afterwards
+        return build_seekable_backup(config=config, hashes=hashes)
+
+    archive_path = archive_snapshot(config=config, hashes=hashes)
+
+    if not config.encrypt_backup:
+        return archive_path
+
+    try:
+        return encrypt_archive(archive_path=archive_path, config=config)
+    finally:
+        logger.debug(f"Cleaning up temporary archive: {archive_path}")
+        archive_path.unlink()
+
+
+def store_deduplicated(config: Config, hashes: Manifest | None = None) -> None:
+    backend = get_encryption_backend(config=config) if config.encrypt_backup else None
+    store = DedupStore(dir=config.backup_dir, backend=backend)
+
+    try:
+        store.write_snapshot(
+            name=f"{build_backup_filename()}{SNAPSHOT_EXTENSION}",
+            dir=config.tmp_dir,
+            base=config.tmp_dir,
+            hashes=hashes,
+        )
+    finally:
+        shutil.rmtree(path=config.tmp_dir)
+
+
+def find_identical_backup(
+    backup_path: Path, config: Config, cache: HashCache | None = None
+) -> Path | None:
+    """
+    Return the previous backup if it has the same content as `backup_path`.
+
+    Unencrypted archives are reproducible (see `archive_dir`), so two backups of the
+    same files are byte for byte identical. Encrypted backups never are.
+    """
+    previous = [
+        path
+        for path in find_all_backups(
+            dir=config.backup_dir, extension=config.backup_extension
+        )
+        if path != backup_path
+    ]
+    if not previous:
+        return None
+
+    latest = max(previous)
+    if latest.stat().st_size != backup_path.stat().st_size:
+        return None
+
+    # The previous backup does not change, its hash is usually cached
+    latest_hash = cache.hash_file(latest) if cache else hash_file(latest)
+    return latest if latest_hash == hash_file(backup_path) else None
+
+
+def backup(config: Config, scan_index: ScanIndex | None = None) -> None:
+    with metrics.measure("scan.seconds"):
+        snapshot = scan_direnv_files(config=config, index=scan_index)
+
+    with open_hash_cache(config.resolved_cache_dir / HASH_CACHE_NAME) as cache:
+        with metrics.measure("copy.seconds"):
+            hashes = copy_snapshot_files(snapshot=snapshot, config=config, cache=cache)
+
+        if config.storage == "dedup":
+            with metrics.measure("store.seconds"):
+                store_deduplicated(config=config, hashes=hashes)
+            return
+
+        with metrics.measure("archive.seconds"):
+            backup_path = build_backup(config=config, hashes=hashes)
+
+        if not config.encrypt_backup and config.storage == "files":
+            previous = find_identical_backup(
+                backup_path=backup_path, config=config, cache=cache
+            )
+            if previous:
+                logger.info(f"Nothing changed since {previous.name}, backup skipped")
+                backup_path.unlink()
+                # Still copied to the destinations that failed or were added since
+                backup_path = previous
+
+    if config.storage == "packs":
+        with metrics.measure("store.seconds"):
+            store_in_pack(backup_path=backup_path, config=config)
+
+    with metrics.measure("replicate.seconds"):
+        results = replicate_backup(
+            backup_path=backup_path,
+            destinations=missing_destinations(
+                backup_path=backup_path, destinations=config.destinations
+            ),
+        )
+    if failed := [result for result in results if not result.ok]:
+        lines = [f"{result.destination.path}: {result.error}" for result in failed]
+        raise ReplicationError(
+            f"Failed to copy the backup to {len(failed)} destination(s):\n"
+            + "\n".join(lines)
+        )
+
+
+def remove_old_files(dir: Path, extension: str, keep: int) -> None:
+    backups = find_all_backups(dir=dir, extension=extension)
+
+    for backup in sorted(backups, reverse=True)[keep:]:
+        logger.debug(f"Deleting backup: {backup.absolute()}")
+        backup.unlink()
 
 
 def remove_old_backups(config: Config) -> None:
     max_backup_amount = 10
-    backups = find_all_backups(dir=config.backup_dir, encrypted=config.encrypt_backup)
+    backups = list_backups(config=config)
 
     sorted_backups = sorted(backups, reverse=True)
-
-    for i, backup in enumerate(sorted_backups):
-        if i < max_backup_amount:
-            continue
-
+    old_backups = sorted_backups[max_backup_amount:]
+
+    if config.storage == "dedup":
+        # Blobs may be shared with the retained snapshots, only the garbage collector
+        # can tell which ones are safe to free
+        store = DedupStore(dir=config.backup_dir, backend=None)
+        store.remove_snapshots(backup.name for backup in old_backups)
+        summary = store.collect_garbage(time_budget=config.gc_time_budget)
+        logger.debug(f"Garbage collection summary: {summary}")
+        return
+
+    if config.storage == "packs":
+        # Only drops them from the pack indexes, see `PackStore.compact`
+        logger.debug(f"Removing {len(old_backups)} backups from the pack store")
+        PackStore(dir=config.backup_dir).remove(backup.name for backup in old_backups)
+        return
+
+    for backup in old_backups:
         logger.debug(f"Deleting backup: {backup.absolute()}")
         backup.unlink()
+
+    # Each destination has its own retention, and a missing one does not stop the rest
+    for destination in config.destinations:
+        try:
+            remove_old_files(
+                dir=destination.path,
+                extension=config.backup_extension,
+                keep=destination.keep,
+            )
+        except OSError as error:
+            logger.error(f"Failed to remove old backups in {destination.path}: {error}")
@@ -2,56 +2,102 @@ import argparse
 import logging
 import sys
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from direnv_backup.backup import backup, remove_old_backups
-from direnv_backup.config import ConfigError, read_config
-from direnv_backup.encrypt import EncryptionError
-from direnv_backup.logging import set_up_logging_config
+from direnv_backup.cli.common import Command, run_single_command
+
+if TYPE_CHECKING:
+    from direnv_backup.backup import ScanIndex
+    from direnv_backup.config import Config
 
 logger = logging.getLogger(__name__)
 
 
-def parse_arguments(args: list[str] | None = None) -> argparse.Namespace:
-    parser = argparse.ArgumentParser()
+def add_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
-        "--config",
-        type=str,
-        help="Path to the config file",
+        "--no-daemon",
+        action="store_true",
+        help="Back up in this process even if the daemon is running",
     )
-    parser.add_argument("-v", "--verbose", action="store_true", help="Show debug logs")
-    arguments = parser.parse_args(args)
-    return arguments
 
 
-def main(args: list[str] | None = None) -> str | None:
-    arguments = parse_arguments(args=args)
+def run(
+    arguments: argparse.Namespace, config_path: Path, config: "Config"
+) -> str | None:
+    from direnv_backup import daemon
+    from direnv_backup.throttle import lower_priority
 
-    if not arguments.config:
-        return "Please specify a config (see --help)"
+    # A profile is of this process
+    if not arguments.no_daemon and not arguments.profile:
+        response = daemon.request_or_run_here(command="backup", config_path=config_path)
+        if response is not None:
+            logger.debug("Backup run by the daemon")
+            return response.error
 
-    config_path = Path(arguments.config)
-    if not config_path.exists():
-        return f"Provided path for the config file does not exit: {config_path}"
+    lower_priority(nice=config.nice, ionice_idle=config.ionice_idle)
+
+    return run_backup(config=config)
 
-    try:
-        config = read_config(path=config_path)
-    except ConfigError as error:
-        return str(error)
 
-    set_up_logging_config(debug_mode_on=arguments.verbose)
+def run_backup(config: "Config", scan_index: "ScanIndex | None" = None) -> str | None:
+    """
+    Back up, apply the retention and upload to S3. Return an error message if any step
+    failed.
+    """
+    from direnv_backup.backup import backup, remove_old_backups
+    from direnv_backup.encrypt import EncryptionError
+    from direnv_backup.metrics import metrics
+    from direnv_backup.replicate import ReplicationError, upload_to_s3
 
-    logger.debug(f"Config loaded: {config}")
+    metrics.clear()
 
+    replication_errors: list[str] = []
     try:
-        backup(config=config)
+        with metrics.measure("backup.seconds"):
+            backup(config=config, scan_index=scan_index)
     except EncryptionError as error:
         return str(error)
-
-    remove_old_backups(config=config)
+    except ReplicationError as error:
+        # The backup exists in the other destinations, keep their retention going
+        replication_errors.append(str(error))
+
+    with metrics.measure("retention.seconds"):
+        remove_old_backups(config=config)
+
+    # After the retention, so the backups that were just removed are not uploaded
+    if config.s3:
+        try:
+            upload_to_s3(config=config)
+        except ReplicationError as error:
+            replication_errors.append(str(error))
+
+    if metrics.as_dict():
+        logger.info(
+            f"Run metrics: {metrics}",
+            extra={
+                "stage": "backup",
+                "duration": round(metrics.get("backup.seconds"), 3),
+            },
+        )
+
+    if replication_errors:
+        return "\n".join(replication_errors)
 
     return None
 
 
+COMMAND = Command(
+    name="backup",
+    help="Create a new backup",
+    add_arguments=add_arguments,
+    run=run,
+)
+
+
+def main(args: list[str] | None = None) -> str | None:
+    return run_single_command(COMMAND, args=args)
+
+
 if __name__ == "__main__":
     if exit_value := main():
         sys.exit(exit_value)
@@ -0,0 +1,105 @@
+"""
+Arguments and config loading shared by every command, see `direnv_backup.cli.main`.
+
+Command modules only import the standard library modules that argparse needs at the
+top: the backup and restore stack is imported by the command when it runs, so that
+`--help`, a typo or a config error return before it is loaded.
+"""
+import argparse
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from direnv_backup.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Command:
+    name: str
+    help: str
+    add_arguments: Callable[[argparse.ArgumentParser], None]
+    # Runs once the config is loaded, returns an error message if the command failed
+    run: Callable[[argparse.Namespace, Path, "Config"], str | None]
+    # Validates the arguments before the config is loaded
+    check_arguments: Callable[[argparse.Namespace], str | None] | None = None
+
+
+def add_common_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--config",
+        type=str,
+        help="Path to the config file",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show debug logs")
+    parser.add_argument(
+        "--log-format",
+        choices=("text", "json"),
+        default="text",
+        help="Write logs as text (default), or as one JSON object per line",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=("cpu", "alloc", "trace"),
+        help=(
+            "Profile the command, and write the profile next to the config file: cpu"
+            " (cProfile), alloc (tracemalloc) or trace (stages, Chrome trace format)"
+        ),
+    )
+
+
+def run_command(command: Command, arguments: argparse.Namespace) -> str | None:
+    if not arguments.config:
+        return "Please specify a config (see --help)"
+
+    if command.check_arguments and (error := command.check_arguments(arguments)):
+        return error
+
+    config_path = Path(arguments.config)
+    if not config_path.exists():
+        return f"Provided path for the config file does not exit: {config_path}"
+
+    from direnv_backup.config import ConfigError
+    from direnv_backup.configcache import read_compiled_config
+    from direnv_backup.logging import set_up_logging_config
+
+    try:
+        config = read_compiled_config(path=config_path)
+    except ConfigError as error:
+        return str(error)
+
+    set_up_logging_config(
+        debug_mode_on=arguments.verbose, log_format=arguments.log_format
+    )
+
+    logger.debug(f"Config loaded: {config}")
+
+    if arguments.profile:
+        from direnv_backup.profiling import profile_path, profiled
+
+        path = profile_path(
+            config_path, command=command.name, profile=arguments.profile
+        )
+        with profiled(arguments.profile, path=path):
+            failure = command.run(arguments, config_path, config)
+    else:
+        failure = command.run(arguments, config_path, config)
+    if failure and arguments.log_format == "json":
+        # Also printed as text on exit, for humans
+        logger.error(failure, extra={"stage": command.name, "error": failure})
+
+    return failure
+
+
+def run_single_command(command: Command, args: list[str] | None = None) -> str | None:
+    """
+    Run `command` with a parser of its own, for the commands that are also installed as
+    a standalone script (e.g. `direnv-restore`).
+    """
+    parser = argparse.ArgumentParser(description=command.help)
+    add_common_arguments(parser)
+    command.add_arguments(parser)
+    return run_command(command, parser.parse_args(args))
@@ -0,0 +1,68 @@
+import argparse
+import logging
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from direnv_backup.cli.common import Command, run_single_command
+
+if TYPE_CHECKING:
+    from direnv_backup.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    # The default, `direnv_backup.store.COMPACTION_THRESHOLD`, is only imported when
+    # compacting
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help=(
+            "Rewrite the packs where at least this fraction of the bytes belongs to"
+            " removed backups (default: 0.5)"
+        ),
+    )
+
+
+def check_arguments(arguments: argparse.Namespace) -> str | None:
+    if arguments.threshold is not None and not 0 < arguments.threshold <= 1:
+        return "--threshold must be greater than 0 and at most 1"
+
+    return None
+
+
+def compact(arguments: argparse.Namespace, config: "Config") -> None:
+    from direnv_backup.store import COMPACTION_THRESHOLD, PackStore
+
+    threshold = arguments.threshold or COMPACTION_THRESHOLD
+    summary = PackStore(dir=config.backup_dir).compact(threshold=threshold)
+    logger.info(f"Compaction summary: {summary}")
+
+
+def run(
+    arguments: argparse.Namespace, config_path: Path, config: "Config"
+) -> str | None:
+    if config.storage != "packs":
+        return 'Compaction only applies to the "packs" storage'
+
+    compact(arguments, config=config)
+    return None
+
+
+COMMAND = Command(
+    name="compact",
+    help='Reclaim the space of removed backups with the "packs" storage',
+    add_arguments=add_arguments,
+    check_arguments=check_arguments,
+    run=run,
+)
+
+
+def main(args: list[str] | None = None) -> None | str:
+    return run_single_command(COMMAND, args=args)
+
+
+if __name__ == "__main__":
+    if exit_value := main():
+        sys.exit(exit_value)
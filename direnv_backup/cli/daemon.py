@@ -0,0 +1,74 @@
+import argparse
+import logging
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from direnv_backup.cli.common import Command, run_single_command
+
+if TYPE_CHECKING:
+    from direnv_backup.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Show the status of the running daemon instead of starting one",
+    )
+
+
+def run(
+    arguments: argparse.Namespace, config_path: Path, config: "Config"
+) -> str | None:
+    import json
+    import signal
+
+    from direnv_backup import daemon
+    from direnv_backup.throttle import lower_priority
+
+    if arguments.status:
+        try:
+            response = daemon.request(command="status", config_path=config_path)
+        except daemon.DaemonError as error:
+            return str(error)
+        if response is None:
+            return f"No daemon running for {config_path}"
+
+        print(json.dumps(response.result, indent=2))
+        return None
+
+    lower_priority(nice=config.nice, ionice_idle=config.ionice_idle)
+
+    backup_daemon = daemon.BackupDaemon(config_path=config_path)
+
+    # systemd stops services with SIGTERM
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        backup_daemon.serve_forever()
+    except daemon.DaemonError as error:
+        return str(error)
+    except KeyboardInterrupt:
+        pass
+
+    return None
+
+
+COMMAND = Command(
+    name="daemon",
+    help="Keep running, and back up and restore when asked to",
+    add_arguments=add_arguments,
+    run=run,
+)
+
+
+def main(args: list[str] | None = None) -> None | str:
+    return run_single_command(COMMAND, args=args)
+
+
+if __name__ == "__main__":
+    if exit_value := main():
+        sys.exit(exit_value)
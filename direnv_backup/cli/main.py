@@ -0,0 +1,57 @@
+"""
+`direnv-backup`, the single entry point of every command:
+
+    direnv-backup backup --config=config.json
+    direnv-backup restore --config=config.json --at 2022-07-27
+
+Without a command, `direnv-backup --config=config.json` backs up, like it did before
+the other commands were added to it.
+"""
+import argparse
+import sys
+
+from direnv_backup.cli import backup, compact, daemon, prune, restore, verify
+from direnv_backup.cli.common import Command, add_common_arguments, run_command
+
+COMMANDS: dict[str, Command] = {
+    command.name: command
+    for command in (
+        backup.COMMAND,
+        restore.COMMAND,
+        restore.LIST_COMMAND,
+        verify.COMMAND,
+        prune.COMMAND,
+        compact.COMMAND,
+        daemon.COMMAND,
+    )
+}
+
+DEFAULT_COMMAND = "backup"
+
+
+def parse_arguments(args: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="direnv-backup", description="Back up and restore direnv files"
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    for name, command in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=command.help)
+        add_common_arguments(subparser)
+        command.add_arguments(subparser)
+
+    args = sys.argv[1:] if args is None else args
+    if not args or args[0] not in (*COMMANDS, "-h", "--help"):
+        args = [DEFAULT_COMMAND, *args]
+
+    arguments = parser.parse_args(args)
+    return arguments
+
+
+def main(args: list[str] | None = None) -> str | None:
+    arguments = parse_arguments(args=args)
+    return run_command(COMMANDS[arguments.command], arguments)
+
+
+if __name__ == "__main__":
+    if exit_value := main():
+        sys.exit(exit_value)
@@ -0,0 +1,37 @@
+import argparse
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from direnv_backup.cli import compact
+from direnv_backup.cli.common import Command
+
+if TYPE_CHECKING:
+    from direnv_backup.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def run(
+    arguments: argparse.Namespace, config_path: Path, config: "Config"
+) -> str | None:
+    from direnv_backup.backup import remove_old_backups
+
+    remove_old_backups(config=config)
+
+    if config.storage == "packs":
+        compact.compact(arguments, config=config)
+
+    return None
+
+
+COMMAND = Command(
+    name="prune",
+    help=(
+        "Remove the backups beyond the retention, and compact the packs with the"
+        ' "packs" storage'
+    ),
+    add_arguments=compact.add_arguments,
+    check_arguments=compact.check_arguments,
+    run=run,
+)
@@ -2,54 +2,175 @@ import argparse
 import logging
 import sys
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from direnv_backup.config import ConfigError, read_config
-from direnv_backup.encrypt import EncryptionError
-from direnv_backup.logging import set_up_logging_config
-from direnv_backup.restore import restore_backup
+from direnv_backup.cli.common import Command, run_single_command
+
+if TYPE_CHECKING:
+    from direnv_backup.config import Config
 
 logger = logging.getLogger(__name__)
 
 
-def parse_arguments(args: list[str] | None = None) -> argparse.Namespace:
-    parser = argparse.ArgumentParser()
+def add_list_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
-        "--config",
+        "--at",
         type=str,
-        help="Path to the config file",
+        help="Use the most recent backup created at or before this timestamp",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Run in this process even if the daemon is running",
     )
-    parser.add_argument("-v", "--verbose", action="store_true", help="Show debug logs")
-    arguments = parser.parse_args(args)
-    return arguments
 
 
-def main(args: list[str] | None = None) -> None | str:
-    arguments = parse_arguments(args=args)
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    add_list_arguments(parser)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show which files would be restored without writing them",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Amount of files to restore concurrently",
+    )
+    parser.add_argument(
+        "--file",
+        type=str,
+        help="Only restore this file",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the files in the backup instead of restoring them",
+    )
+
+
+def check_list_arguments(arguments: argparse.Namespace) -> str | None:
+    if arguments.at:
+        from direnv_backup.restore import RestoreError, parse_timestamp
+
+        try:
+            parse_timestamp(arguments.at)
+        except RestoreError as error:
+            return str(error)
+
+    return None
 
-    if not arguments.config:
-        return "Please specify a config (see --help)"
 
-    config_path = Path(arguments.config)
-    if not config_path.exists():
-        return f"Provided path for the config file does not exit: {config_path}"
+def check_arguments(arguments: argparse.Namespace) -> str | None:
+    if arguments.jobs < 1:
+        return "--jobs must be a positive integer"
+
+    return check_list_arguments(arguments)
+
+
+def run_list(
+    arguments: argparse.Namespace, config_path: Path, config: "Config"
+) -> str | None:
+    from direnv_backup import daemon
+
+    if not arguments.no_daemon and not arguments.profile:
+        response = daemon.request_or_run_here(
+            command="list", config_path=config_path, args={"at": arguments.at}
+        )
+        if response is not None:
+            logger.debug("Request served by the daemon")
+            if response.error:
+                return response.error
+            for name in response.result:
+                print(name)
+            return None
+
+    from direnv_backup.restore import RESTORE_ERRORS, list_backup, parse_timestamp
 
     try:
-        config = read_config(path=config_path)
-    except ConfigError as error:
+        at = parse_timestamp(arguments.at) if arguments.at else None
+        names = list_backup(config=config, at=at)
+    except RESTORE_ERRORS as error:
         return str(error)
 
-    set_up_logging_config(debug_mode_on=arguments.verbose)
+    for name in names:
+        print(name)
+    return None
+
+
+def run(
+    arguments: argparse.Namespace, config_path: Path, config: "Config"
+) -> str | None:
+    if arguments.list:
+        return run_list(arguments, config_path=config_path, config=config)
+
+    from direnv_backup import daemon
 
-    logger.debug(f"Config loaded: {config}")
+    # Dry runs only log, the logs of the daemon are not shown here. A profile is of
+    # this process
+    if not arguments.no_daemon and not arguments.dry_run and not arguments.profile:
+        response = daemon.request_or_run_here(
+            command="restore",
+            config_path=config_path,
+            args={
+                "at": arguments.at,
+                "jobs": arguments.jobs,
+                # The daemon runs in another working directory
+                "file": str(Path(arguments.file).absolute())
+                if arguments.file
+                else None,
+            },
+        )
+        if response is not None:
+            logger.debug("Request served by the daemon")
+            if response.error:
+                return response.error
+
+            # Same as `RestoreSummary`, without importing the restore stack
+            summary = ", ".join(
+                f"{count} {action}" for action, count in response.result.items()
+            )
+            logger.info(f"Restore summary: {summary}", extra={"stage": "restore"})
+            return None
+
+    from direnv_backup.restore import RESTORE_ERRORS, parse_timestamp, restore_backup
 
     try:
-        restore_backup(config=config)
-    except EncryptionError as error:
+        restore_backup(
+            config=config,
+            dry_run=arguments.dry_run,
+            jobs=arguments.jobs,
+            at=parse_timestamp(arguments.at) if arguments.at else None,
+            file=Path(arguments.file) if arguments.file else None,
+        )
+    except RESTORE_ERRORS as error:
         return str(error)
 
     return None
 
 
+COMMAND = Command(
+    name="restore",
+    help="Restore the direnv files of a backup",
+    add_arguments=add_arguments,
+    check_arguments=check_arguments,
+    run=run,
+)
+
+LIST_COMMAND = Command(
+    name="list",
+    help="List the files in a backup, without restoring them",
+    add_arguments=add_list_arguments,
+    check_arguments=check_list_arguments,
+    run=run_list,
+)
+
+
+def main(args: list[str] | None = None) -> None | str:
+    return run_single_command(COMMAND, args=args)
+
+
 if __name__ == "__main__":
     if exit_value := main():
         sys.exit(exit_value)
@@ -0,0 +1,103 @@
+import argparse
+import logging
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from direnv_backup.cli.common import Command, run_single_command
+
+if TYPE_CHECKING:
+    from direnv_backup.config import Config
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--backup",
+        type=str,
+        action="append",
+        help=(
+            "Backup to verify, either a path or a file name inside the backup dir. Can"
+            " be used multiple times. By default every backup is verified"
+        ),
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Amount of backups to verify concurrently",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        help="Maximum read rate in MiB/s, shared by all the concurrent verifications",
+    )
+
+
+def check_arguments(arguments: argparse.Namespace) -> str | None:
+    if arguments.jobs < 1:
+        return "--jobs must be a positive integer"
+
+    if arguments.bandwidth is not None and arguments.bandwidth <= 0:
+        return "--bandwidth must be a positive number"
+
+    return None
+
+
+def run(
+    arguments: argparse.Namespace, config_path: Path, config: "Config"
+) -> str | None:
+    from direnv_backup.encrypt import EncryptionError
+    from direnv_backup.restore import list_backups
+    from direnv_backup.verify import VerificationError, verify_backups
+
+    backups: list[Path] | None = None
+    if arguments.backup:
+        backups = []
+        stored = list_backups(config=config)
+        for value in arguments.backup:
+            path = Path(value)
+            if not path.exists():
+                path = config.backup_dir / value
+            if not path.exists() and path not in stored:
+                return f"Backup not found: {value}"
+            backups.append(path)
+
+    bytes_per_second = int(arguments.bandwidth * MIB) if arguments.bandwidth else None
+
+    try:
+        results = verify_backups(
+            config=config,
+            backups=backups,
+            jobs=arguments.jobs,
+            bytes_per_second=bytes_per_second,
+        )
+    except (EncryptionError, VerificationError) as error:
+        return str(error)
+
+    failed = [result for result in results if not result.ok]
+    if failed:
+        return f"{len(failed)} of {len(results)} backups failed verification"
+
+    return None
+
+
+COMMAND = Command(
+    name="verify",
+    help="Check that backups can be restored, without restoring them",
+    add_arguments=add_arguments,
+    check_arguments=check_arguments,
+    run=run,
+)
+
+
+def main(args: list[str] | None = None) -> None | str:
+    return run_single_command(COMMAND, args=args)
+
+
+if __name__ == "__main__":
+    if exit_value := main():
+        sys.exit(exit_value)
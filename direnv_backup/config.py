@@ -1,5 +1,6 @@
 import json
 import logging
+import math
 import os
 from dataclasses import Field, dataclass
 from pathlib import Path
@@ -8,9 +9,50 @@ logger = logging.getLogger(__name__)
 
 config_envvar_name = "DIRENV_BACKUP_CONFIG"
 
+# encryption backend name -> extension of the backups it encrypts
+ENCRYPTION_BACKENDS = {
+    "gpg": ".gpg",
+    "x25519": ".x25519",
+}
+
+ARCHIVE_FORMATS = ("tar", "seekable")
+
+# "files" stores each backup as its own file in the backup dir, "packs" appends them to a
+# few pack files, see `direnv_backup.store`. "dedup" also uses pack files, but stores
+# each distinct file once, see `direnv_backup.dedup`
+STORAGES = ("files", "packs", "dedup")
+
+# With the "dedup" storage a backup is a snapshot that lists the files it holds
+SNAPSHOT_EXTENSION = ".snapshot"
+
+# Seekable archives hold encrypted members, so they have the same extension whatever the
+# encryption backend is, see `direnv_backup.seekable`
+SEEKABLE_EXTENSION = ".dba"
+
+# S3 rejects multipart uploads with parts (other than the last one) smaller than this
+MIN_S3_PART_SIZE = 5 * 1024 * 1024
+
 Email = str
 
 
+@dataclass(frozen=True)
+class Destination:
+    path: Path  # folder where a copy of each backup is stored
+    keep: int = 10  # amount of backups kept in this destination
+
+
+@dataclass(frozen=True)
+class S3Target:
+    bucket: str
+    prefix: str = ""  # prepended to the name of every object
+    # S3 compatible endpoint (MinIO, Ceph...), AWS if not set. Credentials are read
+    # from the usual boto3 places: environment variables, ~/.aws/credentials...
+    endpoint_url: str | None = None
+    region: str | None = None
+    part_size: int = 8 * 1024 * 1024  # bytes per part of the multipart uploads
+    concurrency: int = 4  # parts uploaded at the same time
+
+
 @dataclass(frozen=True)
 class Config:
     root_dir: Path  # top of the filesystem where to start scanning for direnv files
@@ -26,11 +68,96 @@ class Config:
     # email used to select the public key used to encrypt the data.
     # required if `Config.encrypt == True`
     encryption_recipient: Email | None = None
+    #
+    # tool used to encrypt the backups, see `ENCRYPTION_BACKENDS`. With the "x25519"
+    # backend the recipient is a base64 encoded public key instead of an email.
+    encryption_backend: str = "gpg"
+    #
+    # fingerprint of the gpg key of `encryption_recipient`. Looked up once and kept in
+    # the compiled config when not set, see `direnv_backup.configcache`
+    encryption_fingerprint: str | None = None
+    #
+    # private key file used to decrypt the backups with the "x25519" backend
+    encryption_identity: Path | None = None
+    #
+    # layout of the backups, see `ARCHIVE_FORMATS`. "seekable" backups can restore a
+    # single file without decrypting the whole backup.
+    archive_format: str = "tar"
+    #
+    # how backups are stored in the backup dir, see `STORAGES`
+    storage: str = "files"
+    #
+    # seconds that each backup run can spend at most on garbage collection with the
+    # "dedup" storage, see `direnv_backup.dedup.collect_garbage`
+    gc_time_budget: float = 10
+    #
+    # other folders (USB drive, NAS...) where each backup is copied to, only with the
+    # "files" storage, see `direnv_backup.replicate`
+    destinations: tuple[Destination, ...] = ()
+    #
+    # bucket where new backups, or new blobs and snapshots with the "dedup" storage,
+    # are uploaded after each backup, see `direnv_backup.s3`
+    s3: S3Target | None = None
+    #
+    # niceness added to the backup and the processes it starts, like gpg. From 0 (no
+    # change) to 19 (lowest CPU priority)
+    nice: int = 0
+    #
+    # use the idle I/O scheduling class (see `man ionice`), so the backup only reads and
+    # writes when no other process is using the disk
+    ionice_idle: bool = False
+    #
+    # scanning pauses while the load average per CPU is above `throttle_load`, or while
+    # the I/O pressure (% of time stalled on I/O, see `/proc/pressure/io`) is above
+    # `throttle_io_pressure`, see `direnv_backup.throttle.LoadThrottle`
+    throttle_load: float | None = None
+    throttle_io_pressure: float | None = None
+    #
+    # seconds that each backup run can spend at most paused by the throttle, after
+    # which it stops pausing, see `direnv_backup.throttle.MAX_TOTAL_PAUSE`
+    throttle_time_budget: float = 300
+    #
+    # seconds that each backup run can spend at most on scanning. An unfinished scan
+    # resumes on the next run, see `direnv_backup.backup.scan_direnv_files`
+    scan_time_budget: float | None = None
+    #
+    # descend into symlinked folders while scanning. Each folder is visited once anyway,
+    # so symlink loops are not an issue
+    follow_symlinks: bool = True
+    #
+    # do not descend into folders that are on another file system than `root_dir`,
+    # e.g. network mounts
+    one_file_system: bool = False
+    #
+    # folder for data that can be rebuilt, like the hash of each direnv file, see
+    # `direnv_backup.hashcache`. Kept out of `backup_dir`, which may be synced
+    cache_dir: Path | None = None
 
     @property
     def tmp_dir(self) -> Path:
         return self.backup_dir / ".tmp"
 
+    @property
+    def resolved_cache_dir(self) -> Path:
+        if self.cache_dir:
+            return self.cache_dir
+
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+        return Path(xdg_cache_home) / "direnv-backup"
+
+    @property
+    def backup_extension(self) -> str:
+        if self.storage == "dedup":
+            return SNAPSHOT_EXTENSION
+
+        if self.archive_format == "seekable":
+            return SEEKABLE_EXTENSION
+
+        if not self.encrypt_backup:
+            return ".tar"
+
+        return ENCRYPTION_BACKENDS[self.encryption_backend]
+
     @classmethod
     @property
     def expected_json(self) -> str:
@@ -45,7 +172,9 @@ class Config:
                 field_type = field.type.__name__
             else:
                 field_type = str(field.type)
-            field_type = field_type.replace("set", "list")
+            field_type = field_type.replace("set", "list").replace("pathlib.", "")
+            field_type = field_type.replace("tuple", "list").replace(", ...", "")
+            field_type = field_type.replace(f"{__name__}.", "")
 
             attribute = f'  "{field_name}": <{field_type}>,'
 
@@ -93,7 +222,75 @@ def load_config(cli_path: str) -> Config | None:
     return None
 
 
+def is_positive_number(value: object) -> bool:
+    # `bool` is an `int` too
+    return (
+        isinstance(value, (int, float))
+        and not isinstance(value, bool)
+        and math.isfinite(value)
+        and value > 0
+    )
+
+
 def validate_config(config: Config) -> None:
+    if config.encryption_backend not in ENCRYPTION_BACKENDS:
+        supported = ", ".join(ENCRYPTION_BACKENDS)
+        raise ConfigError(
+            f"Unknown encryption backend {config.encryption_backend!r}, supported"
+            f" backends: {supported}"
+        )
+
+    if config.archive_format not in ARCHIVE_FORMATS:
+        supported = ", ".join(ARCHIVE_FORMATS)
+        raise ConfigError(
+            f"Unknown archive format {config.archive_format!r}, supported formats:"
+            f" {supported}"
+        )
+
+    if config.storage not in STORAGES:
+        supported = ", ".join(STORAGES)
+        raise ConfigError(
+            f"Unknown storage {config.storage!r}, supported storages: {supported}"
+        )
+
+    if config.destinations and config.storage != "files":
+        raise ConfigError('Destinations can only be used with the "files" storage')
+
+    for destination in config.destinations:
+        if destination.keep < 1:
+            raise ConfigError(f"Destination {destination.path} must keep 1+ backups")
+
+    if not 0 <= config.nice <= 19:
+        raise ConfigError("nice must be between 0 and 19")
+
+    if not is_positive_number(config.gc_time_budget):
+        raise ConfigError("gc_time_budget must be a positive number of seconds")
+
+    if config.scan_time_budget is not None and not is_positive_number(
+        config.scan_time_budget
+    ):
+        raise ConfigError("scan_time_budget must be a positive number of seconds")
+
+    if config.throttle_load is not None and not is_positive_number(
+        config.throttle_load
+    ):
+        raise ConfigError("throttle_load must be a positive number")
+
+    if config.throttle_io_pressure is not None and not (
+        is_positive_number(config.throttle_io_pressure)
+        and config.throttle_io_pressure <= 100
+    ):
+        raise ConfigError("throttle_io_pressure must be a percentage between 0 and 100")
+
+    if not is_positive_number(config.throttle_time_budget):
+        raise ConfigError("throttle_time_budget must be a positive number of seconds")
+
+    if config.s3 and config.s3.part_size < MIN_S3_PART_SIZE:
+        raise ConfigError(f"S3 part_size must be at least {MIN_S3_PART_SIZE} bytes")
+
+    if config.s3 and config.s3.concurrency < 1:
+        raise ConfigError("S3 concurrency must be at least 1")
+
     if config.encrypt_backup and not config.encryption_recipient:
         raise ConfigError(
             "Encryption is enabled (by default), but no recipient is specified. Please,"
@@ -104,33 +301,80 @@ def validate_config(config: Config) -> None:
         logger.debug("Configuration validation: encryption disabled")
 
 
+def read_s3_target(data: dict) -> S3Target:
+    defaults = S3Target(bucket="")
+    return S3Target(
+        bucket=data["bucket"],
+        prefix=data.get("prefix", defaults.prefix),
+        endpoint_url=data.get("endpoint_url"),
+        region=data.get("region"),
+        part_size=data.get("part_size", defaults.part_size),
+        concurrency=data.get("concurrency", defaults.concurrency),
+    )
+
+
+def expand_path(value: str) -> Path:
+    """
+    Replace the environment variables (`$VAR` or `${VAR}`) and the leading `~` in a path
+    of the config file, e.g. `${XDG_DATA_HOME}/direnv-backup`.
+    """
+    return Path(os.path.expandvars(value)).expanduser()
+
+
 def read_config(path: Path) -> Config:
     """
     Assumption: path exists
-    If paths contain curly braces, try to replace interpolate with env vars
+    Environment variables in paths are interpolated, see `expand_path`
     """
 
     raw_config = path.read_text()
     if not raw_config:
         raise ConfigError("Config file is empty")
 
-    # interpolate environemnt variables
-    # TODO
-    interpolated_config = raw_config
-
     # parse from JSON string
     try:
-        config_data = json.loads(interpolated_config)
+        config_data = json.loads(raw_config)
     except json.JSONDecodeError:
         raise ConfigError("Provided config file contains invalid JSON")
 
     try:
         config = Config(
-            root_dir=Path(config_data["root_dir"]),
+            root_dir=expand_path(config_data["root_dir"]),
             exclude=set(config_data["exclude"]),
-            backup_dir=Path(config_data["backup_dir"]),
+            backup_dir=expand_path(config_data["backup_dir"]),
             encrypt_backup=config_data.get("encrypt_backup"),
             encryption_recipient=config_data.get("encryption_recipient"),
+            encryption_backend=config_data.get("encryption_backend", "gpg"),
+            encryption_fingerprint=config_data.get("encryption_fingerprint"),
+            encryption_identity=(
+                expand_path(config_data["encryption_identity"])
+                if config_data.get("encryption_identity")
+                else None
+            ),
+            archive_format=config_data.get("archive_format", "tar"),
+            storage=config_data.get("storage", "files"),
+            gc_time_budget=config_data.get("gc_time_budget", 10),
+            destinations=tuple(
+                Destination(
+                    path=expand_path(destination["path"]),
+                    keep=destination.get("keep", 10),
+                )
+                for destination in config_data.get("destinations", [])
+            ),
+            s3=read_s3_target(config_data["s3"]) if config_data.get("s3") else None,
+            nice=config_data.get("nice", 0),
+            ionice_idle=config_data.get("ionice_idle", False),
+            throttle_load=config_data.get("throttle_load"),
+            throttle_io_pressure=config_data.get("throttle_io_pressure"),
+            throttle_time_budget=config_data.get("throttle_time_budget", 300),
+            scan_time_budget=config_data.get("scan_time_budget"),
+            follow_symlinks=config_data.get("follow_symlinks", True),
+            one_file_system=config_data.get("one_file_system", False),
+            cache_dir=(
+                expand_path(config_data["cache_dir"])
+                if config_data.get("cache_dir")
+                else None
+            ),
         )
     except KeyError as missing_field:
         raise ConfigError(
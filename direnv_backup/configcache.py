@@ -0,0 +1,136 @@
+"""
+Compiled form of a config file, so that commands started by shell hooks and timers do
+not parse, validate and resolve a config that did not change since the previous run.
+
+The compiled config is the `Config` returned by `read_config`, with the environment
+variables of its paths already interpolated and, with the gpg backend, the fingerprint
+of the recipient's key already looked up, see `compile_config`. It is pickled next to
+the config file, and used as long as none of these change:
+
+  - the config file, compared by modification time and sha256
+  - the environment variables that the config file refers to, and `HOME`
+  - the gpg public keyrings, compared by modification time
+"""
+import hashlib
+import logging
+import os
+import pickle
+import re
+from dataclasses import replace
+from pathlib import Path
+from typing import Any
+
+from direnv_backup.config import Config, read_config
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".compiled"
+
+ENV_VAR = re.compile(r"\$(\w+)|\$\{(\w+)\}")
+
+GPG_KEYRINGS = ("pubring.kbx", "pubring.gpg")
+
+
+def cache_path(config_path: Path) -> Path:
+    return config_path.with_name(f".{config_path.name}{CACHE_SUFFIX}")
+
+
+def _mtime_ns(path: Path) -> int | None:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _gpg_keyrings() -> list[Path]:
+    gpg_home = os.environ.get("GNUPGHOME") or Path.home() / ".gnupg"
+    return [Path(gpg_home) / name for name in GPG_KEYRINGS]
+
+
+def cache_key(config_path: Path, content: bytes) -> tuple[Any, ...]:
+    text = content.decode("utf-8", errors="replace")
+    names = {braced or plain for plain, braced in ENV_VAR.findall(text)}
+    names.update(("HOME", "GNUPGHOME"))
+
+    return (
+        # A compiled config written by another version may lack some fields
+        tuple(Config.__dataclass_fields__),
+        _mtime_ns(config_path),
+        hashlib.sha256(content).hexdigest(),
+        tuple((name, os.environ.get(name)) for name in sorted(names)),
+        tuple(_mtime_ns(path) for path in _gpg_keyrings()),
+    )
+
+
+def compile_config(config: Config) -> tuple[Config, bool]:
+    """
+    Resolve what `read_config` does not. Return the compiled config, and whether it is
+    complete: a lookup that failed is tried again on the next run instead of cached.
+    """
+    if (
+        not config.encrypt_backup
+        or config.encryption_backend != "gpg"
+        or not config.encryption_recipient
+        or config.encryption_fingerprint
+    ):
+        return config, True
+
+    from direnv_backup.encrypt import gpg_key_fingerprint
+
+    fingerprint = gpg_key_fingerprint(email=config.encryption_recipient)
+    if fingerprint is None:
+        return config, False
+
+    logger.debug(f"Key of {config.encryption_recipient!r}: {fingerprint}")
+    return replace(config, encryption_fingerprint=fingerprint), True
+
+
+def _load(path: Path, key: tuple[Any, ...]) -> Config | None:
+    try:
+        with path.open("rb") as f:
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                logger.debug(f"Ignoring {path}, it belongs to another user")
+                return None
+            cached_key, config = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError) as error:
+        logger.debug(f"Ignoring unreadable compiled config {path}: {error}")
+        return None
+    except (AttributeError, ImportError, TypeError) as error:
+        logger.debug(f"Ignoring compiled config of another version {path}: {error}")
+        return None
+
+    if cached_key != key:
+        return None
+
+    return config
+
+
+def _save(path: Path, key: tuple[Any, ...], config: Config) -> None:
+    from direnv_backup.io import atomic_write_bytes
+
+    content = pickle.dumps((key, config), protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        atomic_write_bytes(path=path, content=content, mode=0o600)
+    except OSError as error:
+        # e.g. a config in a read-only folder, compiled again on each run
+        logger.debug(f"Compiled config not saved to {path}: {error}")
+
+
+def read_compiled_config(path: Path) -> Config:
+    """
+    Like `read_config`, but reuse the compiled config of a previous run while it is
+    valid, see module docstring.
+    """
+    key = cache_key(config_path=path, content=path.read_bytes())
+
+    if config := _load(cache_path(path), key=key):
+        logger.debug(f"Using the compiled config of {path}")
+        return config
+
+    config, complete = compile_config(read_config(path=path))
+    if complete:
+        _save(cache_path(path), key=key, config=config)
+
+    return config
@@ -0,0 +1,385 @@
+"""
+Long-running process that backs up and restores on request, see `direnv-backup-daemon`.
+
+Every CLI invocation pays the Python startup, the config parsing, the gpg probing and a
+cold scan. The daemon pays them once, and keeps warm in memory:
+
+  - the listing of every scanned directory, see `direnv_backup.backup.ScanIndex`
+  - the encryption backend (gpg session, x25519 identity), see `reuse_backends`
+  - the config, read again only when its file changes
+
+`direnv-backup` and `direnv-restore` send their request to the daemon when it is
+running for the same config, and run in their own process otherwise.
+
+Requests and responses are JSON objects, one per line, over a Unix socket that only the
+user running the daemon can use. Clients check that the socket directory and the
+daemon belong to them before trusting a response, and run in their own process
+otherwise:
+
+    -> {"command": "list", "config": "/home/me/.config/direnv-backup.json", "args": {}}
+    <- {"ok": true, "result": ["project/.envrc"]}
+    <- {"ok": false, "error": "No backups found"}
+
+A restore responds with its summary, e.g. `{"unchanged": 2, "updated": 1, "created": 0}`.
+
+Commands: "backup", "list", "restore" (same arguments as `direnv-restore`), "status".
+"""
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from direnv_backup.config import Config, ConfigError
+from direnv_backup.configcache import read_compiled_config
+
+if TYPE_CHECKING:
+    from direnv_backup.backup import ScanIndex
+
+logger = logging.getLogger(__name__)
+
+SOCKET_NAME = "daemon.sock"
+
+# Seconds that a client waits for the daemon to accept its connection
+CONNECT_TIMEOUT = 1
+
+COMMANDS = ("backup", "list", "restore", "status")
+
+# Response code of a daemon that serves another config: the client runs the command in
+# its own process instead
+OTHER_CONFIG = "other-config"
+
+PEER_CREDENTIALS = struct.Struct("3i")  # pid, uid, gid, see SO_PEERCRED
+
+
+class DaemonError(Exception):
+    ...
+
+
+@dataclass(frozen=True)
+class Response:
+    result: Any = None
+    error: str | None = None
+
+
+def default_socket_path() -> Path:
+    if runtime_dir := os.environ.get("XDG_RUNTIME_DIR"):
+        return Path(runtime_dir) / "direnv-backup" / SOCKET_NAME
+    return Path(f"/tmp/direnv-backup-{os.getuid()}") / SOCKET_NAME
+
+
+def is_private_dir(dir: Path) -> bool:
+    """
+    Whether `dir` is a real directory owned by the current user, that nobody else can
+    use. In `/tmp` another user can create the socket directory first, and answer the
+    requests instead of the daemon.
+    """
+    try:
+        info = dir.lstat()
+    except OSError:
+        return False
+
+    return (
+        stat.S_ISDIR(info.st_mode)
+        and info.st_uid == os.getuid()
+        and stat.S_IMODE(info.st_mode) == 0o700
+    )
+
+
+def peer_uid(sock: socket.socket) -> int:
+    credentials = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size
+    )
+    _, uid, _ = PEER_CREDENTIALS.unpack(credentials)
+    return uid
+
+
+def is_listening(socket_path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(CONNECT_TIMEOUT)
+        try:
+            client.connect(str(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+def request(
+    command: str,
+    config_path: Path,
+    args: dict | None = None,
+    socket_path: Path | None = None,
+) -> Response | None:
+    """
+    Send a request to the daemon, and wait for its response. Return `None` if no daemon
+    is running for `config_path`.
+    """
+    socket_path = socket_path or default_socket_path()
+    if not socket_path.exists():
+        return None
+
+    if not is_private_dir(socket_path.parent):
+        logger.warning(
+            f"Not using the daemon, {socket_path.parent} must be owned by you with"
+            " mode 0700"
+        )
+        return None
+
+    message = {
+        "command": command,
+        "config": str(config_path.resolve()),
+        "args": args or {},
+    }
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(CONNECT_TIMEOUT)
+        try:
+            client.connect(str(socket_path))
+        except OSError as error:
+            logger.debug(f"Daemon not reachable at {socket_path}: {error}")
+            return None
+
+        if (uid := peer_uid(client)) != os.getuid():
+            logger.warning(f"Not using the daemon, {socket_path} belongs to user {uid}")
+            return None
+
+        # Backups and restores take as long as they take
+        client.settimeout(None)
+        try:
+            client.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            with client.makefile("rb") as stream:
+                line = stream.readline()
+        except OSError as error:
+            raise DaemonError(f"Lost the connection to the daemon: {error}")
+
+    if not line:
+        raise DaemonError("The daemon closed the connection without responding")
+
+    try:
+        data = json.loads(line)
+        if data.get("code") == OTHER_CONFIG:
+            logger.debug(data["error"])
+            return None
+
+        if data["ok"]:
+            return Response(result=data.get("result"))
+        return Response(error=data["error"])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise DaemonError(f"Malformed response from the daemon: {line!r}")
+
+
+def request_or_run_here(
+    command: str, config_path: Path, args: dict | None = None
+) -> Response | None:
+    """
+    Like `request`, but return `None` when the daemon fails to respond, so that the
+    caller runs the command in its own process instead.
+    """
+    try:
+        return request(command=command, config_path=config_path, args=args)
+    except DaemonError as error:
+        logger.warning(f"{error}, running in this process instead")
+        return None
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: "_Server"
+
+    def handle(self) -> None:
+        uid = peer_uid(self.request)
+        if uid != os.getuid():
+            logger.warning(f"Rejected a request from user {uid}")
+            return
+
+        line = self.rfile.readline()
+        if not line:
+            # e.g. `is_listening`
+            return
+
+        try:
+            message = json.loads(line)
+            response = self.server.daemon.handle(message)
+        except (ValueError, KeyError, TypeError) as error:
+            response = {"ok": False, "error": f"Invalid request: {error}"}
+        except Exception as error:
+            # Keep serving, and let the client know instead of leaving it hanging
+            logger.exception(f"Failed to handle {line!r}")
+            response = {"ok": False, "error": f"The daemon failed: {error}"}
+
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    daemon: "BackupDaemon"
+
+
+class BackupDaemon:
+    """
+    Serve requests for the config at `config_path` on `socket_path`, see module
+    docstring. Backups and restores run one at a time.
+    """
+
+    def __init__(self, config_path: Path, socket_path: Path | None = None) -> None:
+        self.config_path = config_path.resolve()
+        self.socket_path = socket_path or default_socket_path()
+
+        self._config_mtime_ns = 0
+        self._config: Config | None = None
+        self._lock = threading.Lock()
+        self._busy: str | None = None
+
+        self.scan_index: "ScanIndex" = {}
+        self.started_at = time.time()
+        self.last_backup: dict | None = None
+
+    @property
+    def config(self) -> Config:
+        mtime_ns = self.config_path.stat().st_mtime_ns
+        if self._config is None or mtime_ns != self._config_mtime_ns:
+            self._config = read_compiled_config(path=self.config_path)
+            self._config_mtime_ns = mtime_ns
+            self.scan_index.clear()
+            logger.info(f"Config loaded from {self.config_path}")
+
+        return self._config
+
+    def handle(self, message: dict) -> dict:
+        command = message["command"]
+        if command not in COMMANDS:
+            return {"ok": False, "error": f"Unknown command {command!r}"}
+
+        if Path(message["config"]) != self.config_path:
+            return {
+                "ok": False,
+                "code": OTHER_CONFIG,
+                "error": f"The daemon serves {self.config_path}",
+            }
+
+        if command == "status":
+            return {"ok": True, "result": self.status()}
+
+        logger.info(f"Running {command!r} requested by a client")
+        with self._lock:
+            self._busy = command
+            try:
+                config = self.config
+                if command == "backup":
+                    return self._backup(config)
+                if command == "list":
+                    return self._list(config, args=message["args"])
+                return self._restore(config, args=message["args"])
+            except ConfigError as error:
+                return {"ok": False, "error": str(error)}
+            finally:
+                self._busy = None
+
+    def _backup(self, config: Config) -> dict:
+        from direnv_backup.cli.backup import run_backup
+        from direnv_backup.encrypt import forget_backends
+        from direnv_backup.metrics import metrics
+
+        start = time.monotonic()
+        error = run_backup(config=config, scan_index=self.scan_index)
+        if error:
+            # e.g. a gpg key that was missing, and may be imported before the next run
+            forget_backends()
+
+        self.last_backup = {
+            "finished_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "duration": round(time.monotonic() - start, 3),
+            "error": error,
+            "metrics": metrics.as_dict(),
+        }
+
+        if error:
+            return {"ok": False, "error": error}
+        return {"ok": True, "result": None}
+
+    def _list(self, config: Config, args: dict) -> dict:
+        from direnv_backup.restore import RESTORE_ERRORS, list_backup, parse_timestamp
+
+        try:
+            at = parse_timestamp(args["at"]) if args.get("at") else None
+            names = list_backup(config=config, at=at)
+        except RESTORE_ERRORS as error:
+            return {"ok": False, "error": str(error)}
+
+        return {"ok": True, "result": names}
+
+    def _restore(self, config: Config, args: dict) -> dict:
+        from direnv_backup.restore import (
+            RESTORE_ERRORS,
+            parse_timestamp,
+            restore_backup,
+        )
+
+        try:
+            summary = restore_backup(
+                config=config,
+                jobs=args.get("jobs", 1),
+                at=parse_timestamp(args["at"]) if args.get("at") else None,
+                file=Path(args["file"]) if args.get("file") else None,
+            )
+        except RESTORE_ERRORS as error:
+            return {"ok": False, "error": str(error)}
+
+        return {"ok": True, "result": dataclasses.asdict(summary)}
+
+    def status(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "config": str(self.config_path),
+            "uptime": round(time.time() - self.started_at, 3),
+            "busy": self._busy,
+            "indexed_dirs": len(self.scan_index),
+            "last_backup": self.last_backup,
+        }
+
+    def _bind(self) -> _Server:
+        self.socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # `mkdir` leaves an existing directory as it is
+        if not is_private_dir(self.socket_path.parent):
+            raise DaemonError(
+                f"{self.socket_path.parent} must be owned by you with mode 0700"
+            )
+
+        if self.socket_path.exists():
+            if is_listening(self.socket_path):
+                raise DaemonError(f"A daemon is already running on {self.socket_path}")
+            # Left behind by a daemon that did not exit cleanly
+            self.socket_path.unlink()
+
+        server = _Server(str(self.socket_path), _RequestHandler)
+        server.daemon = self
+        os.chmod(self.socket_path, 0o600)
+        return server
+
+    def serve_forever(self, ready: threading.Event | None = None) -> None:
+        from direnv_backup.encrypt import reuse_backends
+
+        # Fails early on an invalid config
+        self.config
+
+        self._server = self._bind()
+        logger.info(f"Listening on {self.socket_path}")
+        try:
+            with reuse_backends():
+                if ready:
+                    ready.set()
+                self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self.socket_path.unlink(missing_ok=True)
+
+    def shutdown(self) -> None:
+        self._server.shutdown()
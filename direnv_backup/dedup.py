@@ -0,0 +1,363 @@
+"""
+Deduplicated storage: each distinct file is stored once, as a blob named after the hash
+of its content, and each backup is a snapshot that lists the blobs it is made of. All
+of them are kept in pack files, see `direnv_backup.store`.
+
+    blob-<sha256>             content of a file, encrypted on its own
+    <timestamp>.snapshot      encrypted snapshot: file name -> blob and mode
+    <timestamp>.refs          blobs referenced by the snapshot, not encrypted
+
+The `.refs` entries let the garbage collector run without the private key. They, and
+the blob names, reveal which backups share files, but not their names or content.
+
+Removing a snapshot does not remove its blobs, since other snapshots may share them.
+`DedupStore.collect_garbage` frees the blobs that no snapshot references anymore.
+"""
+import fcntl
+import json
+import logging
+import stat
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from direnv_backup.archive import ArchiveMember, Manifest, known_hash
+from direnv_backup.config import SNAPSHOT_EXTENSION
+from direnv_backup.encrypt import EncryptionBackend
+from direnv_backup.io import atomic_write_bytes
+from direnv_backup.seekable import FRAME_BATCH_SIZE
+from direnv_backup.store import PackReader, PackStore
+
+logger = logging.getLogger(__name__)
+
+BLOB_PREFIX = "blob-"
+REFS_EXTENSION = ".refs"
+SNAPSHOT_VERSION = 1
+
+GC_STATE_NAME = "gc-state.json"
+LOCK_NAME = ".dedup.lock"
+
+# Amount of blobs dropped from the pack indexes at a time while sweeping, the time
+# budget is checked between batches
+SWEEP_BATCH_SIZE = 1000
+
+
+class DedupError(Exception):
+    ...
+
+
+@dataclass(frozen=True)
+class SnapshotEntry:
+    blob: str  # sha256 hex digest of the content
+    mode: int
+
+
+Snapshot = dict[str, SnapshotEntry]  # file name -> blob
+
+
+@dataclass(frozen=True)
+class GCSummary:
+    marked: int  # snapshots marked in this run
+    swept: int  # blobs freed in this run
+    finished: bool  # whether the collection cycle is over
+
+    def __str__(self) -> str:
+        status = "finished" if self.finished else "in progress"
+        return f"{self.marked} snapshots marked, {self.swept} blobs freed, {status}"
+
+
+@dataclass
+class GCState:
+    """
+    Progress of a garbage collection cycle, saved between runs in `GC_STATE_NAME`.
+
+    `candidates` are the blobs that existed when the cycle started, blobs added later
+    are never swept in this cycle. Before sweeping, every snapshot that exists at that
+    point is marked, including those created after the cycle started.
+    """
+
+    candidates: set[str]
+    marked_snapshots: set[str]
+    marked: set[str]
+    # Snapshots were removed during this cycle, another cycle must follow
+    rerun: bool = False
+
+
+def blob_name(digest: str) -> str:
+    return f"{BLOB_PREFIX}{digest}"
+
+
+def refs_name(snapshot_name: str) -> str:
+    return snapshot_name.removesuffix(SNAPSHOT_EXTENSION) + REFS_EXTENSION
+
+
+def encode_snapshot(snapshot: Snapshot) -> bytes:
+    files = {
+        name: {"blob": entry.blob, "mode": entry.mode}
+        for name, entry in sorted(snapshot.items())
+    }
+    data = {"version": SNAPSHOT_VERSION, "files": files}
+    return json.dumps(data, sort_keys=True).encode("utf-8")
+
+
+def decode_snapshot(content: bytes) -> Snapshot:
+    try:
+        data = json.loads(content)
+    except ValueError:
+        raise DedupError("Corrupt snapshot")
+
+    if not isinstance(data, dict):
+        raise DedupError("Corrupt snapshot")
+
+    if data.get("version") != SNAPSHOT_VERSION:
+        raise DedupError(f"Unsupported snapshot version: {data.get('version')}")
+
+    files = data.get("files")
+    if not isinstance(files, dict):
+        raise DedupError("Corrupt snapshot")
+
+    return {name: decode_snapshot_entry(name, entry) for name, entry in files.items()}
+
+
+def decode_snapshot_entry(name: str, entry: object) -> SnapshotEntry:
+    if (
+        not isinstance(entry, dict)
+        or entry.keys() != {"blob", "mode"}
+        or type(entry["blob"]) is not str
+        or type(entry["mode"]) is not int
+    ):
+        raise DedupError(f"Corrupt snapshot entry: {name}")
+
+    return SnapshotEntry(**entry)
+
+
+class DedupStore:
+    """
+    Store of deduplicated snapshots in `dir`, encrypted with `backend` unless it is not
+    set. See module docstring.
+    """
+
+    def __init__(self, dir: Path, backend: EncryptionBackend | None) -> None:
+        self.dir = dir
+        self.backend = backend
+        self.packs = PackStore(dir=dir)
+
+    @property
+    def _gc_state_path(self) -> Path:
+        return self.dir / GC_STATE_NAME
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """
+        Keep garbage collection from freeing blobs that a new snapshot is about to
+        reference.
+        """
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with (self.dir / LOCK_NAME).open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def snapshots(self) -> list[str]:
+        return [
+            name for name in self.packs.names() if name.endswith(SNAPSHOT_EXTENSION)
+        ]
+
+    def write_snapshot(
+        self, name: str, dir: Path, base: Path, hashes: Manifest | None = None
+    ) -> Snapshot:
+        """
+        Store a snapshot of every file inside `dir`, named after their relative path
+        from `base` (see `direnv_backup.archive.archive_dir`). Only the files that are
+        not in the store yet are encrypted and written. Files in `hashes` are not
+        hashed again.
+        """
+        assert name.endswith(SNAPSHOT_EXTENSION)
+
+        paths = sorted(path for path in dir.rglob("*") if path.is_file())
+        snapshot: Snapshot = {
+            str(path.relative_to(base)): SnapshotEntry(
+                blob=known_hash(path, name=str(path.relative_to(base)), hashes=hashes),
+                mode=stat.S_IMODE(path.stat().st_mode),
+            )
+            for path in paths
+        }
+
+        with self._lock():
+            with self.packs.open_reader() as reader:
+                new_blobs: dict[str, Path] = {}
+                for path, entry in zip(paths, snapshot.values()):
+                    if blob_name(entry.blob) not in reader:
+                        new_blobs.setdefault(entry.blob, path)
+
+            logger.debug(f"{len(new_blobs)} of {len(paths)} files are new")
+
+            to_store = list(new_blobs.values())
+            if self.backend:
+                contents = self.backend.encrypt_files(to_store)
+            else:
+                contents = [path.read_bytes() for path in to_store]
+
+            encoded = encode_snapshot(snapshot)
+            if self.backend:
+                encoded = self.backend.encrypt_bytes(encoded)
+            refs = sorted({entry.blob for entry in snapshot.values()})
+
+            # Indexed all at once, so the snapshot never exists without its blobs
+            entries = {
+                blob_name(digest): content
+                for digest, content in zip(new_blobs, contents)
+            }
+            entries[refs_name(name)] = json.dumps(refs).encode("utf-8")
+            entries[name] = encoded
+            self.packs.add_many(entries)
+
+        return snapshot
+
+    def read_snapshot(self, name: str, reader: PackReader | None = None) -> Snapshot:
+        if reader is None:
+            with self.packs.open_reader() as reader:
+                return self.read_snapshot(name=name, reader=reader)
+
+        encoded = reader.read(name)
+        if self.backend:
+            encoded = self.backend.decrypt_bytes(encoded)
+
+        return decode_snapshot(encoded)
+
+    def iter_members(
+        self, snapshot_name: str, names: set[str] | None = None
+    ) -> Iterator[ArchiveMember]:
+        """
+        Yield the files of the snapshot in `names` (every file by default), decrypting
+        their blobs in batches.
+        """
+        with self.packs.open_reader() as reader:
+            snapshot = self.read_snapshot(name=snapshot_name, reader=reader)
+            wanted = [
+                name for name in sorted(snapshot) if names is None or name in names
+            ]
+
+            for start in range(0, len(wanted), FRAME_BATCH_SIZE):
+                end = start + FRAME_BATCH_SIZE
+                batch = wanted[start:end]
+                blobs = [reader.read(blob_name(snapshot[name].blob)) for name in batch]
+                contents = self.backend.decrypt_many(blobs) if self.backend else blobs
+
+                for name, content in zip(batch, contents):
+                    yield ArchiveMember(
+                        name=name, content=content, mode=snapshot[name].mode
+                    )
+
+    def remove_snapshots(self, names: Iterable[str]) -> None:
+        """
+        Remove snapshots, but not their blobs, and schedule a garbage collection cycle.
+        """
+        names = list(names)
+        if not names:
+            return
+
+        with self._lock():
+            self.packs.remove([*names, *(refs_name(name) for name in names)])
+
+            state = self._load_gc_state()
+            if state is None:
+                self._save_gc_state(self._new_gc_state())
+            elif not state.rerun:
+                state.rerun = True
+                self._save_gc_state(state)
+
+    def _new_gc_state(self) -> GCState:
+        blobs = {
+            name.removeprefix(BLOB_PREFIX)
+            for name in self.packs.names()
+            if name.startswith(BLOB_PREFIX)
+        }
+        return GCState(candidates=blobs, marked_snapshots=set(), marked=set())
+
+    def _load_gc_state(self) -> GCState | None:
+        if not self._gc_state_path.exists():
+            return None
+
+        data = json.loads(self._gc_state_path.read_text())
+        return GCState(
+            candidates=set(data["candidates"]),
+            marked_snapshots=set(data["marked_snapshots"]),
+            marked=set(data["marked"]),
+            rerun=data["rerun"],
+        )
+
+    def _save_gc_state(self, state: GCState) -> None:
+        data = {
+            "candidates": sorted(state.candidates),
+            "marked_snapshots": sorted(state.marked_snapshots),
+            "marked": sorted(state.marked),
+            "rerun": state.rerun,
+        }
+        content = json.dumps(data).encode("utf-8")
+        atomic_write_bytes(path=self._gc_state_path, content=content, mode=0o600)
+
+    def collect_garbage(self, time_budget: float) -> GCSummary:
+        """
+        Run the current garbage collection cycle for up to `time_budget` seconds:
+
+          1. mark: every blob referenced by a snapshot is marked
+          2. sweep: the blobs that existed when the cycle started and are not marked
+             are dropped from the pack indexes
+          3. the packs that are now mostly garbage are compacted
+
+        Progress is saved in `GC_STATE_NAME` and the next call resumes from there. Every
+        step is idempotent and the state is saved after the changes it describes, so
+        the collection is safe to interrupt at any point.
+        """
+        deadline = time.monotonic() + time_budget
+        marked = swept = 0
+
+        with self._lock():
+            state = self._load_gc_state()
+            if state is None:
+                return GCSummary(marked=0, swept=0, finished=True)
+
+            with self.packs.open_reader() as reader:
+                pending = sorted(
+                    name
+                    for name in reader.entries
+                    if name.endswith(REFS_EXTENSION)
+                    and name not in state.marked_snapshots
+                )
+                for name in pending:
+                    if time.monotonic() >= deadline:
+                        self._save_gc_state(state)
+                        return GCSummary(marked=marked, swept=0, finished=False)
+
+                    state.marked.update(json.loads(reader.read(name)))
+                    state.marked_snapshots.add(name)
+                    marked += 1
+
+            garbage = sorted(state.candidates - state.marked)
+            for start in range(0, len(garbage), SWEEP_BATCH_SIZE):
+                if time.monotonic() >= deadline:
+                    self._save_gc_state(state)
+                    return GCSummary(marked=marked, swept=swept, finished=False)
+
+                end = start + SWEEP_BATCH_SIZE
+                batch = garbage[start:end]
+                self.packs.remove(blob_name(digest) for digest in batch)
+                state.candidates.difference_update(batch)
+                swept += len(batch)
+
+            if state.rerun:
+                self._save_gc_state(self._new_gc_state())
+            else:
+                self._gc_state_path.unlink()
+
+        logger.debug(f"Garbage collection cycle finished, {swept} blobs freed")
+
+        compaction = self.packs.compact(deadline=deadline)
+        logger.debug(f"Compaction summary: {compaction}")
+
+        return GCSummary(marked=marked, swept=swept, finished=True)
@@ -1,25 +1,43 @@
 import logging
+import os
+import shutil
 import subprocess
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import IO, ContextManager, Iterator
 
+from direnv_backup import process
+from direnv_backup.config import Config
 from direnv_backup.types import Email
 
 logger = logging.getLogger(__name__)
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Never wait for user input, and write machine readable status lines to stderr
+GPG_BATCH_ARGS = ["--batch", "--no-tty", "--status-fd", "2"]
+GPG_STATUS_PREFIX = "[GNUPG:] "
+
+# Seconds before a gpg process is killed. Quick lookups have a shorter timeout than
+# encryption and decryption, whose duration grows with the backup size.
+GPG_PROBE_TIMEOUT = 30
+GPG_TIMEOUT = 600
+
+# Seconds between two attempts at unblocking a thread that waits on a named pipe that
+# gpg never opened, see `release_pipe`
+PIPE_RELEASE_INTERVAL = 0.05
+
 
 class EncryptionError(Exception):
     ...
 
 
 def is_gpg_installed() -> bool:
-    cmd = ["which", "gpg"]
-    proc = subprocess.run(cmd, capture_output=True)
-    stdout = proc.stdout.decode("utf-8")
-
-    fmt_command = " ".join(cmd)
-    logger.debug(f"{fmt_command!r} returned this stdout: {stdout!r}")
-
-    gpg_command_found = stdout != ""
+    gpg_command_found = shutil.which("gpg") is not None
     if gpg_command_found:
         logger.debug("gpg command is installed")
     else:
@@ -29,14 +47,14 @@ def is_gpg_installed() -> bool:
 
 
 def email_has_gpg_key_associated(email: Email) -> bool:
-    cmd = ["gpg", "--list-keys"]
-    logger.debug(f'Executing {" ".join([str(x) for x in cmd])!r} ...')
-    proc = subprocess.run(cmd, capture_output=True)
-    stdout = proc.stdout.decode("utf-8")
-    stderr = proc.stderr.decode("utf-8")
+    cmd = ["gpg", *GPG_BATCH_ARGS, "--list-keys"]
+    try:
+        proc = process.run(cmd, timeout=GPG_PROBE_TIMEOUT, check=False)
+    except process.ProcessError as error:
+        raise to_gpg_error(error)
 
+    stdout = proc.stdout.decode("utf-8")
     logger.debug(f"{stdout=}")
-    logger.debug(f"{stderr=}")
 
     email_found_in_keys = f"<{email}>" in stdout
 
@@ -48,70 +66,526 @@ def email_has_gpg_key_associated(email: Email) -> bool:
     return email_found_in_keys
 
 
-class GPGError(Exception):
-    ...
+def gpg_key_fingerprint(email: Email) -> str | None:
+    """
+    Return the fingerprint of the only gpg key of `email`, or `None` if gpg is not
+    installed or has no key, or several keys, for it.
+    """
+    if not is_gpg_installed():
+        return None
 
+    cmd = ["gpg", *GPG_BATCH_ARGS, "--with-colons", "--list-keys", f"<{email}>"]
+    try:
+        proc = process.run(cmd, timeout=GPG_PROBE_TIMEOUT, check=False)
+    except process.ProcessError as error:
+        logger.debug(f"Fingerprint lookup for {email!r} failed: {error}")
+        return None
 
-def encrypt(path_to_encrypt: Path, encrypted_path: Path, recipient: Email) -> None:
-    if not is_gpg_installed():
-        error_message = "gpg is not installed"
-        logger.debug(error_message)
-        raise EncryptionError(error_message)
-
-    if not email_has_gpg_key_associated(email=recipient):
-        error_message = f"No key found for recipient {recipient!r}"
-        logger.debug(error_message)
-        raise EncryptionError(error_message)
-
-    cmd = [
-        "gpg",
-        "--output",
-        str(encrypted_path),
-        "--encrypt",
-        "--recipient",
-        recipient,
-        str(path_to_encrypt),
+    if proc.returncode != 0:
+        return None
+
+    # Each primary key ("pub") is followed by its fingerprint ("fpr"), then by its user
+    # ids and subkeys, see doc/DETAILS in the gnupg sources
+    records = [line.split(":") for line in proc.stdout.decode("utf-8").splitlines()]
+    fingerprints = [
+        fields[9]
+        for previous, fields in zip(records, records[1:])
+        if previous[0] == "pub" and fields[0] == "fpr"
     ]
-    logger.debug(f'Executing {" ".join([str(x) for x in cmd])!r} ...')
-    proc = subprocess.run(cmd, capture_output=True)
-    stdout = proc.stdout.decode("utf-8")
-    stderr = proc.stderr.decode("utf-8")
+    if len(fingerprints) != 1:
+        logger.debug(f"Found {len(fingerprints)} keys for {email!r}")
+        return None
 
-    something_went_wrong = proc.returncode != 0
+    return fingerprints[0]
 
-    if something_went_wrong:
-        # TODO: handle this with the corresponding exceptions - if key missing, etc.
-        print(f"{stdout=}")
-        print(f"{stderr=}")
-        raise GPGError(stderr)
 
-    logger.debug(f"Encryption output: {encrypted_path}")
+class GPGError(EncryptionError):
+    ...
 
 
-def decrypt(encrypted_path: Path) -> Path:
-    if not is_gpg_installed():
-        raise EncryptionError("gpg is not installed")
+def to_gpg_error(error: process.ProcessError) -> GPGError:
+    """
+    Keep gpg's own error messages, without the status lines, if gpg failed on its own.
+    """
+    if isinstance(error, (process.ProcessTimeout, process.ProcessCancelled)):
+        return GPGError(str(error))
 
-    decrypted_path = encrypted_path.with_suffix(".tar")
+    _, messages = parse_gpg_stderr(error.stderr)
+    return GPGError("\n".join(messages) or str(error))
+
+
+@dataclass(frozen=True)
+class GPGStatus:
+    """
+    Machine readable line that gpg writes to `--status-fd`, e.g.:
+
+        [GNUPG:] FILE_START 3 foo.gpg   -->   GPGStatus("FILE_START", ("3", "foo.gpg"))
+    """
+
+    keyword: str
+    arguments: tuple[str, ...]
+
+
+def parse_gpg_stderr(stderr: str) -> tuple[list[GPGStatus], list[str]]:
+    """
+    Split what gpg writes to stderr into status lines and human readable messages. See
+    `GPG_BATCH_ARGS`.
+    """
+    statuses: list[GPGStatus] = []
+    messages: list[str] = []
+
+    for line in stderr.splitlines():
+        if line.startswith(GPG_STATUS_PREFIX):
+            keyword, *arguments = line.removeprefix(GPG_STATUS_PREFIX).split(" ")
+            statuses.append(GPGStatus(keyword=keyword, arguments=tuple(arguments)))
+        else:
+            messages.append(line)
+
+    return statuses, messages
+
+
+@dataclass(frozen=True)
+class GPGFileResult:
+    path: Path
+    statuses: list[GPGStatus]
+
+    @property
+    def ok(self) -> bool:
+        keywords = {status.keyword for status in self.statuses}
+        if "FILE_START" not in keywords:
+            return False
+        return bool(keywords & {"END_ENCRYPTION", "DECRYPTION_OKAY"}) and not (
+            keywords & {"DECRYPTION_FAILED", "INV_RECP", "NODATA", "FAILURE"}
+        )
+
+
+def split_statuses_by_file(statuses: list[GPGStatus]) -> dict[Path, list[GPGStatus]]:
+    """
+    When gpg processes several files in one go (`--encrypt-files`, `--decrypt-files`)
+    the statuses of each file are between a FILE_START and a FILE_DONE status.
+    """
+    by_file: dict[Path, list[GPGStatus]] = {}
+    current: list[GPGStatus] | None = None
+
+    for status in statuses:
+        if status.keyword == "FILE_START":
+            current = by_file.setdefault(Path(" ".join(status.arguments[1:])), [])
+        if current is not None:
+            current.append(status)
+        if status.keyword == "FILE_DONE":
+            current = None
+
+    return by_file
+
+
+class GPGSession:
+    """
+    Reuse the same gpg setup for many operations: gpg is located once, each recipient's
+    key is looked up once, and gpg-agent is started upfront so that every gpg process
+    talks to an already warm agent instead of starting one.
+
+    Many files can be encrypted or decrypted with a single gpg process, see
+    `encrypt_files` and `decrypt_many`. gpg runs with `--batch --no-tty` so it never
+    waits for user input, and reports structured results through `--status-fd`.
+    """
+
+    def __init__(
+        self, timeout: float = GPG_TIMEOUT, cancel: threading.Event | None = None
+    ) -> None:
+        self.timeout = timeout
+        self.cancel = cancel
+        self._gpg_installed: bool | None = None
+        self._keys: dict[Email, bool] = {}
+        self._agent_started = False
+
+    def ensure_gpg_installed(self) -> None:
+        if self._gpg_installed is None:
+            self._gpg_installed = is_gpg_installed()
+
+        if not self._gpg_installed:
+            error_message = "gpg is not installed"
+            logger.debug(error_message)
+            raise EncryptionError(error_message)
+
+    def ensure_recipient_has_key(self, recipient: Email) -> None:
+        if recipient not in self._keys:
+            self._keys[recipient] = email_has_gpg_key_associated(email=recipient)
+
+        if not self._keys[recipient]:
+            error_message = f"No key found for recipient {recipient!r}"
+            logger.debug(error_message)
+            raise EncryptionError(error_message)
+
+    def add_known_key(self, recipient: str) -> None:
+        """
+        Skip the lookup of `recipient`, e.g. a fingerprint resolved beforehand.
+        """
+        self._keys[recipient] = True
+
+    def start_agent(self) -> None:
+        if self._agent_started:
+            return
+
+        cmd = ["gpgconf", "--launch", "gpg-agent"]
+        try:
+            process.run(cmd, timeout=GPG_PROBE_TIMEOUT, cancel=self.cancel)
+        except (FileNotFoundError, process.ProcessError) as error:
+            # gpg-agent is started on demand anyway
+            logger.debug(f"gpg-agent not started upfront: {error}")
+
+        self._agent_started = True
+
+    def _prepare(self, recipient: Email | None = None) -> None:
+        self.ensure_gpg_installed()
+        if recipient:
+            self.ensure_recipient_has_key(recipient=recipient)
+        self.start_agent()
+
+    def _run(self, cmd: list[str], input: bytes | None = None) -> bytes:
+        try:
+            proc = process.run(
+                cmd, timeout=self.timeout, input=input, cancel=self.cancel
+            )
+        except process.ProcessError as error:
+            raise to_gpg_error(error)
+
+        return proc.stdout
+
+    def encrypt(
+        self, path_to_encrypt: Path, encrypted_path: Path, recipient: Email
+    ) -> None:
+        self._prepare(recipient=recipient)
+
+        cmd = [
+            "gpg",
+            *GPG_BATCH_ARGS,
+            "--output",
+            str(encrypted_path),
+            "--encrypt",
+            "--recipient",
+            recipient,
+            str(path_to_encrypt),
+        ]
+        self._run(cmd)
+
+        logger.debug(f"Encryption output: {encrypted_path}")
+
+    def encrypt_bytes(self, data: bytes, recipient: Email) -> bytes:
+        self._prepare(recipient=recipient)
+        cmd = ["gpg", *GPG_BATCH_ARGS, "--encrypt", "--recipient", recipient]
+        return self._run(cmd, input=data)
+
+    def decrypt_bytes(self, data: bytes) -> bytes:
+        self._prepare()
+        cmd = ["gpg", *GPG_BATCH_ARGS, "--decrypt"]
+        return self._run(cmd, input=data)
+
+    def _run_multifile(self, cmd: list[str], paths: list[Path]) -> list[GPGFileResult]:
+        # gpg exits with an error status if any file fails, the result of each file is
+        # read from the status lines instead
+        try:
+            proc = process.run(
+                [*cmd, *[str(path) for path in paths]],
+                timeout=self.timeout,
+                cancel=self.cancel,
+                check=False,
+            )
+        except process.ProcessError as error:
+            raise to_gpg_error(error)
+
+        statuses, _ = parse_gpg_stderr(proc.stderr)
+        by_file = split_statuses_by_file(statuses)
+        return [
+            GPGFileResult(path=path, statuses=by_file.get(path, [])) for path in paths
+        ]
+
+    def encrypt_files(self, paths: list[Path], recipient: Email) -> list[GPGFileResult]:
+        """
+        Encrypt every file in `paths` with a single gpg process. Each encrypted file is
+        written next to the original one, with an extra `.gpg` extension.
+        """
+        self._prepare(recipient=recipient)
+        cmd = [
+            "gpg",
+            *GPG_BATCH_ARGS,
+            "--yes",
+            "--recipient",
+            recipient,
+            "--encrypt-files",
+        ]
+        return self._run_multifile(cmd, paths=paths)
+
+    def decrypt_many(self, encrypted: list[bytes]) -> list[bytes]:
+        """
+        Decrypt every item in `encrypted` with a single gpg process, and return them in
+        the same order.
+
+        `--decrypt-files` only works on files: each item and its decrypted content go
+        through named pipes in a private temporary directory instead, so that neither
+        is ever written to disk.
+        """
+        if not encrypted:
+            return []
+        self._prepare()
+
+        decrypted: dict[Path, bytes] = {}
+        with tempfile.TemporaryDirectory(prefix="direnv-backup-") as tmp:
+            paths = [Path(tmp) / f"{i}.gpg" for i in range(len(encrypted))]
+            outputs = [path.with_suffix("") for path in paths]
+            for path in [*paths, *outputs]:
+                os.mkfifo(path, 0o600)
+
+            writers = [
+                threading.Thread(target=write_pipe, args=(path, data), daemon=True)
+                for path, data in zip(paths, encrypted)
+            ]
+            readers = [
+                threading.Thread(
+                    target=read_pipe, args=(output, decrypted), daemon=True
+                )
+                for output in outputs
+            ]
+            for thread in [*writers, *readers]:
+                thread.start()
+
+            try:
+                cmd = ["gpg", *GPG_BATCH_ARGS, "--yes", "--decrypt-files"]
+                results = self._run_multifile(cmd, paths=paths)
+            finally:
+                for path, thread in zip(paths, writers):
+                    release_pipe(path, thread=thread, flags=os.O_RDONLY)
+                for output, thread in zip(outputs, readers):
+                    release_pipe(output, thread=thread, flags=os.O_WRONLY)
+
+        for result in results:
+            if not result.ok:
+                raise GPGError(f"gpg failed to process {result.path.name}")
+
+        return [decrypted[output] for output in outputs]
+
+    @contextmanager
+    def decrypt_stream(self, encrypted_path: Path) -> Iterator[IO[bytes]]:
+        """
+        Decrypt `encrypted_path` to gpg's stdout and yield it as a stream, so the
+        decrypted data is never written to disk.
+
+        Whatever the caller leaves unread is drained before checking gpg's exit status,
+        so that integrity errors at the end of the encrypted data are still detected. If
+        the caller raises, gpg is killed instead. gpg is also killed if it does not
+        finish within the session timeout.
+        """
+        self._prepare()
+
+        cmd = ["gpg", *GPG_BATCH_ARGS, "--decrypt", str(encrypted_path)]
+        supervised = process.SupervisedProcess(
+            cmd, timeout=self.timeout, cancel=self.cancel, stdin=subprocess.DEVNULL
+        )
+
+        try:
+            with supervised as gpg:
+                yield gpg.stdout
+                while gpg.stdout.read(STREAM_CHUNK_SIZE):
+                    pass
+        except Exception:
+            # Reading the output of a gpg that was killed fails, in that case report why
+            # gpg was killed instead
+            if not (supervised.timed_out or supervised.cancelled):
+                raise
+
+        try:
+            supervised.check()
+        except process.ProcessError as error:
+            raise to_gpg_error(error)
+
+        logger.debug(f"Decrypted {encrypted_path}")
+
+
+class EncryptionBackend(ABC):
+    """
+    Tool used to encrypt backups, and to decrypt them as a stream.
+    """
+
+    @abstractmethod
+    def encrypt(self, path_to_encrypt: Path, encrypted_path: Path) -> None:
+        ...
+
+    @abstractmethod
+    def decrypt_stream(self, encrypted_path: Path) -> ContextManager[IO[bytes]]:
+        ...
+
+    @abstractmethod
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        ...
+
+    @abstractmethod
+    def decrypt_bytes(self, data: bytes) -> bytes:
+        ...
+
+    def encrypt_files(self, paths: list[Path]) -> list[bytes]:
+        """
+        Encrypt each file in `paths` on its own, and return the encrypted contents in
+        the same order.
+        """
+        return [self.encrypt_bytes(path.read_bytes()) for path in paths]
+
+    def decrypt_many(self, encrypted: list[bytes]) -> list[bytes]:
+        """
+        Decrypt each item in `encrypted` on its own, and return them in the same order.
+        """
+        return [self.decrypt_bytes(data) for data in encrypted]
+
+
+class GPGBackend(EncryptionBackend):
+    """
+    Shell out to the `gpg` binary. Every operation goes through the same `GPGSession`.
+    """
+
+    def __init__(self, recipient: Email | None, fingerprint: str | None = None) -> None:
+        self.recipient = recipient
+        self.fingerprint = fingerprint
+        self.session = GPGSession()
+
+        if fingerprint:
+            # Encrypting to a missing key fails anyway, with gpg's own error
+            self.session.add_known_key(fingerprint)
+
+    def _get_recipient(self) -> str:
+        if not self.recipient:
+            raise EncryptionError("Config must specify a recipient to run encryption")
+        return self.fingerprint or self.recipient
+
+    def encrypt(self, path_to_encrypt: Path, encrypted_path: Path) -> None:
+        self.session.encrypt(
+            path_to_encrypt=path_to_encrypt,
+            encrypted_path=encrypted_path,
+            recipient=self._get_recipient(),
+        )
+
+    def decrypt_stream(self, encrypted_path: Path) -> ContextManager[IO[bytes]]:
+        return self.session.decrypt_stream(encrypted_path=encrypted_path)
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        return self.session.encrypt_bytes(data, recipient=self._get_recipient())
+
+    def decrypt_bytes(self, data: bytes) -> bytes:
+        return self.session.decrypt_bytes(data)
+
+    def encrypt_files(self, paths: list[Path]) -> list[bytes]:
+        # One gpg process for all files, instead of one per file
+        results = self.session.encrypt_files(paths, recipient=self._get_recipient())
+        return [
+            read_gpg_output(
+                result, output=result.path.with_name(result.path.name + ".gpg")
+            )
+            for result in results
+        ]
+
+    def decrypt_many(self, encrypted: list[bytes]) -> list[bytes]:
+        # One gpg process for all items, instead of one per item
+        return self.session.decrypt_many(encrypted)
+
+
+def write_pipe(path: Path, data: bytes) -> None:
+    try:
+        with open(path, "wb") as pipe:
+            pipe.write(data)
+    except BrokenPipeError:
+        # gpg stopped reading, e.g. the data is not encrypted
+        pass
+
+
+def read_pipe(path: Path, contents: dict[Path, bytes]) -> None:
+    with open(path, "rb") as pipe:
+        contents[path] = pipe.read()
+
+
+def release_pipe(path: Path, thread: threading.Thread, flags: int) -> None:
+    """
+    Briefly open the named pipe at `path` until `thread` returns, in case the thread
+    still waits for gpg to open the other end, e.g. the output of a file that gpg
+    failed to decrypt. Opening for writing fails until the thread opens for reading.
+    """
+    while thread.is_alive():
+        try:
+            os.close(os.open(path, flags | os.O_NONBLOCK))
+        except OSError:
+            pass
+        thread.join(PIPE_RELEASE_INTERVAL)
+
+
+def read_gpg_output(result: GPGFileResult, output: Path) -> bytes:
+    """
+    Read and remove the `output` file that gpg wrote for `result`, see
+    `GPGSession.encrypt_files`.
+    """
+    if not result.ok:
+        raise GPGError(f"gpg failed to process {result.path.name}")
+
+    data = output.read_bytes()
+    output.unlink()
+    return data
+
+
+# Backends already created, by (backend, recipient, fingerprint, identity), see
+# `reuse_backends`
+_BackendKey = tuple[str, str | None, str | None, Path | None]
+_backends: dict[_BackendKey, EncryptionBackend] | None = None
+
+
+@contextmanager
+def reuse_backends() -> Iterator[None]:
+    """
+    Reuse the same backend for every backup inside the block, which keeps its state
+    warm, e.g. the gpg session or the loaded x25519 identity. See
+    `direnv_backup.daemon`.
+    """
+    global _backends
+    _backends = {}
+    try:
+        yield
+    finally:
+        _backends = None
+
+
+def forget_backends() -> None:
+    """
+    Drop the reused backends, e.g. after an error that a new gpg key may fix.
+    """
+    if _backends is not None:
+        _backends.clear()
+
+
+def get_encryption_backend(config: Config) -> EncryptionBackend:
+    if _backends is None:
+        return _create_encryption_backend(config=config)
+
+    key = (
+        config.encryption_backend,
+        config.encryption_recipient,
+        config.encryption_fingerprint,
+        config.encryption_identity,
+    )
+    if key not in _backends:
+        _backends[key] = _create_encryption_backend(config=config)
+
+    return _backends[key]
 
-    cmd = [
-        "gpg",
-        "--output",
-        str(decrypted_path),
-        "--decrypt",
-        str(encrypted_path),
-    ]
-    proc = subprocess.run(cmd, capture_output=True)
-    stdout = proc.stdout.decode("utf-8")
-    stderr = proc.stderr.decode("utf-8")
 
-    something_went_wrong = proc.returncode != 0
+def _create_encryption_backend(config: Config) -> EncryptionBackend:
+    if config.encryption_backend == "x25519":
+        try:
+            from direnv_backup.x25519 import X25519Backend
+        except ImportError:
+            raise EncryptionError(
+                "The 'x25519' encryption backend requires the 'cryptography' package"
+            )
 
-    if something_went_wrong:
-        # TODO: handle this with the corresponding exceptions - if key missing, etc.
-        print(f"{stdout=}")
-        print(f"{stderr=}")
-        raise GPGError(stderr)
+        return X25519Backend(
+            recipient=config.encryption_recipient,
+            identity=config.encryption_identity,
+        )
 
-    logger.debug(f"Encryption output: {decrypted_path}")
-    return decrypted_path
+    return GPGBackend(
+        recipient=config.encryption_recipient,
+        fingerprint=config.encryption_fingerprint,
+    )
@@ -0,0 +1,108 @@
+"""
+On-disk cache of the sha256 of files, so a file is only read again when it changed.
+
+Entries are keyed by (device, inode, size, mtime_ns) of the file: an editor that saves
+by replacing the file changes the inode, and one that writes in place changes the size
+or the modification time. The cache is an SQLite database, and each lookup is a single
+primary key search.
+
+A file modified twice within the resolution of its file system's clock could keep the
+same key with a different content. Like git's "racily clean" check, files modified less
+than `RACY_WINDOW_NS` before they are hashed are not cached.
+"""
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from direnv_backup.io import hash_file
+
+logger = logging.getLogger(__name__)
+
+HASH_CACHE_NAME = ".hash-cache.sqlite"
+
+RACY_WINDOW_NS = 2_000_000_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS hashes_path ON hashes (path);
+"""
+
+
+class HashCache:
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
+        self.hits = 0
+        self.misses = 0
+
+    def hash_file(self, path: Path, stat: os.stat_result | None = None) -> str:
+        """
+        Return the sha256 of `path`, only reading it if its `stat` (read now if not
+        given) is not in the cache.
+        """
+        stat = stat or path.stat()
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        row = self.connection.execute(
+            "SELECT sha256 FROM hashes"
+            " WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+            key,
+        ).fetchone()
+        if row:
+            self.hits += 1
+            return row[0]
+
+        self.misses += 1
+        digest = hash_file(path)
+
+        if time.time_ns() - stat.st_mtime_ns >= RACY_WINDOW_NS:
+            # An entry per path: the previous version of the file is gone
+            self.connection.execute("DELETE FROM hashes WHERE path = ?", (str(path),))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, str(path), digest),
+            )
+
+        return digest
+
+    def evict_missing(self) -> int:
+        """
+        Drop the entries of the files that do not exist anymore, and return how many.
+        """
+        paths = [row[0] for row in self.connection.execute("SELECT path FROM hashes")]
+        missing = [(path,) for path in paths if not os.path.exists(path)]
+        self.connection.executemany("DELETE FROM hashes WHERE path = ?", missing)
+        return len(missing)
+
+
+@contextmanager
+def open_hash_cache(path: Path) -> Iterator[HashCache]:
+    """
+    Open (or create) the cache at `path`. Changes are saved, and the entries of missing
+    files evicted, when the block exits without errors.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path)
+    try:
+        connection.executescript(SCHEMA)
+        cache = HashCache(connection=connection)
+        yield cache
+
+        evicted = cache.evict_missing()
+        connection.commit()
+        logger.debug(
+            f"Hash cache: {cache.hits} hits, {cache.misses} misses, {evicted} evicted"
+        )
+    finally:
+        connection.close()
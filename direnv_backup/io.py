@@ -1,7 +1,12 @@
+import hashlib
 import json
+import os
 import shutil
+import tempfile
 from pathlib import Path
 
+HASH_CHUNK_SIZE = 64 * 1024
+
 
 def read_json(path: Path, data: dict) -> dict:
     with path.open("r") as f:
@@ -17,3 +22,41 @@ def write_json(path: Path, data: dict) -> None:
 def copy_file(*, src: Path, dst: Path) -> None:
     dst.parent.mkdir(parents=True, exist_ok=True)
     shutil.copy(src=src, dst=dst)
+
+
+def atomic_write_bytes(*, path: Path, content: bytes, mode: int) -> None:
+    """
+    Write `content` into a temporary file next to `path` and then rename it over `path`,
+    so that readers (and concurrent writers) never see a partially written file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def file_has_content(path: Path, content: bytes) -> bool:
+    """
+    Compare sizes first, which only needs a `stat` call, and only hash the file if it
+    has the same size as `content`.
+    """
+    if path.stat().st_size != len(content):
+        return False
+
+    return hash_file(path) == hashlib.sha256(content).hexdigest()
@@ -1,12 +1,101 @@
+"""
+Logging set up of the commands.
+
+Records are put on an in-memory queue, and written to stderr by a background thread,
+so a slow stderr (a terminal, or journald when it is backed up) never blocks a backup.
+
+With the "json" format each record is written as a JSON object on a line of its own,
+with the `FIELDS` that the caller passed as `extra`, e.g.
+
+    logger.info("Backup finished", extra={"stage": "backup", "duration": 1.2})
+
+    {"time": "2022-07-27T18:16:51.123", "level": "INFO", "logger": "...",
+     "message": "Backup finished", "stage": "backup", "duration": 1.2}
+"""
+import atexit
+import copy
+import datetime
+import json
 import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes that callers can set on a record through `extra`, written by the "json"
+# format
+FIELDS = ("stage", "path", "bytes", "duration", "error")
+
+# Format of the logs of this process, see `set_up_logging_config`
+_log_format = "text"
+
+
+def is_json_logging() -> bool:
+    return _log_format == "json"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        created = datetime.datetime.fromtimestamp(record.created)
+        event = {
+            "time": created.isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
 
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                event[field] = value
 
-def set_up_logging_config(debug_mode_on: bool) -> None:
-    if debug_mode_on:
-        format = "%(levelname)s:%(asctime)s:%(module)s:%(lineno)d:%(message)s"
-        log_level = logging.DEBUG
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            event["traceback"] = record.exc_text
+
+        return json.dumps(event, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike `QueueHandler.prepare`, leave the formatting to the listener, and only
+        # resolve what may change before the listener gets to the record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def set_up_logging_config(debug_mode_on: bool, log_format: str = "text") -> None:
+    global _log_format
+
+    root = logging.getLogger()
+    if root.handlers:
+        # Already set up, like `logging.basicConfig` does
+        return
+
+    _log_format = log_format
+
+    if log_format == "json":
+        formatter: logging.Formatter = JsonFormatter()
+    elif debug_mode_on:
+        formatter = logging.Formatter(
+            "%(levelname)s:%(asctime)s:%(module)s:%(lineno)d:%(message)s"
+        )
     else:
-        format = "%(message)s"
-        log_level = logging.INFO
+        formatter = logging.Formatter("%(message)s")
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(records, stream_handler)
+    listener.start()
+    # Writes the records still in the queue before exiting
+    atexit.register(listener.stop)
 
-    logging.basicConfig(level=log_level, format=format)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(logging.DEBUG if debug_mode_on else logging.INFO)
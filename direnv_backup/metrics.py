@@ -0,0 +1,91 @@
+"""
+Measurements of the current run (bytes uploaded, seconds spent...), logged at the end
+of each backup run.
+
+Every value is a float added to under a dotted name, e.g. "s3.bytes_uploaded", so any
+stage can record its own measurements without the others knowing about them.
+
+While tracing, each `Metrics.measure` block is also recorded as a `Span`, see
+`direnv_backup.profiling`.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+MIB = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class Span:
+    name: str
+    start: float  # `time.monotonic` value
+    duration: float
+    thread: int
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self._values: dict[str, float] = {}
+        self._spans: list[Span] | None = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, value: float) -> None:
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._values.get(name, 0)
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[None]:
+        """
+        Add the seconds spent inside the block to `name`.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            self.add(name, duration)
+            if self._spans is not None:
+                span = Span(name, start, duration, threading.get_ident())
+                with self._lock:
+                    self._spans.append(span)
+
+    def start_tracing(self) -> None:
+        with self._lock:
+            self._spans = []
+
+    def stop_tracing(self) -> list[Span]:
+        with self._lock:
+            spans, self._spans = self._spans or [], None
+        return spans
+
+    def as_dict(self) -> dict[str, float]:
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def __str__(self) -> str:
+        return ", ".join(f"{name}={value:g}" for name, value in self.as_dict().items())
+
+
+def throughput(bytes: float, seconds: float) -> float:
+    """
+    MiB per second.
+    """
+    return bytes / MIB / seconds if seconds > 0 else 0
+
+
+# Measurements of the current run
+metrics = Metrics()
@@ -0,0 +1,248 @@
+"""
+Run external commands (gpg, gpgconf, ionice...) under supervision: every command has a
+timeout, can be cancelled from another thread, and its stderr is logged line by line as
+it is written. A command that times out or is cancelled is killed, together with any
+process it spawned, so a hung command never blocks the backup for longer than its
+timeout.
+"""
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from types import TracebackType
+from typing import IO
+
+logger = logging.getLogger(__name__)
+
+# Seconds that a process has to exit after SIGTERM before it is sent SIGKILL
+TERMINATE_GRACE_PERIOD = 2
+
+
+class ProcessError(Exception):
+    def __init__(self, cmd: list[str], returncode: int | None, stderr: str) -> None:
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        super().__init__(self.describe())
+
+    @property
+    def command_name(self) -> str:
+        return " ".join(self.cmd[:2])
+
+    def describe(self) -> str:
+        return f"{self.command_name!r} failed with exit status {self.returncode}"
+
+
+class ProcessTimeout(ProcessError):
+    def __init__(self, cmd: list[str], stderr: str, timeout: float) -> None:
+        self.timeout = timeout
+        super().__init__(cmd=cmd, returncode=None, stderr=stderr)
+
+    def describe(self) -> str:
+        return f"{self.command_name!r} timed out after {self.timeout:g}s and was killed"
+
+
+class ProcessCancelled(ProcessError):
+    def __init__(self, cmd: list[str], stderr: str) -> None:
+        super().__init__(cmd=cmd, returncode=None, stderr=stderr)
+
+    def describe(self) -> str:
+        return f"{self.command_name!r} was cancelled"
+
+
+@dataclass(frozen=True)
+class CompletedProcess:
+    cmd: list[str]
+    returncode: int
+    stdout: bytes
+    stderr: str
+    duration: float
+
+
+class SupervisedProcess:
+    """
+    Start `cmd` in its own process group, with a watchdog that kills the whole group if
+    the command runs for longer than `timeout` seconds or if `cancel` is set.
+
+    Use as a context manager to read `stdout` as a stream:
+
+        with SupervisedProcess(cmd, timeout=60) as process:
+            for chunk in process.stdout:
+                ...
+        process.check()
+    """
+
+    def __init__(
+        self,
+        cmd: list[str],
+        *,
+        timeout: float,
+        cancel: threading.Event | None = None,
+        stdin: int | None = None,
+    ) -> None:
+        self.cmd = cmd
+        self.timeout = timeout
+        self.cancel = cancel or threading.Event()
+        self.stdin = stdin
+
+        self.timed_out = False
+        self.cancelled = False
+        self._stderr_lines: list[str] = []
+        self._finished = threading.Event()
+
+    def __enter__(self) -> "SupervisedProcess":
+        logger.debug(f'Executing {" ".join(self.cmd)!r} (timeout: {self.timeout}s)')
+        self.start = time.monotonic()
+        self.proc = subprocess.Popen(
+            self.cmd,
+            stdin=self.stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+
+        self._stderr_reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_reader.start()
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        if exc_type is not None and self.proc.poll() is None:
+            self.kill()
+
+        if self.proc.stdin:
+            self.proc.stdin.close()
+        assert self.proc.stdout
+        self.proc.stdout.close()
+        self.proc.wait()
+
+        self._finished.set()
+        self._stderr_reader.join()
+        self._watchdog.join()
+
+        self.duration = time.monotonic() - self.start
+        logger.debug(
+            f"{self.cmd[0]!r} exited with status {self.proc.returncode}"
+            f" after {self.duration:.3f}s"
+        )
+
+    @property
+    def stdout(self) -> IO[bytes]:
+        assert self.proc.stdout
+        return self.proc.stdout
+
+    @property
+    def stderr(self) -> str:
+        return "".join(self._stderr_lines)
+
+    @property
+    def returncode(self) -> int | None:
+        return self.proc.returncode
+
+    def _read_stderr(self) -> None:
+        assert self.proc.stderr
+        with self.proc.stderr:
+            for raw_line in self.proc.stderr:
+                line = raw_line.decode("utf-8", errors="replace")
+                self._stderr_lines.append(line)
+                logger.debug(f"{self.cmd[0]}: {line.rstrip()}")
+
+    def _watch(self) -> None:
+        deadline = self.start + self.timeout
+        while not self._finished.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.timed_out = True
+                self.kill()
+                return
+
+            if self.cancel.wait(timeout=min(remaining, 0.1)):
+                self.cancelled = True
+                self.kill()
+                return
+
+    def kill(self) -> None:
+        """
+        Terminate the process group, and kill it if it does not exit in time.
+        """
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+            try:
+                self.proc.wait(timeout=TERMINATE_GRACE_PERIOD)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # already gone
+
+    def check(self) -> None:
+        """
+        Raise a `ProcessError` if the command did not finish successfully.
+        """
+        if self.timed_out:
+            raise ProcessTimeout(cmd=self.cmd, stderr=self.stderr, timeout=self.timeout)
+
+        if self.cancelled:
+            raise ProcessCancelled(cmd=self.cmd, stderr=self.stderr)
+
+        if self.returncode != 0:
+            raise ProcessError(
+                cmd=self.cmd, returncode=self.returncode, stderr=self.stderr
+            )
+
+
+def run(
+    cmd: list[str],
+    *,
+    timeout: float,
+    input: bytes | None = None,
+    cancel: threading.Event | None = None,
+    check: bool = True,
+) -> CompletedProcess:
+    """
+    Run `cmd` to completion and return its output. See `SupervisedProcess`.
+    """
+    stdin = subprocess.PIPE if input is not None else subprocess.DEVNULL
+
+    with SupervisedProcess(cmd, timeout=timeout, cancel=cancel, stdin=stdin) as process:
+        if input is not None:
+            assert process.proc.stdin
+            # Feed stdin from another thread, so that a command that fills its stdout
+            # before reading all its input does not deadlock
+            writer = threading.Thread(
+                target=_write_and_close, args=(process.proc.stdin, input), daemon=True
+            )
+            writer.start()
+
+        stdout = process.stdout.read()
+
+        if input is not None:
+            writer.join()
+
+    if check:
+        process.check()
+
+    return CompletedProcess(
+        cmd=cmd,
+        returncode=process.returncode,  # type: ignore
+        stdout=stdout,
+        stderr=process.stderr,
+        duration=process.duration,
+    )
+
+
+def _write_and_close(stream: IO[bytes], data: bytes) -> None:
+    try:
+        with stream:
+            stream.write(data)
+    except (OSError, ValueError):
+        pass  # the command exited, or was killed, without reading all its input
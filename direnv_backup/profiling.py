@@ -0,0 +1,128 @@
+"""
+Profiles of a command run, to attach to reports of slow backups or restores, see the
+`--profile` argument of the commands.
+
+The profile is written next to the config file, e.g.
+`config.backup-20220727-181651.pstats`:
+
+  - "cpu": cProfile statistics, read them with `python -m pstats <file>`
+  - "alloc": the peak of the memory allocated by Python, and the lines that allocated
+    the most memory still allocated when the command ended, from tracemalloc
+  - "trace": the stages of the run (the `Metrics.measure` blocks: scan, copy,
+    archive...) in the Chrome trace event format, open it in https://ui.perfetto.dev
+    or chrome://tracing
+"""
+import datetime
+import json
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from direnv_backup.metrics import Span, metrics
+
+logger = logging.getLogger(__name__)
+
+# profile -> extension of its file
+PROFILES = {
+    "cpu": ".pstats",
+    "alloc": ".alloc.txt",
+    "trace": ".trace.json",
+}
+
+# Lines listed in "alloc" profiles
+TOP_ALLOCATIONS = 25
+
+
+def profile_path(config_path: Path, command: str, profile: str) -> Path:
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    name = f"{config_path.stem}.{command}-{timestamp}{PROFILES[profile]}"
+    return config_path.with_name(name)
+
+
+def trace_events(spans: list[Span]) -> dict:
+    """
+    Chrome trace event format, with "complete" events in microseconds since the first
+    span started.
+    """
+    origin = min((span.start for span in spans), default=0)
+    pid = os.getpid()
+    return {
+        "displayTimeUnit": "ms",
+        "traceEvents": [
+            {
+                "name": span.name.removesuffix(".seconds"),
+                "cat": "stage",
+                "ph": "X",
+                "ts": round((span.start - origin) * 1_000_000),
+                "dur": round(span.duration * 1_000_000),
+                "pid": pid,
+                "tid": span.thread,
+            }
+            for span in spans
+        ],
+    }
+
+
+@contextmanager
+def _cpu_profile(path: Path) -> Iterator[None]:
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+@contextmanager
+def _alloc_profile(path: Path) -> Iterator[None]:
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        statistics = snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        ).statistics("lineno")
+        lines = [
+            f"Peak: {peak / 1024:.1f} KiB",
+            "",
+            f"Top {TOP_ALLOCATIONS} lines by memory still allocated at the end:",
+            *(str(statistic) for statistic in statistics[:TOP_ALLOCATIONS]),
+        ]
+        path.write_text("\n".join(lines) + "\n")
+
+
+@contextmanager
+def _trace_profile(path: Path) -> Iterator[None]:
+    metrics.start_tracing()
+    try:
+        yield
+    finally:
+        spans = metrics.stop_tracing()
+        path.write_text(json.dumps(trace_events(spans)))
+
+
+@contextmanager
+def profiled(profile: str, path: Path) -> Iterator[None]:
+    """
+    Write the `profile` of the block to `path`, see module docstring.
+    """
+    profilers = {
+        "cpu": _cpu_profile,
+        "alloc": _alloc_profile,
+        "trace": _trace_profile,
+    }
+    with profilers[profile](path):
+        yield
+
+    logger.info(f"Profile written to {path}")
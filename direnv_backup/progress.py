@@ -0,0 +1,123 @@
+"""
+Progress of the loops over every file (copying, restoring...), reported at most once
+per interval instead of once per file.
+
+On an interactive terminal it is a single line redrawn in place, with the throughput and
+the estimated time left. Otherwise (systemd, cron, a pipe, or JSON logs that must not be
+mixed with anything else) a summary line is logged every `LOG_INTERVAL` seconds, and
+once when the loop ends.
+
+Per-file details are only logged at debug level, by the callers.
+"""
+import logging
+import sys
+import time
+from typing import IO
+
+from direnv_backup.logging import is_json_logging
+from direnv_backup.metrics import MIB, throughput
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two redraws of the progress bar
+REDRAW_INTERVAL = 0.2
+
+# Seconds between two log lines when not interactive
+LOG_INTERVAL = 30
+
+BAR_WIDTH = 24
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+
+class Progress:
+    """
+    Call `advance` after each item, and `close` after the last one (or use it as a
+    context manager). `advance` only compares the time to the next report, so it is
+    cheap enough to call for every file.
+    """
+
+    def __init__(
+        self,
+        stage: str,
+        total: int,
+        unit: str = "files",
+        stream: IO[str] | None = None,
+    ) -> None:
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.stream = stream or sys.stderr
+        self.interactive = self.stream.isatty() and not is_json_logging()
+        self.interval = REDRAW_INTERVAL if self.interactive else LOG_INTERVAL
+
+        self.done = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self._next_report = self.start + self.interval
+
+    def advance(self, items: int = 1, bytes: int = 0) -> None:
+        self.done += items
+        self.bytes += bytes
+
+        now = time.monotonic()
+        if now >= self._next_report:
+            self._next_report = now + self.interval
+            self._report(now)
+
+    def describe(self, now: float) -> str:
+        elapsed = now - self.start
+        parts = [f"{self.done}/{self.total} {self.unit}"]
+        if self.bytes:
+            rate = throughput(self.bytes, elapsed)
+            parts.append(f"{self.bytes / MIB:.1f} MiB, {rate:.1f} MiB/s")
+
+        if 0 < self.done < self.total:
+            eta = elapsed / self.done * (self.total - self.done)
+            parts.append(f"ETA {format_duration(eta)}")
+
+        return ", ".join(parts)
+
+    def _fields(self, now: float) -> dict:
+        """
+        For structured logs, see `direnv_backup.logging`.
+        """
+        return {
+            "stage": self.stage,
+            "bytes": self.bytes,
+            "duration": round(now - self.start, 3),
+        }
+
+    def _report(self, now: float) -> None:
+        if not self.interactive:
+            logger.info(f"{self.stage}: {self.describe(now)}", extra=self._fields(now))
+            return
+
+        filled = BAR_WIDTH * self.done // self.total if self.total else BAR_WIDTH
+        bar = "#" * filled + "-" * (BAR_WIDTH - filled)
+        # Padded, so a shorter line fully covers the previous one
+        line = f"{self.stage} [{bar}] {self.describe(now)}"
+        self.stream.write(f"\r{line:<79}")
+        self.stream.flush()
+
+    def close(self) -> None:
+        now = time.monotonic()
+        if self.interactive:
+            self._report(now)
+            self.stream.write("\n")
+            self.stream.flush()
+
+        elapsed = format_duration(now - self.start)
+        logger.info(
+            f"{self.stage}: {self.describe(now)} in {elapsed}", extra=self._fields(now)
+        )
+
+    def __enter__(self) -> "Progress":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
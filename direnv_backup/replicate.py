@@ -0,0 +1,126 @@
+"""
+Copy each backup to every destination in `Config.destinations`.
+
+A backup is scanned, archived and encrypted once, into `Config.backup_dir`, and then
+copied to all destinations at the same time, each one from its own thread. While the
+destinations are written the backup is still in the page cache, so it is read from disk
+at most once. Each destination is independent: a slow destination does not slow down
+the others, and a failing one (e.g. an unmounted drive) does not stop the others.
+"""
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from direnv_backup.config import Config, Destination
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class ReplicationError(Exception):
+    ...
+
+
+@dataclass(frozen=True)
+class ReplicationResult:
+    destination: Destination
+    duration: float
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def copy_to_destination(backup_path: Path, destination: Destination) -> None:
+    """
+    Copy `backup_path` into `destination`, atomically, so that an interrupted copy never
+    leaves a partial backup behind.
+
+    The destination folder must exist: a missing folder usually means that the drive
+    it belongs to is not mounted, and creating it would fill the mount point instead.
+    """
+    if not destination.path.is_dir():
+        raise ReplicationError(f"{destination.path} does not exist or is not mounted")
+
+    fd, tmp_name = tempfile.mkstemp(
+        dir=destination.path, prefix=f".{backup_path.name}."
+    )
+    tmp_path = Path(tmp_name)
+    try:
+        with backup_path.open("rb") as src, os.fdopen(fd, "wb") as dst:
+            while chunk := src.read(COPY_CHUNK_SIZE):
+                dst.write(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, destination.path / backup_path.name)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _replicate_to(backup_path: Path, destination: Destination) -> ReplicationResult:
+    start = time.monotonic()
+    try:
+        copy_to_destination(backup_path=backup_path, destination=destination)
+    except (OSError, ReplicationError) as error:
+        logger.error(
+            f"Failed to copy {backup_path.name} to {destination.path}: {error}"
+        )
+        return ReplicationResult(
+            destination=destination,
+            duration=time.monotonic() - start,
+            error=str(error),
+        )
+
+    duration = time.monotonic() - start
+    logger.debug(f"Copied {backup_path.name} to {destination.path} in {duration:.3f}s")
+    return ReplicationResult(destination=destination, duration=duration)
+
+
+def missing_destinations(
+    backup_path: Path, destinations: tuple[Destination, ...]
+) -> tuple[Destination, ...]:
+    """
+    Return the destinations that do not have a copy of `backup_path` yet.
+    """
+    return tuple(
+        destination
+        for destination in destinations
+        if not (destination.path / backup_path.name).exists()
+    )
+
+
+def replicate_backup(
+    backup_path: Path, destinations: tuple[Destination, ...]
+) -> list[ReplicationResult]:
+    """
+    Copy `backup_path` to every destination concurrently, and return the result of each
+    copy in the same order as `destinations`.
+    """
+    if not destinations:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(destinations)) as executor:
+        futures = [
+            executor.submit(_replicate_to, backup_path, destination)
+            for destination in destinations
+        ]
+        return [future.result() for future in futures]
+
+
+def upload_to_s3(config: Config) -> None:
+    """
+    Upload the backups that are not in `Config.s3` yet, see `direnv_backup.s3`.
+    """
+    try:
+        from direnv_backup.s3 import upload_backups
+    except ImportError:
+        raise ReplicationError("Uploading to S3 requires the 'boto3' package")
+
+    upload_backups(config=config)
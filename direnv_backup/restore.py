@@ -1,65 +1,182 @@
+import bisect
+import datetime
 import logging
-import shutil
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
+from typing import Iterator
 
-from direnv_backup.archive import extract
+from direnv_backup.archive import MANIFEST_NAME, ArchiveMember, iter_members
 from direnv_backup.config import Config
-from direnv_backup.encrypt import decrypt
-from direnv_backup.io import copy_file
+from direnv_backup.dedup import DedupStore
+from direnv_backup.encrypt import EncryptionError, get_encryption_backend
+from direnv_backup.io import atomic_write_bytes, file_has_content
+from direnv_backup.metrics import metrics
+from direnv_backup.seekable import (
+    SeekableArchive,
+    SeekableArchiveError,
+    is_seekable_archive,
+)
+from direnv_backup.store import PackStore
 
 logger = logging.getLogger(__name__)
 
+BACKUP_NAME_FORMAT = "%Y%m%d-%H%M%S"
 
-# TODO: add support for dry run printing to console
-def restore_file(backup: Path, config: Config) -> None:
+
+class RestoreError(Exception):
+    ...
+
+
+# Errors that mean a backup cannot be listed or restored
+RESTORE_ERRORS = (EncryptionError, RestoreError, SeekableArchiveError)
+
+
+class RestoreAction(Enum):
+    unchanged = "unchanged"
+    updated = "updated"
+    created = "created"
+
+
+@dataclass
+class RestoreSummary:
+    unchanged: int = 0
+    updated: int = 0
+    created: int = 0
+
+    def add(self, action: RestoreAction) -> None:
+        setattr(self, action.value, getattr(self, action.value) + 1)
+
+    def __str__(self) -> str:
+        return (
+            f"{self.unchanged} unchanged, {self.updated} updated,"
+            f" {self.created} created"
+        )
+
+
+def get_restore_path(member_name: str, config: Config) -> Path:
     # Taxonomy of a backup file path:
     #
-    #   my_backup_dir/.tmp/projects/foo/.envrc   <-- a backup file once extracted
-    #   ------▲------ --▲- ---▲---- ----▲-----
-    #         │         │     │         └─ relative path
-    #         │         │     │
-    #         │         │     └─ top parent
-    #         │         │
-    #         │         └─ where backup is extracted temporarily before restoration
-    #         │
-    #         └─ backups folder - specified in config.backup_dir
+    #   projects/foo/.envrc   <-- the name of a file inside the backup archive
+    #   ---▲---- ----▲-----
+    #      │         └─ relative path
+    #      │
+    #      └─ top parent
     #
     #
     #    variable name          variable value
     #  -------------------------------------------------------------------
-    #    backup:                my_backup_dir/.tmp/projects/foo/.envrc
-    #    config.tmp_dir:        my_backup_dir/.tmp
-    #    relative_to_tmp_dir:                     projects/foo/.envrc
-    #    top_parent:                              projects
-    #    relative_path:                                    foo/.envrc
+    #    member_name:           projects/foo/.envrc
+    #    top_parent:            projects
+    #    relative_path:                  foo/.envrc
     #
-    relative_to_tmp_dir = backup.relative_to(config.tmp_dir)
-    top_parent = relative_to_tmp_dir.parts[0]
+    # A crafted or corrupt backup must not write outside of `root_dir`: absolute names
+    # and `..` parts are rejected. Symlinks inside `root_dir` are only followed out of
+    # it when the backups follow them too, see `Config.follow_symlinks`.
+    relative_to_archive = Path(member_name)
+    parts = relative_to_archive.parts
+    if relative_to_archive.is_absolute() or ".." in parts or len(parts) < 2:
+        raise RestoreError(f"{member_name} is outside of {config.root_dir}")
 
     # Assumption: the top parent directory name of the backup file must match the name
     # of the `root_dir` specified in the config
-    assert top_parent == config.root_dir.name
+    top_parent = parts[0]
+    if top_parent != config.root_dir.name:
+        raise RestoreError(f"{member_name} is not in {config.root_dir.name}")
 
     # Stripe anything path parts above the top parent, including the top parent itself
-    relative_path = relative_to_tmp_dir.relative_to(top_parent)
+    relative_path = relative_to_archive.relative_to(top_parent)
     final_path = config.root_dir / relative_path
-    logger.debug(f"Restoring {backup} to {final_path}")
-    copy_file(src=backup, dst=final_path)
+    if not config.follow_symlinks and not final_path.resolve().is_relative_to(
+        config.root_dir.resolve()
+    ):
+        raise RestoreError(f"{member_name} is outside of {config.root_dir}")
 
+    return final_path
 
-def find_all_backups(dir: Path, encrypted: bool) -> list[Path]:
-    if encrypted:
-        extension = ".gpg"
+
+def restore_file(
+    member: ArchiveMember, config: Config, dry_run: bool = False
+) -> RestoreAction:
+    # A symlinked direnv file is written through, the link stays in place
+    final_path = get_restore_path(member_name=member.name, config=config).resolve()
+
+    # Do not touch files that are already identical to the backup, otherwise their
+    # mtime changes and direnv asks to approve them again
+    if not final_path.exists():
+        action = RestoreAction.created
+    elif file_has_content(final_path, member.content):
+        logger.debug("Skipping %s, it is identical to the backup", final_path)
+        return RestoreAction.unchanged
     else:
-        extension = ".tar"
+        action = RestoreAction.updated
+
+    if dry_run:
+        logger.info(f"{final_path} would be {action.value}")
+        return action
+
+    logger.debug(
+        "Restoring %s to %s",
+        member.name,
+        final_path,
+        extra={
+            "stage": "restore",
+            "path": str(final_path),
+            "bytes": len(member.content),
+        },
+    )
+    atomic_write_bytes(path=final_path, content=member.content, mode=member.mode)
+
+    return action
+
 
+def find_all_backups(dir: Path, extension: str) -> list[Path]:
     backups = list(dir.glob(f"*{extension}"))
     return backups
 
 
-def find_latest_backup(dir: Path, encrypted: bool) -> Path:
-    backups = find_all_backups(dir=dir, encrypted=encrypted)
+def list_backups(config: Config) -> list[Path]:
+    """
+    Return every backup of `config`. With pack storage the backups are not files of
+    their own, see `open_backup`.
+    """
+    if config.storage in ("packs", "dedup"):
+        store = PackStore(dir=config.backup_dir)
+        return [
+            config.backup_dir / name
+            for name in store.names()
+            if name.endswith(config.backup_extension)
+        ]
+
+    return find_all_backups(dir=config.backup_dir, extension=config.backup_extension)
 
+
+@contextmanager
+def open_backup(config: Config, backup: Path) -> Iterator[Path]:
+    """
+    Yield a path where `backup` can be read from. Backups inside a pack are copied to a
+    temporary file first.
+    """
+    if config.storage != "packs" or backup.exists():
+        yield backup
+        return
+
+    with tempfile.TemporaryDirectory(prefix="direnv-backup-") as tmp_dir:
+        path = Path(tmp_dir) / backup.name
+        PackStore(dir=config.backup_dir).extract(name=backup.name, output=path)
+        yield path
+
+
+def find_latest_backup(dir: Path, extension: str) -> Path:
+    backups = find_all_backups(dir=dir, extension=extension)
+    return select_latest_backup(backups)
+
+
+def select_latest_backup(backups: list[Path]) -> Path:
     # backups include a timestamp at the begining of the file
     sorted_backups = sorted(backups)
     logger.info(f"{len(sorted_backups)} backups found")
@@ -70,58 +187,205 @@ def find_latest_backup(dir: Path, encrypted: bool) -> Path:
     return most_recent_backup
 
 
-def restore_backup(config: Config) -> None:
+def parse_timestamp(value: str) -> datetime.datetime:
+    """
+    Accept both ISO 8601 timestamps (`2022-07-27T18:16:51`, `2022-07-27`) and the
+    timestamp format used in the backup file names (`20220727-181651`).
+    """
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+
+    try:
+        return datetime.datetime.strptime(value, BACKUP_NAME_FORMAT)
+    except ValueError:
+        raise RestoreError(f"Invalid timestamp: {value!r}")
+
+
+def find_backup_at(dir: Path, extension: str, at: datetime.datetime) -> Path:
+    """
+    Find the most recent backup created at or before `at`.
+
+    Backup file names start with a fixed width timestamp, so sorting them by name sorts
+    them chronologically and the right backup can be found with a binary search.
+    """
+    backups = find_all_backups(dir=dir, extension=extension)
+    return select_backup_at(backups, at=at)
+
+
+def select_backup_at(backups: list[Path], at: datetime.datetime) -> Path:
+    backups = sorted(backups)
+    names = [backup.stem for backup in backups]
+
+    index = bisect.bisect_right(names, at.strftime(BACKUP_NAME_FORMAT))
+    if index == 0:
+        raise RestoreError(f"No backup found at or before {at.isoformat()}")
+
+    backup = backups[index - 1]
+    logger.info(f"Backup at {at.isoformat()}: {backup.absolute()}")
+
+    return backup
+
+
+def get_member_name(path: Path, config: Config) -> str:
+    """
+    Return the name that the `path` file has inside the backups. See `restore_file`.
+    """
+    absolute_path = path.absolute()
+    try:
+        relative_path = absolute_path.relative_to(config.root_dir.absolute())
+    except ValueError:
+        raise RestoreError(f"{path} is not inside {config.root_dir}")
+
+    return str(Path(config.root_dir.name) / relative_path)
+
+
+@contextmanager
+def read_backup(
+    backup_path: Path, config: Config, names: set[str] | None = None
+) -> Iterator[Iterator[ArchiveMember]]:
+    """
+    Yield the members of the backup in `names` (every member by default) as they are
+    read. Seekable archives and deduplicated snapshots only decrypt those members, tar
+    archives are decrypted as a stream until all of them are found.
+    """
+    backend = get_encryption_backend(config=config) if config.encrypt_backup else None
+
+    if config.storage == "dedup":
+        store = DedupStore(dir=config.backup_dir, backend=backend)
+        yield store.iter_members(snapshot_name=backup_path.name, names=names)
+        return
+
+    with open_backup(config=config, backup=backup_path) as path:
+        if is_seekable_archive(path):
+            with SeekableArchive(path=path, backend=backend) as archive:
+                yield archive.iter_members(names=names)
+            return
+
+        if backend:
+            archive_stream = backend.decrypt_stream(encrypted_path=path)
+        else:
+            archive_stream = path.open("rb")
+
+        with archive_stream as stream:
+            yield iter_members(fileobj=stream, names=names)
+
+
+def find_backup(config: Config, at: datetime.datetime | None = None) -> Path:
+    backups = list_backups(config=config)
+    if at:
+        return select_backup_at(backups, at=at)
+
+    return select_latest_backup(backups)
+
+
+def list_backup(config: Config, at: datetime.datetime | None = None) -> list[str]:
+    """
+    Return the name of every file in the backup that `restore_backup` would restore.
+    Seekable archives and deduplicated snapshots only need their index to be decrypted.
+    """
+    backup_path = find_backup(config=config, at=at)
+    backend = get_encryption_backend(config=config) if config.encrypt_backup else None
+
+    if config.storage == "dedup":
+        store = DedupStore(dir=config.backup_dir, backend=backend)
+        return sorted(store.read_snapshot(name=backup_path.name))
+
+    if is_seekable_archive(backup_path):
+        with open_backup(config=config, backup=backup_path) as path:
+            with SeekableArchive(path=path, backend=backend) as archive:
+                return archive.names
+
+    with read_backup(backup_path=backup_path, config=config) as members:
+        return sorted(member.name for member in members if member.name != MANIFEST_NAME)
+
+
+def restore_backup(
+    config: Config,
+    dry_run: bool = False,
+    jobs: int = 1,
+    at: datetime.datetime | None = None,
+    file: Path | None = None,
+) -> RestoreSummary:
     """
     The restore backup will restore the files taking the config.root_dir as the root
     directory to calculate where to put each file inside the backup.
 
+    By default the most recent backup is restored. If `at` is set, the most recent
+    backup created at or before `at` is restored instead. If `file` is set, only that
+    file is read from the backup and restored: with seekable archives only that file
+    is decrypted, so it takes the same time whatever the size of the backup.
+
     Restoration uses global config to:
       1. Find backup path
       3. Determine where to restore the files in the backup
 
-    GPG knows which private key to use to decrypt the file because its specified in the
-    encrypted file itself: https://security.stackexchange.com/a/183202
+    Files that are identical to their backup are left untouched. If `dry_run` is set,
+    the same comparison is done but no file is written.
+
+    Tar backups are decrypted and read as a stream, so the decrypted archive is never
+    written to disk. Up to `jobs` files are restored concurrently. Every file is written
+    atomically, and failures are reported once all files are processed, sorted by path.
+
+    When using the gpg encryption backend, GPG knows which private key to use to decrypt
+    the file because its specified in the encrypted file itself:
+    https://security.stackexchange.com/a/183202
     """
     # TODO assert keys exists for selected recipient, if not raise meaningful error
 
-    if config.encrypt_backup:
-        encrypted_path = find_latest_backup(dir=config.backup_dir, encrypted=True)
-        # encrypted_path = next(config.backup_dir.glob("*.gpg"))
-        archive_path = decrypt(encrypted_path=encrypted_path)
-        assert archive_path.suffixes == [".tar"]
-    else:
-        archive_path = find_latest_backup(dir=config.backup_dir, encrypted=False)
-        # archive_path = next(config.backup_dir.glob("*.tar"))
+    # Resolve the member name before decrypting anything, to fail early
+    member_name = get_member_name(path=file, config=config) if file else None
 
-    # To make clean-up easier, extract the backup into a temporary directory
-    #
-    #   backup_dir/
-    #       20220727_181651.gpg
-    #       20220727_181651.tar
-    #       .tmp/    <---- temporary dir to extract tar file
-    #           projects/.envrc
-    #           projects/foo/.envrc
-    #
-    tmp_dir = config.tmp_dir
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-    extract(path=archive_path, extract_to_dir=tmp_dir)
+    with metrics.measure("find.seconds"):
+        backup_path = find_backup(config=config, at=at)
 
-    file_paths = (path for path in tmp_dir.rglob("*") if path.is_file())
+    summary = RestoreSummary()
+    restored: list[tuple[str, Future[RestoreAction]]] = []
+    failures: list[tuple[str, str]] = []
+    names = {member_name} if member_name else None
 
-    try:
-        for backup in file_paths:
-            restore_file(backup=backup, config=config)
-    except Exception:
-        raise
-    finally:
-        logger.debug("Cleaning temporary files...")
-        shutil.rmtree(tmp_dir)
-
-        if config.encrypt_backup:
-            archive_path.unlink()
-        else:
-            # If the backup was not encrypted, the archive is the backup itself so do
-            # not delete it during the clean-up of you will loose your backup!
-            ...
+    # Bound the amount of members read into memory but not restored yet
+    in_flight = threading.BoundedSemaphore(jobs * 2)
+
+    # Members are restored while the archive is still being read, and never touch the
+    # disk other than at their final destination. Each member maps to a different
+    # destination, so no two workers ever write to the same path.
+    with metrics.measure("restore.seconds"), read_backup(
+        backup_path=backup_path, config=config, names=names
+    ) as members, ThreadPoolExecutor(max_workers=jobs) as executor:
+        for member in members:
+            if member.name == MANIFEST_NAME:
+                continue
+
+            in_flight.acquire()
+            future = executor.submit(
+                restore_file, member=member, config=config, dry_run=dry_run
+            )
+            future.add_done_callback(lambda _: in_flight.release())
+            restored.append((member.name, future))
+
+    for name, future in restored:
+        try:
+            summary.add(future.result())
+        except Exception as error:
+            logger.debug(f"Failed to restore {name}", exc_info=True)
+            failures.append((name, repr(error)))
+
+    if member_name and not restored:
+        raise RestoreError(f"{file} not found in backup {backup_path.name}")
+
+    if failures:
+        lines = [f"{name}: {error}" for name, error in sorted(failures)]
+        raise RestoreError(
+            f"Failed to restore {len(failures)} file(s):\n" + "\n".join(lines)
+        )
+
+    if dry_run:
+        logger.info(f"Dry run, no files were written: {summary}")
+    else:
+        logger.info(f"Restore summary: {summary}", extra={"stage": "restore"})
 
     logger.debug("Restore process finished")
+
+    return summary
@@ -0,0 +1,367 @@
+"""
+Upload the backups to an S3 compatible object store (AWS, MinIO, Ceph...), see
+`Config.s3`. Requires the `boto3` package.
+
+Every backup becomes an object named after it. With the "packs" and "dedup" storages
+each entry of the pack store (backup, blob, snapshot...) is an object of its own, so a
+dedup backup only uploads the files that changed, and the snapshot that lists them.
+Objects are never modified once uploaded: an object that is already in the bucket with
+the same size is skipped.
+
+Two files in `STATE_DIR_NAME`, inside the backup dir, keep each run cheap:
+
+    listing.json    objects known to be in the bucket, so the bucket is not listed on
+                    every run. It is refreshed after `LISTING_MAX_AGE` seconds.
+    uploads.json    multipart uploads in progress. An interrupted upload is resumed
+                    with the parts that the bucket does not have yet.
+
+Objects of the backups removed locally are kept in the bucket. With the "files" storage
+they can be expired with a lifecycle rule of the bucket. With the "packs" and "dedup"
+storages they cannot: a blob is uploaded once and stays referenced by every newer
+snapshot, so an age based rule deletes blobs that the latest backups still need, and
+`listing.json` hides the loss for up to `LISTING_MAX_AGE` seconds.
+"""
+import json
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
+
+from direnv_backup.config import Config, S3Target
+from direnv_backup.io import atomic_write_bytes
+from direnv_backup.metrics import metrics, throughput
+from direnv_backup.replicate import ReplicationError
+from direnv_backup.restore import list_backups
+from direnv_backup.store import PackStore
+
+logger = logging.getLogger(__name__)
+
+STATE_DIR_NAME = ".s3"
+LISTING_NAME = "listing.json"
+UPLOADS_NAME = "uploads.json"
+
+# Seconds after which the cached listing of the bucket is refreshed
+LISTING_MAX_AGE = 24 * 60 * 60
+
+
+@dataclass(frozen=True)
+class UploadItem:
+    """
+    `size` bytes at `offset` of `path` to upload as `key`. Backups in a pack store are
+    a range of their pack file.
+    """
+
+    key: str
+    path: Path
+    size: int
+    offset: int = 0
+
+    def read_part(self, start: int, length: int) -> bytes:
+        with self.path.open("rb") as f:
+            f.seek(self.offset + start)
+            return f.read(length)
+
+
+@dataclass(frozen=True)
+class UploadSummary:
+    uploaded: int  # objects uploaded
+    skipped: int  # objects already in the bucket
+    failed: int
+    bytes: int  # bytes sent, resumed uploads only count the missing parts
+    duration: float
+
+    def __str__(self) -> str:
+        speed = throughput(bytes=self.bytes, seconds=self.duration)
+        return (
+            f"{self.uploaded} objects uploaded, {self.skipped} skipped,"
+            f" {self.failed} failed, {self.bytes} bytes in {self.duration:.3f}s"
+            f" ({speed:.2f} MiB/s)"
+        )
+
+
+def create_client(target: S3Target) -> Any:
+    return boto3.client(
+        "s3",
+        endpoint_url=target.endpoint_url,
+        region_name=target.region,
+        # One connection per concurrent part, the default pool only has 10
+        config=BotoConfig(max_pool_connections=max(10, target.concurrency)),
+    )
+
+
+def find_upload_items(config: Config) -> list[UploadItem]:
+    assert config.s3
+    prefix = config.s3.prefix
+
+    if config.storage in ("packs", "dedup"):
+        store = PackStore(dir=config.backup_dir)
+        return [
+            UploadItem(
+                key=f"{prefix}{name}",
+                path=config.backup_dir / entry.pack,
+                size=entry.length,
+                offset=entry.offset,
+            )
+            for name, entry in sorted(store.entries().items())
+        ]
+
+    return [
+        UploadItem(key=f"{prefix}{path.name}", path=path, size=path.stat().st_size)
+        for path in sorted(list_backups(config=config))
+    ]
+
+
+class S3Uploader:
+    """
+    Upload `UploadItem`s to `target`, see module docstring. `state_dir` holds the cached
+    listing and the multipart uploads in progress.
+    """
+
+    def __init__(self, target: S3Target, state_dir: Path, client: Any = None) -> None:
+        self.target = target
+        self.state_dir = state_dir
+        self.client = client or create_client(target)
+
+    @property
+    def _listing_path(self) -> Path:
+        return self.state_dir / LISTING_NAME
+
+    @property
+    def _uploads_path(self) -> Path:
+        return self.state_dir / UPLOADS_NAME
+
+    def _save_json(self, path: Path, data: dict) -> None:
+        content = json.dumps(data, sort_keys=True).encode("utf-8")
+        atomic_write_bytes(path=path, content=content, mode=0o600)
+
+    def _list_bucket(self) -> dict[str, int]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        objects: dict[str, int] = {}
+        for page in paginator.paginate(
+            Bucket=self.target.bucket, Prefix=self.target.prefix
+        ):
+            for obj in page.get("Contents", []):
+                objects[obj["Key"]] = obj["Size"]
+
+        logger.debug(f"{len(objects)} objects listed in s3://{self.target.bucket}")
+        return objects
+
+    def _load_listing(self) -> tuple[dict[str, int], float]:
+        """
+        Objects in the bucket (key -> size), from the cache if it is recent enough, and
+        when they were listed.
+        """
+        if self._listing_path.exists():
+            data = json.loads(self._listing_path.read_text())
+            if (
+                data["bucket"] == self.target.bucket
+                and time.time() - data["listed_at"] < LISTING_MAX_AGE
+            ):
+                return data["objects"], data["listed_at"]
+
+        listed_at = time.time()
+        objects = self._list_bucket()
+        self._save_listing(objects=objects, listed_at=listed_at)
+        return objects, listed_at
+
+    def _save_listing(self, objects: dict[str, int], listed_at: float) -> None:
+        data = {
+            "bucket": self.target.bucket,
+            "listed_at": listed_at,
+            "objects": objects,
+        }
+        self._save_json(self._listing_path, data)
+
+    def _load_uploads(self) -> dict[str, dict]:
+        if not self._uploads_path.exists():
+            return {}
+        return json.loads(self._uploads_path.read_text())
+
+    def _put(self, item: UploadItem) -> int:
+        self.client.put_object(
+            Bucket=self.target.bucket,
+            Key=item.key,
+            Body=item.read_part(start=0, length=item.size),
+        )
+        return item.size
+
+    def _upload_part(self, item: UploadItem, upload_id: str, number: int) -> dict:
+        start = (number - 1) * self.target.part_size
+        length = min(self.target.part_size, item.size - start)
+        body = item.read_part(start=start, length=length)
+        response = self.client.upload_part(
+            Bucket=self.target.bucket,
+            Key=item.key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        metrics.add("s3.bytes_uploaded", len(body))
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def _uploaded_parts(self, item: UploadItem, upload_id: str) -> dict[int, dict]:
+        """
+        Parts of a previous attempt that the bucket already has, complete ones only.
+        """
+        paginator = self.client.get_paginator("list_parts")
+        parts: dict[int, dict] = {}
+        for page in paginator.paginate(
+            Bucket=self.target.bucket, Key=item.key, UploadId=upload_id
+        ):
+            for part in page.get("Parts", []):
+                number = part["PartNumber"]
+                start = (number - 1) * self.target.part_size
+                if part["Size"] == min(self.target.part_size, item.size - start):
+                    parts[number] = {"PartNumber": number, "ETag": part["ETag"]}
+        return parts
+
+    def _start_or_resume(
+        self, item: UploadItem, uploads: dict[str, dict]
+    ) -> tuple[str, dict[int, dict]]:
+        """
+        Return the id of the multipart upload of `item`, and the parts it already has.
+        """
+        previous = uploads.get(item.key)
+        if previous and previous["size"] == item.size:
+            try:
+                parts = self._uploaded_parts(item, upload_id=previous["upload_id"])
+                logger.debug(f"Resuming upload of {item.key}, {len(parts)} parts done")
+                return previous["upload_id"], parts
+            except ClientError as error:
+                # Aborted, or expired by a lifecycle rule of the bucket
+                logger.debug(f"Cannot resume upload of {item.key}: {error}")
+
+        response = self.client.create_multipart_upload(
+            Bucket=self.target.bucket, Key=item.key
+        )
+        upload_id = response["UploadId"]
+
+        # Saved before any part is sent, so an interrupted upload can be resumed
+        uploads[item.key] = {"upload_id": upload_id, "size": item.size}
+        self._save_json(self._uploads_path, uploads)
+        return upload_id, {}
+
+    def _upload_multipart(
+        self, item: UploadItem, uploads: dict[str, dict], executor: ThreadPoolExecutor
+    ) -> None:
+        upload_id, parts = self._start_or_resume(item, uploads=uploads)
+
+        part_count = -(-item.size // self.target.part_size)
+        futures = [
+            executor.submit(self._upload_part, item, upload_id, number)
+            for number in range(1, part_count + 1)
+            if number not in parts
+        ]
+        for future in futures:
+            part = future.result()
+            parts[part["PartNumber"]] = part
+
+        self.client.complete_multipart_upload(
+            Bucket=self.target.bucket,
+            Key=item.key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": [parts[number] for number in sorted(parts)]},
+        )
+
+        del uploads[item.key]
+        self._save_json(self._uploads_path, uploads)
+
+    def upload(self, items: list[UploadItem]) -> UploadSummary:
+        """
+        Upload the items that are not in the bucket yet. Small items are uploaded
+        `S3Target.concurrency` at a time, and large ones one after the other, each with
+        `S3Target.concurrency` parts at a time.
+        """
+        start = time.monotonic()
+        bytes_before = metrics.get("s3.bytes_uploaded")
+
+        listing, listed_at = self._load_listing()
+        uploads = self._load_uploads()
+
+        missing = [item for item in items if listing.get(item.key) != item.size]
+        skipped = len(items) - len(missing)
+        uploaded = failed = 0
+
+        small = [item for item in missing if item.size <= self.target.part_size]
+        large = [item for item in missing if item.size > self.target.part_size]
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.target.concurrency) as executor:
+                puts: list[tuple[UploadItem, Future]] = [
+                    (item, executor.submit(self._put, item)) for item in small
+                ]
+                for item, future in puts:
+                    try:
+                        metrics.add("s3.bytes_uploaded", future.result())
+                    except (BotoCoreError, ClientError, OSError) as error:
+                        logger.error(f"Failed to upload {item.key}: {error}")
+                        failed += 1
+                        continue
+
+                    listing[item.key] = item.size
+                    uploaded += 1
+
+                for item in large:
+                    try:
+                        self._upload_multipart(item, uploads=uploads, executor=executor)
+                    except (BotoCoreError, ClientError, OSError) as error:
+                        logger.error(f"Failed to upload {item.key}: {error}")
+                        failed += 1
+                        continue
+
+                    listing[item.key] = item.size
+                    uploaded += 1
+        finally:
+            # Keeps the age of the listing, the objects uploaded since are known to be
+            # in the bucket
+            self._save_listing(objects=listing, listed_at=listed_at)
+
+        duration = time.monotonic() - start
+        summary = UploadSummary(
+            uploaded=uploaded,
+            skipped=skipped,
+            failed=failed,
+            bytes=int(metrics.get("s3.bytes_uploaded") - bytes_before),
+            duration=duration,
+        )
+
+        metrics.add("s3.objects_uploaded", uploaded)
+        metrics.add("s3.objects_skipped", skipped)
+        metrics.add("s3.seconds", duration)
+        metrics.set(
+            "s3.throughput_mib_s",
+            throughput(
+                bytes=metrics.get("s3.bytes_uploaded"),
+                seconds=metrics.get("s3.seconds"),
+            ),
+        )
+
+        return summary
+
+
+def upload_backups(config: Config) -> UploadSummary:
+    assert config.s3
+    uploader = S3Uploader(
+        target=config.s3, state_dir=config.backup_dir / STATE_DIR_NAME
+    )
+    try:
+        summary = uploader.upload(items=find_upload_items(config=config))
+    except (BotoCoreError, ClientError) as error:
+        raise ReplicationError(f"Failed to upload to s3://{config.s3.bucket}: {error}")
+
+    logger.info(
+        f"Upload to s3://{config.s3.bucket}: {summary}",
+        extra={"stage": "upload", "bytes": summary.bytes},
+    )
+    if summary.failed:
+        raise ReplicationError(
+            f"Failed to upload {summary.failed} objects to s3://{config.s3.bucket}"
+        )
+
+    return summary
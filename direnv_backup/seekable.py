@@ -0,0 +1,272 @@
+"""
+Archive format where any member can be read without reading the rest of the archive.
+
+A tar archive encrypted as a whole must be decrypted from the start to reach any of its
+members. In a seekable archive each member is encrypted on its own (a frame), and an
+index with the position of every frame is stored, encrypted too, at the end of the
+archive:
+
+    archive = MAGIC | frame | ... | frame | index | footer
+    footer  = index offset (8 bytes) | index length (8 bytes) | MAGIC
+
+Reading one member only needs to read the footer, decrypt the index, and decrypt the
+frame of that member, so it takes the same time no matter how big the archive is.
+Members with the same content, like a hard linked direnv file backed up under each of
+its paths, share a single frame.
+
+The index also holds the hash of every member, so it doubles as the manifest of the
+archive, see `direnv_backup.archive.MANIFEST_NAME`.
+"""
+import json
+import logging
+import os
+import stat
+import struct
+from dataclasses import dataclass, fields
+from pathlib import Path
+from types import TracebackType
+from typing import BinaryIO, Iterator
+
+from direnv_backup.archive import ArchiveMember, Manifest, known_hash
+from direnv_backup.config import SEEKABLE_EXTENSION
+from direnv_backup.encrypt import EncryptionBackend
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"DBASEEK1"
+FOOTER = struct.Struct(f">QQ{len(MAGIC)}s")
+INDEX_VERSION = 1
+
+# Amount of frames decrypted together when reading many members, e.g. by a single gpg
+# process, see `EncryptionBackend.decrypt_many`
+FRAME_BATCH_SIZE = 64
+
+
+class SeekableArchiveError(Exception):
+    ...
+
+
+@dataclass(frozen=True)
+class IndexEntry:
+    offset: int
+    length: int
+    mode: int
+    sha256: str
+
+
+Index = dict[str, IndexEntry]  # member name -> frame
+
+
+def is_seekable_archive(path: Path) -> bool:
+    return path.suffix == SEEKABLE_EXTENSION
+
+
+def encode_index(index: Index) -> bytes:
+    files = {
+        name: {
+            "offset": entry.offset,
+            "length": entry.length,
+            "mode": entry.mode,
+            "sha256": entry.sha256,
+        }
+        for name, entry in index.items()
+    }
+    data = {"version": INDEX_VERSION, "files": files}
+    return json.dumps(data, sort_keys=True).encode("utf-8")
+
+
+def decode_index(content: bytes) -> Index:
+    try:
+        data = json.loads(content)
+    except ValueError:
+        raise SeekableArchiveError("Corrupt archive index")
+
+    if not isinstance(data, dict):
+        raise SeekableArchiveError("Corrupt archive index")
+
+    if data.get("version") != INDEX_VERSION:
+        raise SeekableArchiveError(
+            f"Unsupported archive index version: {data.get('version')}"
+        )
+
+    files = data.get("files")
+    if not isinstance(files, dict):
+        raise SeekableArchiveError("Corrupt archive index")
+
+    return {name: decode_index_entry(name, entry) for name, entry in files.items()}
+
+
+def decode_index_entry(name: str, entry: object) -> IndexEntry:
+    types = {field.name: field.type for field in fields(IndexEntry)}
+    if not isinstance(entry, dict) or entry.keys() != types.keys():
+        raise SeekableArchiveError(f"Corrupt archive index entry: {name}")
+
+    for key, value in entry.items():
+        # Exact types, as `bool` is an `int` too
+        if type(value) is not types[key] or (type(value) is int and value < 0):
+            raise SeekableArchiveError(f"Corrupt archive index entry: {name}")
+
+    return IndexEntry(**entry)
+
+
+def write_seekable_archive(
+    dir: Path,
+    base: Path,
+    output: Path,
+    backend: EncryptionBackend | None,
+    hashes: Manifest | None = None,
+) -> Path:
+    """
+    Build a seekable archive with every file inside `dir`, named after their relative
+    path from `base` (see `direnv_backup.archive.archive_dir`). Each file is encrypted
+    with `backend`, unless it is not set. Files in `hashes` are not hashed again.
+
+    The archive is written to a temporary file and renamed once complete, so a partial
+    archive is never mistaken for a backup.
+    """
+    assert output.suffix == SEEKABLE_EXTENSION
+
+    paths = sorted(path for path in dir.rglob("*") if path.is_file())
+    names = {path: str(path.relative_to(base)) for path in paths}
+    digests = {
+        path: known_hash(path, name=names[path], hashes=hashes) for path in paths
+    }
+
+    # Files with the same content (e.g. a hard linked direnv file backed up under each
+    # of its paths) share a single frame
+    unique: dict[str, Path] = {}
+    for path in paths:
+        unique.setdefault(digests[path], path)
+
+    # Encrypt all files in one go, to let the backend batch them
+    frames = backend.encrypt_files(list(unique.values())) if backend else None
+
+    index: Index = {}
+    tmp_output = output.with_name(f".{output.name}.tmp")
+
+    try:
+        with tmp_output.open("wb") as f:
+            f.write(MAGIC)
+
+            # (offset, length) of the frame of each content, by hash
+            written: dict[str, tuple[int, int]] = {}
+            for i, (digest, path) in enumerate(unique.items()):
+                frame = frames[i] if frames is not None else path.read_bytes()
+                written[digest] = (f.tell(), len(frame))
+                f.write(frame)
+
+            for path in paths:
+                name = names[path]
+                logger.debug("Adding file to archive as %s", name)
+
+                offset, length = written[digests[path]]
+                index[name] = IndexEntry(
+                    offset=offset,
+                    length=length,
+                    mode=stat.S_IMODE(path.stat().st_mode),
+                    sha256=digests[path],
+                )
+
+            encoded_index = encode_index(index)
+            if backend:
+                encoded_index = backend.encrypt_bytes(encoded_index)
+
+            index_offset = f.tell()
+            f.write(encoded_index)
+            f.write(FOOTER.pack(index_offset, len(encoded_index), MAGIC))
+
+        os.replace(tmp_output, output)
+    except BaseException:
+        tmp_output.unlink(missing_ok=True)
+        raise
+
+    return output
+
+
+class SeekableArchive:
+    """
+    Read members of a seekable archive by name, decrypting only the frames of those
+    members. Frames are decrypted with `backend`, unless it is not set.
+
+        with SeekableArchive(path=path, backend=backend) as archive:
+            for member in archive.iter_members(names={name}):
+                ...
+    """
+
+    def __init__(self, path: Path, backend: EncryptionBackend | None) -> None:
+        self.path = path
+        self.backend = backend
+
+    def __enter__(self) -> "SeekableArchive":
+        self._file: BinaryIO = self.path.open("rb")
+        try:
+            self.index = self._read_index()
+        except BaseException:
+            self._file.close()
+            raise
+
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        self._file.close()
+
+    def _read_at(self, offset: int, length: int) -> bytes:
+        self._file.seek(offset)
+        data = self._file.read(length)
+        if len(data) != length:
+            raise SeekableArchiveError(f"Truncated archive: {self.path}")
+        return data
+
+    def _read_index(self) -> Index:
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise SeekableArchiveError(f"Not a seekable archive: {self.path}")
+
+        size = self._file.seek(0, os.SEEK_END)
+        if size < len(MAGIC) + FOOTER.size:
+            raise SeekableArchiveError(f"Truncated archive: {self.path}")
+
+        footer = self._read_at(size - FOOTER.size, FOOTER.size)
+        index_offset, index_length, magic = FOOTER.unpack(footer)
+        if magic != MAGIC or index_offset + index_length > size - FOOTER.size:
+            raise SeekableArchiveError(f"Truncated archive: {self.path}")
+
+        encoded_index = self._read_at(index_offset, index_length)
+        if self.backend:
+            encoded_index = self.backend.decrypt_bytes(encoded_index)
+
+        return decode_index(encoded_index)
+
+    @property
+    def names(self) -> list[str]:
+        return sorted(self.index)
+
+    @property
+    def manifest(self) -> Manifest:
+        return {name: entry.sha256 for name, entry in self.index.items()}
+
+    def iter_members(self, names: set[str] | None = None) -> Iterator[ArchiveMember]:
+        """
+        Yield the members in `names` that exist in the archive (every member by
+        default), decrypting their frames in batches. See `FRAME_BATCH_SIZE`.
+        """
+        wanted = [name for name in self.names if names is None or name in names]
+
+        for start in range(0, len(wanted), FRAME_BATCH_SIZE):
+            end = start + FRAME_BATCH_SIZE
+            batch = wanted[start:end]
+            frames = [
+                self._read_at(self.index[name].offset, self.index[name].length)
+                for name in batch
+            ]
+            contents = self.backend.decrypt_many(frames) if self.backend else frames
+
+            for name, content in zip(batch, contents):
+                logger.debug("Read %s from archive", name)
+                yield ArchiveMember(
+                    name=name, content=content, mode=self.index[name].mode
+                )
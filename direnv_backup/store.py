@@ -0,0 +1,433 @@
+"""
+Pack-file storage: many backups are appended to a few large pack files instead of
+being stored as one file each, so that listing the backups and syncing the backup dir
+(e.g. with Dropbox) costs the same whatever the amount of backups is.
+
+    backup_dir/
+        pack-000001.pack   backups, one after the other
+        pack-000001.json   sidecar index: backup name -> offset and length in the pack
+        pack-000002.pack
+        pack-000002.json
+
+Packs are append-only. Removing a backup only drops it from the sidecar index, and the
+space it used in the pack becomes garbage. `PackStore.compact` rewrites the packs that
+are mostly garbage.
+
+Every change writes the data first and the sidecar index last, atomically, so an
+interrupted change leaves at worst some unreferenced bytes in a pack. A backup can
+appear in more than one sidecar index if a compaction was interrupted, in that case the
+copy in the most recent pack is used and the others count as garbage.
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator
+
+from direnv_backup.io import atomic_write_bytes
+
+logger = logging.getLogger(__name__)
+
+PACK_PREFIX = "pack-"
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".json"
+LOCK_NAME = ".pack-store.lock"
+
+# A new pack is started once the current one reaches this size
+MAX_PACK_SIZE = 256 * 1024 * 1024
+
+# Packs where at least this fraction of the bytes is garbage are rewritten on compaction
+COMPACTION_THRESHOLD = 0.5
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class PackStoreError(Exception):
+    ...
+
+
+@dataclass(frozen=True)
+class PackEntry:
+    pack: str  # pack file name
+    offset: int
+    length: int
+
+
+@dataclass(frozen=True)
+class PackUsage:
+    pack: str
+    size: int  # bytes in the pack file
+    live: int  # bytes used by backups that were not removed
+
+    @property
+    def garbage_ratio(self) -> float:
+        if not self.size:
+            return 1.0
+        return 1 - self.live / self.size
+
+
+@dataclass(frozen=True)
+class CompactionSummary:
+    packs_rewritten: int
+    bytes_freed: int
+
+    def __str__(self) -> str:
+        mib = self.bytes_freed / (1024 * 1024)
+        return f"{self.packs_rewritten} packs rewritten, {mib:.1f} MiB freed"
+
+
+def pack_name(number: int) -> str:
+    return f"{PACK_PREFIX}{number:06d}{PACK_SUFFIX}"
+
+
+def pack_number(name: str) -> int:
+    return int(name.removeprefix(PACK_PREFIX).removesuffix(PACK_SUFFIX))
+
+
+def copy_range(source: BinaryIO, output: BinaryIO, length: int) -> None:
+    remaining = length
+    while remaining:
+        chunk = source.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise PackStoreError("Unexpected end of file while copying")
+        output.write(chunk)
+        remaining -= len(chunk)
+
+
+class PackStore:
+    """
+    Store of named blobs (backups) inside pack files in `dir`. See module docstring.
+    """
+
+    def __init__(self, dir: Path, max_pack_size: int = MAX_PACK_SIZE) -> None:
+        self.dir = dir
+        self.max_pack_size = max_pack_size
+
+    def _index_path(self, pack: str) -> Path:
+        return self.dir / pack.replace(PACK_SUFFIX, INDEX_SUFFIX)
+
+    def _read_index(self, pack: str) -> dict[str, PackEntry]:
+        data = json.loads(self._index_path(pack).read_text())
+        return {
+            name: PackEntry(pack=pack, offset=entry["offset"], length=entry["length"])
+            for name, entry in data["entries"].items()
+        }
+
+    def _write_index(self, pack: str, entries: dict[str, PackEntry]) -> None:
+        data = {
+            "entries": {
+                name: {"offset": entry.offset, "length": entry.length}
+                for name, entry in sorted(entries.items())
+            }
+        }
+        content = json.dumps(data, indent=2).encode("utf-8")
+        atomic_write_bytes(path=self._index_path(pack), content=content, mode=0o600)
+
+    def _packs(self) -> list[str]:
+        """
+        Pack names, oldest first. A pack without a sidecar index holds no backup yet.
+        """
+        indexes = self.dir.glob(f"{PACK_PREFIX}*{INDEX_SUFFIX}")
+        packs = [path.name.replace(INDEX_SUFFIX, PACK_SUFFIX) for path in indexes]
+        return sorted(packs, key=pack_number)
+
+    def _load(self) -> dict[str, dict[str, PackEntry]]:
+        """
+        Read every sidecar index, and return the entries of each pack. Backups that
+        are in more than one pack are only kept in the most recent one.
+        """
+        by_pack: dict[str, dict[str, PackEntry]] = {}
+        seen: set[str] = set()
+
+        for pack in reversed(self._packs()):
+            entries = self._read_index(pack)
+            by_pack[pack] = {
+                name: entry for name, entry in entries.items() if name not in seen
+            }
+            seen.update(entries)
+
+        return by_pack
+
+    def entries(self) -> dict[str, PackEntry]:
+        return {
+            name: entry
+            for entries in self._load().values()
+            for name, entry in entries.items()
+        }
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """
+        Serialize changes to the store across processes, e.g. a scheduled backup and a
+        manual compaction.
+        """
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with (self.dir / LOCK_NAME).open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def names(self) -> list[str]:
+        return sorted(self.entries())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries()
+
+    def _pack_to_append(self) -> str:
+        packs = self._packs()
+        if packs:
+            last = packs[-1]
+            path = self.dir / last
+            if not path.exists() or path.stat().st_size < self.max_pack_size:
+                return last
+
+        next_number = pack_number(packs[-1]) + 1 if packs else 1
+        return pack_name(next_number)
+
+    def _index_appended(self, pack: str, appended: dict[str, PackEntry]) -> None:
+        """
+        Add the entries appended to `pack` to its index, and drop older copies of the
+        same names from the other packs. Must hold the lock.
+        """
+        by_pack = self._load()
+        for other_pack, entries in by_pack.items():
+            if other_pack != pack and entries.keys() & appended.keys():
+                for name in entries.keys() & appended.keys():
+                    del entries[name]
+                self._write_index(other_pack, entries)
+
+        entries = by_pack.get(pack, {})
+        entries.update(appended)
+        self._write_index(pack, entries)
+
+    def add(self, name: str, source: Path) -> PackEntry:
+        """
+        Append the content of `source` to the current pack under `name`, replacing any
+        backup with the same name.
+        """
+        with self._lock():
+            pack = self._pack_to_append()
+            pack_path = self.dir / pack
+
+            with source.open("rb") as src, pack_path.open("ab") as output:
+                # Whatever an interrupted append left at the end of the pack is garbage
+                offset = output.seek(0, os.SEEK_END)
+                shutil.copyfileobj(src, output, COPY_CHUNK_SIZE)
+                output.flush()
+                os.fsync(output.fileno())
+                length = output.tell() - offset
+
+            entry = PackEntry(pack=pack, offset=offset, length=length)
+            self._index_appended(pack, {name: entry})
+
+        logger.debug(f"Added {name} to {pack} ({length} bytes at offset {offset})")
+        return entry
+
+    def add_many(self, blobs: dict[str, bytes]) -> None:
+        """
+        Append every blob to the current pack, and update the indexes once for all of
+        them. Meant for many small blobs, see `direnv_backup.dedup`.
+        """
+        if not blobs:
+            return
+
+        with self._lock():
+            pack = self._pack_to_append()
+            appended: dict[str, PackEntry] = {}
+
+            with (self.dir / pack).open("ab") as output:
+                output.seek(0, os.SEEK_END)
+                for name, data in blobs.items():
+                    offset = output.tell()
+                    output.write(data)
+                    appended[name] = PackEntry(
+                        pack=pack, offset=offset, length=len(data)
+                    )
+                output.flush()
+                os.fsync(output.fileno())
+
+            self._index_appended(pack, appended)
+
+        logger.debug(f"Added {len(blobs)} blobs to {pack}")
+
+    @contextmanager
+    def open_reader(self) -> Iterator["PackReader"]:
+        """
+        Read many blobs while loading the indexes once, and opening each pack once.
+        """
+        reader = PackReader(dir=self.dir, entries=self.entries())
+        try:
+            yield reader
+        finally:
+            reader.close()
+
+    def extract(self, name: str, output: Path) -> None:
+        entries = self.entries()
+        if name not in entries:
+            raise PackStoreError(f"{name} not found in {self.dir}")
+
+        entry = entries[name]
+        with (self.dir / entry.pack).open("rb") as src, output.open("wb") as dst:
+            src.seek(entry.offset)
+            copy_range(source=src, output=dst, length=entry.length)
+
+    def remove(self, names: Iterable[str]) -> None:
+        """
+        Drop `names` from the sidecar indexes. Their bytes stay in the packs until they
+        are compacted, see `compact`.
+        """
+        to_remove = set(names)
+
+        with self._lock():
+            for pack in self._packs():
+                entries = self._read_index(pack)
+                if to_remove & entries.keys():
+                    for name in to_remove & entries.keys():
+                        del entries[name]
+                    self._write_index(pack, entries)
+
+        logger.debug(f"Removed {len(to_remove)} backups from {self.dir}")
+
+    def _usage(self, by_pack: dict[str, dict[str, PackEntry]]) -> list[PackUsage]:
+        return [
+            PackUsage(
+                pack=pack,
+                size=(self.dir / pack).stat().st_size,
+                live=sum(entry.length for entry in entries.values()),
+            )
+            for pack, entries in sorted(
+                by_pack.items(), key=lambda i: pack_number(i[0])
+            )
+        ]
+
+    def usage(self) -> list[PackUsage]:
+        return self._usage(self._load())
+
+    def compact(
+        self, threshold: float = COMPACTION_THRESHOLD, deadline: float | None = None
+    ) -> CompactionSummary:
+        """
+        Copy the live backups of every pack that is at least `threshold` garbage into a
+        new pack, and delete the old packs. If `deadline` (a `time.monotonic` value) is
+        set, no more packs are rewritten once it is reached, the rest are left for the
+        next compaction.
+
+        The copies are indexed before the old packs and their indexes are deleted, so an
+        interrupted compaction never loses a backup.
+        """
+        with self._lock():
+            by_pack = self._load()
+            to_rewrite = [
+                usage
+                for usage in self._usage(by_pack)
+                if usage.garbage_ratio >= threshold
+            ]
+
+            rewritten = self._copy_to_new_pack(
+                usages=to_rewrite, by_pack=by_pack, deadline=deadline
+            )
+
+            for usage in rewritten:
+                self._index_path(usage.pack).unlink()
+                (self.dir / usage.pack).unlink()
+                logger.debug(f"Compacted {usage.pack}, {usage.size - usage.live} bytes")
+
+            self._remove_orphan_packs()
+
+        return CompactionSummary(
+            packs_rewritten=len(rewritten),
+            bytes_freed=sum(usage.size - usage.live for usage in rewritten),
+        )
+
+    def _remove_orphan_packs(self) -> None:
+        """
+        Delete packs without a sidecar index, left behind by an interrupted compaction
+        or by an interrupted first append to a pack. Must hold the lock.
+        """
+        indexed = set(self._packs())
+        for path in self.dir.glob(f"{PACK_PREFIX}*{PACK_SUFFIX}"):
+            if path.name not in indexed:
+                logger.debug(f"Deleting orphan pack {path.name}")
+                path.unlink()
+
+    def _copy_to_new_pack(
+        self,
+        usages: list[PackUsage],
+        by_pack: dict[str, dict[str, PackEntry]],
+        deadline: float | None,
+    ) -> list[PackUsage]:
+        """
+        Copy the live entries of the packs in `usages`, oldest first, into a single new
+        pack until `deadline`. Return the packs that were fully copied.
+        """
+        if not usages:
+            return []
+
+        pack = pack_name(pack_number(self._packs()[-1]) + 1)
+
+        copied: dict[str, PackEntry] = {}
+        rewritten: list[PackUsage] = []
+        with (self.dir / pack).open("wb") as output:
+            for usage in usages:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+
+                entries = sorted(by_pack[usage.pack].items(), key=lambda i: i[1].offset)
+                with (self.dir / usage.pack).open("rb") as src:
+                    for name, entry in entries:
+                        src.seek(entry.offset)
+                        offset = output.tell()
+                        copy_range(source=src, output=output, length=entry.length)
+                        copied[name] = PackEntry(
+                            pack=pack, offset=offset, length=entry.length
+                        )
+                rewritten.append(usage)
+
+            output.flush()
+            os.fsync(output.fileno())
+
+        if copied:
+            self._write_index(pack, copied)
+        # Otherwise the new pack is an orphan, and is deleted with the other orphans
+
+        return rewritten
+
+
+class PackReader:
+    """
+    See `PackStore.open_reader`.
+    """
+
+    def __init__(self, dir: Path, entries: dict[str, PackEntry]) -> None:
+        self.dir = dir
+        self.entries = entries
+        self._files: dict[str, BinaryIO] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def read(self, name: str) -> bytes:
+        if name not in self.entries:
+            raise PackStoreError(f"{name} not found in {self.dir}")
+
+        entry = self.entries[name]
+        if entry.pack not in self._files:
+            self._files[entry.pack] = (self.dir / entry.pack).open("rb")
+
+        src = self._files[entry.pack]
+        src.seek(entry.offset)
+        data = src.read(entry.length)
+        if len(data) != entry.length:
+            raise PackStoreError(f"{entry.pack} is truncated")
+        return data
+
+    def close(self) -> None:
+        for file in self._files.values():
+            file.close()
@@ -0,0 +1,190 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import IO
+
+from direnv_backup import process
+from direnv_backup.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Pressure stall information, see https://docs.kernel.org/accounting/psi.html
+IO_PRESSURE_PATH = Path("/proc/pressure/io")
+
+# Seconds between two reads of the system load while throttling
+LOAD_CHECK_INTERVAL = 0.5
+
+# Longest pause in a row: a busy system slows the backup down, but never stops it
+MAX_PAUSE = 30
+
+# Longest time paused in total by a throttle, after which it stops pausing, so that a
+# system that stays busy does not stretch a run to hours. See
+# `Config.throttle_time_budget`
+MAX_TOTAL_PAUSE = 300
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by every reader that must stay under the same bandwidth cap.
+    The bucket holds up to one second worth of bytes, so short bursts are allowed.
+    """
+
+    def __init__(self, bytes_per_second: int) -> None:
+        assert bytes_per_second > 0
+        self.bytes_per_second = bytes_per_second
+        self._available = float(bytes_per_second)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last_refill
+            self._last_refill = now
+            self._available = min(
+                self.bytes_per_second,
+                self._available + elapsed * self.bytes_per_second,
+            )
+            self._available -= amount
+            wait = -self._available / self.bytes_per_second
+
+        # Sleep outside the lock: the debt is already booked, so other readers will wait
+        # for it too instead of racing for the same bytes
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledReader:
+    """
+    Minimal read-only file object that keeps `raw` under the `limiter` bandwidth cap.
+    """
+
+    def __init__(self, raw: IO[bytes], limiter: BandwidthLimiter) -> None:
+        self.raw = raw
+        self.limiter = limiter
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.raw.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+
+def read_load_per_cpu() -> float:
+    """
+    Load average of the last minute, divided by the amount of CPUs.
+    """
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def read_io_pressure() -> float | None:
+    """
+    Percentage of the last 10 seconds in which some task was stalled waiting for I/O, or
+    `None` if the kernel does not report it.
+    """
+    try:
+        content = IO_PRESSURE_PATH.read_text()
+    except OSError:
+        return None
+
+    for line in content.splitlines():
+        kind, *fields = line.split()
+        if kind == "some":
+            values = dict(field.split("=") for field in fields)
+            return float(values["avg10"])
+
+    return None
+
+
+class LoadThrottle:
+    """
+    Pause a background task (e.g. scanning) while the system is busy: while the load
+    average per CPU is above `max_load`, or the I/O pressure is above `max_io_pressure`
+    (see `read_io_pressure`). Unset limits are not checked.
+
+    The system load is read at most every `LOAD_CHECK_INTERVAL` seconds, so calling
+    `pause_if_busy` for every directory is cheap. Time spent paused is added to the
+    "throttle.seconds" metric. Once it has paused for `max_total_pause` seconds in total
+    it stops pausing, see `MAX_TOTAL_PAUSE`.
+    """
+
+    def __init__(
+        self,
+        max_load: float | None = None,
+        max_io_pressure: float | None = None,
+        max_total_pause: float = MAX_TOTAL_PAUSE,
+    ) -> None:
+        self.max_load = max_load
+        self.max_io_pressure = max_io_pressure
+        self.max_total_pause = max_total_pause
+        self.paused = 0.0
+        self._last_check = 0.0
+
+    def is_busy(self) -> bool:
+        if self.max_load is not None and read_load_per_cpu() > self.max_load:
+            return True
+
+        if self.max_io_pressure is not None:
+            pressure = read_io_pressure()
+            if pressure is not None and pressure > self.max_io_pressure:
+                return True
+
+        return False
+
+    def pause_if_busy(self, deadline: float | None = None) -> None:
+        """
+        Pause while the system is busy, but never past `deadline` (a `time.monotonic`
+        value), if it is set.
+        """
+        if self.max_load is None and self.max_io_pressure is None:
+            return
+
+        start = time.monotonic()
+        if start - self._last_check < LOAD_CHECK_INTERVAL:
+            return
+
+        if self.paused >= self.max_total_pause:
+            return
+
+        end = start + min(MAX_PAUSE, self.max_total_pause - self.paused)
+        if deadline is not None:
+            end = min(end, deadline)
+
+        paused = False
+        while time.monotonic() < end and self.is_busy():
+            paused = True
+            time.sleep(LOAD_CHECK_INTERVAL)
+
+        self._last_check = time.monotonic()
+        if paused:
+            duration = self._last_check - start
+            self.paused += duration
+            logger.debug(f"System busy, paused for {duration:.3f}s")
+            metrics.add("throttle.seconds", duration)
+
+            if self.paused >= self.max_total_pause:
+                logger.info(
+                    f"System still busy after pausing for {self.paused:.0f}s,"
+                    " throttling stopped for this run"
+                )
+
+
+def lower_priority(nice: int, ionice_idle: bool) -> None:
+    """
+    Lower the CPU (`nice`) and I/O priority of the current process. Processes started
+    afterwards, like gpg, inherit both.
+    """
+    if nice:
+        os.nice(nice)
+        logger.debug(f"Niceness raised by {nice}")
+
+    if ionice_idle:
+        cmd = ["ionice", "--class", "idle", "--pid", str(os.getpid())]
+        try:
+            process.run(cmd, timeout=5)
+        except (OSError, process.ProcessError) as error:
+            # e.g. util-linux not installed, the backup still works at normal priority
+            logger.warning(f"Failed to set the idle I/O scheduling class: {error}")
+        else:
+            logger.debug("I/O scheduling class set to idle")
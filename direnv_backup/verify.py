@@ -0,0 +1,233 @@
+import dataclasses
+import hashlib
+import logging
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, ContextManager
+
+from direnv_backup.archive import (
+    MANIFEST_NAME,
+    Manifest,
+    ManifestError,
+    iter_members,
+    parse_manifest,
+)
+from direnv_backup.config import Config
+from direnv_backup.dedup import DedupError, DedupStore
+from direnv_backup.encrypt import (
+    EncryptionBackend,
+    EncryptionError,
+    GPGError,
+    get_encryption_backend,
+    is_gpg_installed,
+)
+from direnv_backup.restore import list_backups, open_backup
+from direnv_backup.seekable import (
+    SeekableArchive,
+    SeekableArchiveError,
+    is_seekable_archive,
+)
+from direnv_backup.store import PackStoreError
+from direnv_backup.throttle import BandwidthLimiter, ThrottledReader
+
+logger = logging.getLogger(__name__)
+
+
+class VerificationError(Exception):
+    ...
+
+
+@dataclass
+class VerificationResult:
+    backup: Path
+    members: int = 0
+    has_manifest: bool = False
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+def compare_with_manifest(hashes: Manifest, manifest: Manifest) -> list[str]:
+    errors: list[str] = []
+
+    for name in sorted(manifest.keys() - hashes.keys()):
+        errors.append(f"{name}: listed in the manifest but missing in the archive")
+
+    for name in sorted(hashes.keys() - manifest.keys()):
+        errors.append(f"{name}: found in the archive but not listed in the manifest")
+
+    for name in sorted(hashes.keys() & manifest.keys()):
+        if hashes[name] != manifest[name]:
+            errors.append(f"{name}: hash does not match the manifest")
+
+    return errors
+
+
+def verify_backup(
+    backup: Path,
+    backend: EncryptionBackend | None,
+    limiter: BandwidthLimiter | None = None,
+) -> VerificationResult:
+    """
+    Read the whole backup as a stream, in memory, and check the hash of every member
+    against the manifest stored at the end of the archive. Nothing is written to disk.
+
+    Unencrypted backups must be verified without `backend`.
+    """
+    logger.debug(f"Verifying {backup}")
+
+    if is_seekable_archive(backup):
+        return verify_seekable_backup(backup=backup, backend=backend, limiter=limiter)
+
+    result = VerificationResult(backup=backup)
+    hashes: Manifest = {}
+    manifest: Manifest | None = None
+
+    if backend:
+        stream: ContextManager[IO[bytes]] = backend.decrypt_stream(backup)
+    else:
+        stream = backup.open("rb")
+
+    try:
+        with stream as raw:
+            fileobj = ThrottledReader(raw=raw, limiter=limiter) if limiter else raw
+            for member in iter_members(fileobj=fileobj):  # type: ignore
+                if member.name == MANIFEST_NAME:
+                    manifest = parse_manifest(member.content)
+                    continue
+
+                result.members += 1
+                hashes[member.name] = hashlib.sha256(member.content).hexdigest()
+    except (tarfile.TarError, EOFError, ManifestError) as error:
+        result.errors.append(f"corrupt or truncated archive: {error}")
+        return result
+    except (EncryptionError, GPGError) as error:
+        result.errors.append(f"decryption failed: {str(error).strip()}")
+        return result
+
+    if manifest is None:
+        logger.info(f"{backup.name} has no manifest, member hashes cannot be checked")
+        return result
+
+    result.has_manifest = True
+    result.errors.extend(compare_with_manifest(hashes=hashes, manifest=manifest))
+
+    return result
+
+
+def verify_seekable_backup(
+    backup: Path,
+    backend: EncryptionBackend | None,
+    limiter: BandwidthLimiter | None = None,
+) -> VerificationResult:
+    """
+    Decrypt every frame of a seekable archive, in memory, and check its hash against
+    the index. See `verify_backup`.
+    """
+    result = VerificationResult(backup=backup)
+    hashes: Manifest = {}
+
+    try:
+        with SeekableArchive(path=backup, backend=backend) as archive:
+            manifest = archive.manifest
+            for member in archive.iter_members():
+                if limiter:
+                    limiter.consume(len(member.content))
+
+                result.members += 1
+                hashes[member.name] = hashlib.sha256(member.content).hexdigest()
+    except SeekableArchiveError as error:
+        result.errors.append(f"corrupt or truncated archive: {error}")
+        return result
+    except (EncryptionError, GPGError) as error:
+        result.errors.append(f"decryption failed: {str(error).strip()}")
+        return result
+
+    result.has_manifest = True
+    result.errors.extend(compare_with_manifest(hashes=hashes, manifest=manifest))
+
+    return result
+
+
+def verify_snapshot(
+    store: DedupStore, backup: Path, limiter: BandwidthLimiter | None = None
+) -> VerificationResult:
+    """
+    Decrypt every blob of a deduplicated snapshot, in memory, and check that it matches
+    the hash it is named after. See `verify_backup`.
+    """
+    result = VerificationResult(backup=backup)
+
+    try:
+        snapshot = store.read_snapshot(name=backup.name)
+        for member in store.iter_members(snapshot_name=backup.name):
+            if limiter:
+                limiter.consume(len(member.content))
+
+            result.members += 1
+            if hashlib.sha256(member.content).hexdigest() != snapshot[member.name].blob:
+                result.errors.append(f"{member.name}: hash does not match the snapshot")
+    except (PackStoreError, DedupError) as error:
+        result.errors.append(f"corrupt or missing data: {error}")
+    except (EncryptionError, GPGError) as error:
+        result.errors.append(f"decryption failed: {str(error).strip()}")
+
+    result.has_manifest = True
+    return result
+
+
+def verify_backups(
+    config: Config,
+    backups: list[Path] | None = None,
+    jobs: int = 1,
+    bytes_per_second: int | None = None,
+) -> list[VerificationResult]:
+    """
+    Verify `backups` (every backup in `config.backup_dir` by default), up to `jobs` at a
+    time. If `bytes_per_second` is set, all backups together are read at most at that
+    rate, so that scheduled verifications do not compete with interactive work.
+    """
+    if backups is None:
+        backups = list_backups(config=config)
+
+    if not backups:
+        raise VerificationError(f"No backups found in {config.backup_dir}")
+
+    # Fail once here instead of once per backup
+    use_gpg = config.encryption_backend == "gpg"
+    if config.encrypt_backup and use_gpg and not is_gpg_installed():
+        raise EncryptionError("gpg is not installed")
+
+    backend = get_encryption_backend(config=config) if config.encrypt_backup else None
+
+    limiter = BandwidthLimiter(bytes_per_second) if bytes_per_second else None
+
+    def verify(backup: Path) -> VerificationResult:
+        if config.storage == "dedup":
+            store = DedupStore(dir=config.backup_dir, backend=backend)
+            return verify_snapshot(store=store, backup=backup, limiter=limiter)
+
+        try:
+            with open_backup(config=config, backup=backup) as path:
+                result = verify_backup(backup=path, backend=backend, limiter=limiter)
+        except PackStoreError as error:
+            return VerificationResult(
+                backup=backup, errors=[f"corrupt or missing data: {error}"]
+            )
+        return dataclasses.replace(result, backup=backup)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(verify, sorted(backups)))
+
+    for result in results:
+        if result.ok:
+            logger.info(f"{result.backup.name}: OK, {result.members} files")
+        else:
+            for error in result.errors:
+                logger.error(f"{result.backup.name}: {error}")
+
+    return results
@@ -0,0 +1,231 @@
+"""
+In-process encryption backend, so that no external process needs to be spawned to
+encrypt or decrypt a backup.
+
+Each backup is encrypted to an X25519 public key (the recipient) with an ephemeral key
+pair. The shared secret is expanded with HKDF-SHA256 into a ChaCha20-Poly1305 key, and
+the payload is encrypted in fixed size chunks so that it can be decrypted as a stream.
+The nonce of each chunk holds a counter and a flag that marks the last chunk, so that
+reordered, dropped or truncated chunks fail to decrypt.
+
+    encrypted file = HEADER | ephemeral public key (32 bytes) | chunk | ... | last chunk
+"""
+import base64
+import io
+import logging
+import os
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, BinaryIO, Iterator
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import (
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from direnv_backup.encrypt import EncryptionBackend, EncryptionError
+
+logger = logging.getLogger(__name__)
+
+HEADER = b"direnv-backup/x25519/v1\n"
+KEY_SIZE = 32
+TAG_SIZE = 16
+CHUNK_SIZE = 64 * 1024
+ENCRYPTED_CHUNK_SIZE = CHUNK_SIZE + TAG_SIZE
+
+
+def _raw(key: X25519PublicKey) -> bytes:
+    return key.public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+
+
+def _derive_key(shared_secret: bytes, ephemeral: bytes, recipient: bytes) -> bytes:
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_SIZE,
+        salt=ephemeral + recipient,
+        info=b"direnv-backup payload",
+    )
+    return hkdf.derive(shared_secret)
+
+
+def _nonce(counter: int, last: bool) -> bytes:
+    return counter.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+
+def generate_identity(path: Path) -> str:
+    """
+    Write a new private key to `path` and return its public key, to be used as the
+    `encryption_recipient` in the config.
+    """
+    private_key = X25519PrivateKey.generate()
+    raw_private_key = private_key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(base64.b64encode(raw_private_key).decode("ascii") + "\n")
+
+    return base64.b64encode(_raw(private_key.public_key())).decode("ascii")
+
+
+def load_recipient(recipient: str) -> X25519PublicKey:
+    try:
+        return X25519PublicKey.from_public_bytes(base64.b64decode(recipient))
+    except ValueError:
+        raise EncryptionError(f"Invalid x25519 recipient: {recipient!r}")
+
+
+def load_identity(path: Path) -> X25519PrivateKey:
+    try:
+        raw_private_key = base64.b64decode(path.read_text().strip())
+        return X25519PrivateKey.from_private_bytes(raw_private_key)
+    except FileNotFoundError:
+        raise EncryptionError(f"Identity file not found: {path}")
+    except ValueError:
+        raise EncryptionError(f"Invalid x25519 identity file: {path}")
+
+
+def encrypt_stream(source: IO[bytes], output: IO[bytes], recipient: str) -> None:
+    recipient_key = load_recipient(recipient)
+
+    ephemeral_key = X25519PrivateKey.generate()
+    ephemeral = _raw(ephemeral_key.public_key())
+    shared_secret = ephemeral_key.exchange(recipient_key)
+    aead = ChaCha20Poly1305(
+        _derive_key(shared_secret, ephemeral=ephemeral, recipient=_raw(recipient_key))
+    )
+
+    output.write(HEADER)
+    output.write(ephemeral)
+
+    # Read one chunk ahead to know which one is the last
+    counter = 0
+    chunk = source.read(CHUNK_SIZE)
+    while True:
+        next_chunk = source.read(CHUNK_SIZE)
+        last = not next_chunk
+        output.write(aead.encrypt(_nonce(counter, last), chunk, None))
+        if last:
+            break
+        chunk = next_chunk
+        counter += 1
+
+
+class DecryptingReader:
+    """
+    Read-only file object that decrypts `source` one chunk at a time.
+    """
+
+    def __init__(self, source: BinaryIO, identity: X25519PrivateKey) -> None:
+        self.source = source
+
+        if source.read(len(HEADER)) != HEADER:
+            raise EncryptionError("Not an x25519 encrypted backup")
+
+        ephemeral = source.read(KEY_SIZE)
+        if len(ephemeral) != KEY_SIZE:
+            raise EncryptionError("Truncated x25519 encrypted backup")
+
+        shared_secret = identity.exchange(X25519PublicKey.from_public_bytes(ephemeral))
+        recipient = _raw(identity.public_key())
+        self.aead = ChaCha20Poly1305(
+            _derive_key(shared_secret, ephemeral=ephemeral, recipient=recipient)
+        )
+
+        self.counter = 0
+        self.buffer = b""
+        self.finished = False
+        self.next_chunk = source.read(ENCRYPTED_CHUNK_SIZE)
+
+    def _decrypt_next_chunk(self) -> None:
+        chunk = self.next_chunk
+        self.next_chunk = self.source.read(ENCRYPTED_CHUNK_SIZE)
+        last = not self.next_chunk
+
+        try:
+            self.buffer += self.aead.decrypt(_nonce(self.counter, last), chunk, None)
+        except InvalidTag:
+            raise EncryptionError("Corrupt or truncated x25519 encrypted backup")
+
+        self.counter += 1
+        self.finished = last
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            self._decrypt_next_chunk()
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class X25519Backend(EncryptionBackend):
+    def __init__(self, recipient: str | None, identity: Path | None) -> None:
+        self.recipient = recipient
+        self.identity = identity
+        self._identity_key: X25519PrivateKey | None = None
+
+    def encrypt(self, path_to_encrypt: Path, encrypted_path: Path) -> None:
+        if not self.recipient:
+            raise EncryptionError("Config must specify a recipient to run encryption")
+
+        logger.debug(f"Encrypting {path_to_encrypt} to {encrypted_path}")
+        with path_to_encrypt.open("rb") as source, encrypted_path.open("wb") as output:
+            encrypt_stream(source=source, output=output, recipient=self.recipient)
+
+    def _load_identity(self) -> X25519PrivateKey:
+        if not self.identity:
+            raise EncryptionError(
+                "Config must specify an identity to decrypt x25519 backups"
+            )
+
+        # Read once, each frame of a seekable archive is decrypted on its own
+        if self._identity_key is None:
+            self._identity_key = load_identity(self.identity)
+        return self._identity_key
+
+    @contextmanager
+    def decrypt_stream(self, encrypted_path: Path) -> Iterator[IO[bytes]]:
+        identity = self._load_identity()
+
+        with encrypted_path.open("rb") as source:
+            reader = DecryptingReader(source=source, identity=identity)
+            yield reader  # type: ignore
+
+            # Authenticate whatever the caller left unread, to detect truncation
+            while reader.read(CHUNK_SIZE):
+                pass
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        if not self.recipient:
+            raise EncryptionError("Config must specify a recipient to run encryption")
+
+        output = io.BytesIO()
+        encrypt_stream(source=io.BytesIO(data), output=output, recipient=self.recipient)
+        return output.getvalue()
+
+    def decrypt_bytes(self, data: bytes) -> bytes:
+        reader = DecryptingReader(
+            source=io.BytesIO(data), identity=self._load_identity()
+        )
+        return reader.read()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(f"Usage: python -m {__spec__.name} <identity-path>")
+
+    print(generate_identity(path=Path(sys.argv[1])))
@@ -0,0 +1,76 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from direnv_backup.cli.main import main
+from direnv_backup.config import Config
+from tests.helpers.config import write_config
+from tests.helpers.direnv import create_sample_envrc_files
+
+REPO_DIR = Path(__file__).parents[2]
+
+# Only imported by the commands that need them
+LAZY_MODULES = {
+    "tarfile",
+    "subprocess",
+    "sqlite3",
+    "socketserver",
+    "direnv_backup.backup",
+    "direnv_backup.encrypt",
+    "direnv_backup.restore",
+}
+
+
+def imported_modules(code: str) -> set[str]:
+    """
+    Run `code` in a new interpreter, and return the modules it imported.
+    """
+    code += "\nimport sys; print('\\n'.join(sys.modules))"
+    process = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(process.stdout.split())
+
+
+def test_config_errors_are_reported_before_importing_the_backup_stack() -> None:
+    modules = imported_modules(
+        "from direnv_backup.cli.main import main; main(['--config', 'missing.json'])"
+    )
+
+    assert "direnv_backup.cli.main" in modules
+    assert not LAZY_MODULES & modules
+
+
+def test_backup_is_the_default_command() -> None:
+    assert main([]) == "Please specify a config (see --help)"
+    assert main(["--config", "missing.json"]) == (
+        "Provided path for the config file does not exit: missing.json"
+    )
+
+
+def test_subcommands(
+    unencrypted_config: Config, config_file: Path, capsys: pytest.CaptureFixture
+) -> None:
+    config = unencrypted_config
+    write_config(path=config_file, config=config)
+    create_sample_envrc_files(root_dir=config.root_dir)
+
+    assert main(["backup", "--config", str(config_file), "--no-daemon"]) is None
+    assert main(["list", "--config", str(config_file), "--no-daemon"]) is None
+    assert sorted(capsys.readouterr().out.split()) == [
+        "root_dir/.envrc",
+        "root_dir/bar/.envrc",
+        "root_dir/foo/.envrc",
+    ]
+
+    assert main(["verify", "--config", str(config_file), "--jobs", "0"]) == (
+        "--jobs must be a positive integer"
+    )
+    assert main(["prune", "--config", str(config_file)]) is None
+    assert len(list(config.backup_dir.glob("*.tar"))) == 1
@@ -39,11 +39,28 @@ def test_exit_if_config_is_not_valid(tmp_path: Path) -> None:
         "Provided config is missing the 'root_dir' field.\n"
         "The config should look like this:\n"
         "{\n"
+        '  "archive_format": <str>,\n'
         '  "backup_dir": <Path>,\n'
+        '  "cache_dir": <Path | None>,\n'
+        '  "destinations": <list[Destination]>,\n'
         '  "encrypt_backup": <bool>,\n'
+        '  "encryption_backend": <str>,\n'
+        '  "encryption_fingerprint": <str | None>,\n'
+        '  "encryption_identity": <Path | None>,\n'
         '  "encryption_recipient": <str | None>,\n'
         '  "exclude": <list[str]>,\n'
+        '  "follow_symlinks": <bool>,\n'
+        '  "gc_time_budget": <float>,\n'
+        '  "ionice_idle": <bool>,\n'
+        '  "nice": <int>,\n'
+        '  "one_file_system": <bool>,\n'
         '  "root_dir": <Path>,\n'
+        '  "s3": <S3Target | None>,\n'
+        '  "scan_time_budget": <float | None>,\n'
+        '  "storage": <str>,\n'
+        '  "throttle_io_pressure": <float | None>,\n'
+        '  "throttle_load": <float | None>,\n'
+        '  "throttle_time_budget": <float>,\n'
         "}\n"
         "\n"
     )
@@ -1,3 +1,4 @@
+import dataclasses
 import os
 from pathlib import Path
 from unittest import mock
@@ -17,10 +18,16 @@ def config(tmp_path: Path) -> Config:
         backup_dir=tmp_path / "backup_dir",
         encrypt_backup=True,
         encryption_recipient="john@doe.com",
+        cache_dir=tmp_path / "cache",
     )
     return config
 
 
+@pytest.fixture
+def unencrypted_config(config: Config) -> Config:
+    return dataclasses.replace(config, encrypt_backup=False, encryption_recipient=None)
+
+
 @pytest.fixture
 def config_file(tmp_path: Path, config: Config) -> Path:
     path = tmp_path / "config.json"
@@ -0,0 +1,137 @@
+"""
+Fixtures of the performance tests: a large tree of projects, created once per session
+on tmpfs so that the disk does not add noise to the measurements, and shims that count
+what the code under test does.
+"""
+import builtins
+import io
+import os
+import subprocess
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import pytest
+
+from direnv_backup.config import Config
+
+TMPFS_DIR = Path("/dev/shm")
+
+# Shape of the tree: every project has `SUBDIRS_PER_PROJECT` folders, each with
+# `FILES_PER_SUBDIR` files, and one project out of `PROJECTS_PER_ENVRC` has a direnv
+# file in each of its folders
+PROJECTS = 500
+SUBDIRS_PER_PROJECT = 20
+FILES_PER_SUBDIR = 3
+PROJECTS_PER_ENVRC = 5
+
+# File system calls counted by `count_fs_calls`, by module
+FS_CALLS = {
+    os: (
+        "stat",
+        "lstat",
+        "scandir",
+        "listdir",
+        "open",
+        "mkdir",
+        "chmod",
+        "replace",
+        "rename",
+        "unlink",
+        "utime",
+    ),
+    io: ("open",),
+    builtins: ("open",),
+}
+
+
+@dataclass(frozen=True)
+class ProjectTree:
+    root_dir: Path
+    dirs: int
+    envrcs: int
+
+
+def _create_tree(root_dir: Path) -> ProjectTree:
+    dirs = envrcs = 0
+    for project in range(PROJECTS):
+        for subdir in range(SUBDIRS_PER_PROJECT):
+            dir = root_dir / f"project-{project}" / "src" / f"module-{subdir}"
+            dir.mkdir(parents=True)
+            dirs += 1
+            for file in range(FILES_PER_SUBDIR):
+                (dir / f"file-{file}.py").write_text("pass\n")
+
+            if project % PROJECTS_PER_ENVRC == 0:
+                (dir / ".envrc").write_text(f"export MODULE={project}-{subdir}\n")
+                envrcs += 1
+
+    # The root, and every project-N and project-N/src
+    dirs += 1 + PROJECTS * 2
+    return ProjectTree(root_dir=root_dir, dirs=dirs, envrcs=envrcs)
+
+
+@pytest.fixture(scope="session")
+def tmpfs_dir() -> Iterator[Path]:
+    parent = TMPFS_DIR if TMPFS_DIR.is_dir() else None
+    with tempfile.TemporaryDirectory(prefix="direnv-backup-perf-", dir=parent) as dir:
+        yield Path(dir)
+
+
+@pytest.fixture(scope="session")
+def project_tree(tmpfs_dir: Path) -> ProjectTree:
+    return _create_tree(root_dir=tmpfs_dir / "projects")
+
+
+@pytest.fixture
+def perf_config(project_tree: ProjectTree, tmpfs_dir: Path, tmp_path: Path) -> Config:
+    backup_dir = Path(tempfile.mkdtemp(prefix="backups-", dir=tmpfs_dir))
+    return Config(
+        root_dir=project_tree.root_dir,
+        backup_dir=backup_dir,
+        exclude=set(),
+        encrypt_backup=False,
+        cache_dir=tmp_path / "cache",
+    )
+
+
+def _counting(name: str, function: Callable, calls: Counter) -> Callable:
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        calls[name] += 1
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def count_fs_calls() -> Iterator[Counter]:
+    """
+    Count the file system calls made by Python code inside the block, by name.
+    """
+    calls: Counter = Counter()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for module, names in FS_CALLS.items():
+            for name in names:
+                function = getattr(module, name)
+                monkeypatch.setattr(module, name, _counting(name, function, calls))
+        yield calls
+
+
+@contextmanager
+def count_subprocesses() -> Iterator[Counter]:
+    """
+    Count the processes started inside the block, by command.
+    """
+    calls: Counter = Counter()
+    init = subprocess.Popen.__init__
+
+    def counting_init(self: subprocess.Popen, args: Any, *rest: Any, **kw: Any) -> None:
+        calls[args[0] if isinstance(args, list) else args] += 1
+        init(self, args, *rest, **kw)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(subprocess.Popen, "__init__", counting_init)
+        yield calls
@@ -0,0 +1,96 @@
+"""
+Budgets of a backup of a large tree: scan throughput, peak memory, processes started
+and file system calls per file. Each budget leaves a wide margin over what is measured
+on a laptop, so that only a real regression fails them, not a busy CI runner.
+
+Run with `pytest -m performance`.
+"""
+import time
+import tracemalloc
+
+import pytest
+
+from direnv_backup.backup import backup, copy_snapshot_files, scan_direnv_files
+from direnv_backup.config import Config
+from direnv_backup.hashcache import HASH_CACHE_NAME, open_hash_cache
+from tests.performance.conftest import ProjectTree, count_fs_calls, count_subprocesses
+
+pytestmark = pytest.mark.performance
+
+# Directories scanned per second
+MIN_SCAN_THROUGHPUT = 5_000
+
+# Bytes allocated at the peak, by scanned directory
+MAX_SCAN_MEMORY_PER_DIR = 1_000
+
+# Bytes allocated at the peak, by copied file
+MAX_COPY_MEMORY_PER_FILE = 1_000
+
+# File system calls by scanned directory
+MAX_SCAN_CALLS_PER_DIR = 3
+
+# File system calls by copied file, on the first backup and when nothing changed
+MAX_COPY_CALLS_PER_FILE = 16
+
+
+def test_scan_throughput(perf_config: Config, project_tree: ProjectTree) -> None:
+    # Warms the page cache and the imports up
+    scan_direnv_files(config=perf_config)
+
+    start = time.perf_counter()
+    snapshot = scan_direnv_files(config=perf_config)
+    elapsed = time.perf_counter() - start
+
+    assert len(snapshot.files) == project_tree.envrcs
+    assert project_tree.dirs / elapsed >= MIN_SCAN_THROUGHPUT
+
+
+def test_scan_memory(perf_config: Config, project_tree: ProjectTree) -> None:
+    tracemalloc.start()
+    try:
+        scan_direnv_files(config=perf_config)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak / project_tree.dirs <= MAX_SCAN_MEMORY_PER_DIR
+
+
+def test_copy_memory(perf_config: Config, project_tree: ProjectTree) -> None:
+    snapshot = scan_direnv_files(config=perf_config)
+
+    tracemalloc.start()
+    try:
+        copy_snapshot_files(snapshot=snapshot, config=perf_config)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak / project_tree.envrcs <= MAX_COPY_MEMORY_PER_FILE
+
+
+def test_scan_fs_calls(perf_config: Config, project_tree: ProjectTree) -> None:
+    with count_fs_calls() as calls:
+        scan_direnv_files(config=perf_config)
+
+    assert calls["scandir"] == project_tree.dirs
+    assert sum(calls.values()) / project_tree.dirs <= MAX_SCAN_CALLS_PER_DIR
+
+
+def test_copy_fs_calls(perf_config: Config, project_tree: ProjectTree) -> None:
+    snapshot = scan_direnv_files(config=perf_config)
+    with open_hash_cache(perf_config.resolved_cache_dir / HASH_CACHE_NAME) as cache:
+        with count_fs_calls() as first:
+            copy_snapshot_files(snapshot=snapshot, config=perf_config, cache=cache)
+        with count_fs_calls() as cached:
+            copy_snapshot_files(snapshot=snapshot, config=perf_config, cache=cache)
+
+    assert sum(first.values()) / project_tree.envrcs <= MAX_COPY_CALLS_PER_FILE
+    assert sum(cached.values()) / project_tree.envrcs <= MAX_COPY_CALLS_PER_FILE
+
+
+def test_unencrypted_backup_starts_no_process(perf_config: Config) -> None:
+    with count_subprocesses() as processes:
+        backup(config=perf_config)
+
+    assert processes == {}
@@ -0,0 +1,40 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytestmark = pytest.mark.performance
+
+REPO_DIR = Path(__file__).parents[2]
+
+# Microseconds, of the imports done by `direnv-backup` before it reads the config
+IMPORT_TIME_BUDGET = 50_000
+
+
+def import_times(code: str) -> dict[str, int]:
+    """
+    Run `code` in a new interpreter, and return the cumulative import time of each
+    module it imported.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_time() -> None:
+    times = import_times(
+        "from direnv_backup.cli.main import main; main(['--config', 'missing.json'])"
+    )
+
+    assert times["direnv_backup.cli.main"] < IMPORT_TIME_BUDGET
@@ -0,0 +1,37 @@
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+from direnv_backup.archive import archive_dir
+from direnv_backup.backup import backup
+from direnv_backup.config import Config
+from tests.helpers.direnv import create_sample_envrc_files
+
+
+def test_archives_are_reproducible(tmp_path: Path) -> None:
+    dir = tmp_path / "dir"
+    create_sample_envrc_files(root_dir=dir)
+
+    first = archive_dir(dir=dir, base=tmp_path, output=tmp_path / "first.tar")
+    for path in dir.rglob("*"):
+        os.utime(path, ns=(0, 0))
+    second = archive_dir(dir=dir, base=tmp_path, output=tmp_path / "second.tar")
+
+    assert first.read_bytes() == second.read_bytes()
+
+
+def test_unchanged_unencrypted_backup_is_skipped(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+
+    names = iter(["20220101-000000", "20220101-010000", "20220101-020000"])
+    with patch("direnv_backup.backup.build_backup_filename", lambda: next(names)):
+        backup(config=config)
+        backup(config=config)
+        (config.root_dir / ".envrc").write_text("changed")
+        backup(config=config)
+
+    assert sorted(path.name for path in config.backup_dir.glob("*.tar")) == [
+        "20220101-000000.tar",
+        "20220101-020000.tar",
+    ]
@@ -4,7 +4,8 @@ from unittest.mock import MagicMock, patch
 
 import pytest
 
-from direnv_backup.cli.backup import backup, main
+from direnv_backup.backup import backup
+from direnv_backup.cli.backup import main
 from direnv_backup.config import Config
 from direnv_backup.restore import restore_backup
 from tests.helpers.config import write_config
@@ -57,6 +58,11 @@ def test_backup_and_restore_with_encryption(config: Config) -> None:
         # Assert
         assert_all_envrc_files_are_in_place(root_dir=config.root_dir)
 
+        # Assert: the decrypted archive was never written to disk
+        files_in_backup_dir = [p for p in config.backup_dir.rglob("*") if p.is_file()]
+        assert len(files_in_backup_dir) == 1
+        assert files_in_backup_dir[0].suffixes == [".gpg"]
+
 
 @pytest.mark.skipif(not inside_container(), reason="must run in container")
 def test_backup_and_restore_without_encryption(config: Config) -> None:
@@ -70,6 +76,7 @@ def test_backup_and_restore_without_encryption(config: Config) -> None:
         backup_dir=config.backup_dir,
         encrypt_backup=False,
         encryption_recipient=None,
+        cache_dir=config.cache_dir,
     )
 
     with AutoCleaningEnvironment(
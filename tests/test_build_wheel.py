@@ -31,7 +31,13 @@ def build_wheel(output_dir: Path) -> Path:
 
 @pytest.mark.skipif(not inside_container(), reason="must run in container")
 def test_build_and_install_wheel(tmp_path: Path) -> None:
-    commands = ["direnv-backup", "direnv-restore"]
+    commands = [
+        "direnv-backup",
+        "direnv-restore",
+        "direnv-backup-verify",
+        "direnv-backup-compact",
+        "direnv-backup-daemon",
+    ]
 
     # ----------------------------------------------------------------------------------
     #  build wheel
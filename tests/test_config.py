@@ -1,6 +1,9 @@
+import dataclasses
 from pathlib import Path
 
-from direnv_backup.config import Config
+import pytest
+
+from direnv_backup.config import Config, ConfigError, validate_config
 
 
 def test_encryption_is_enabled_by_default():
@@ -12,10 +15,61 @@ def test_encryption_is_enabled_by_default():
 def test_get_config_template_json():
     assert Config.expected_json == (  # type: ignore
         "{\n"
+        '  "archive_format": <str>,\n'
         '  "backup_dir": <Path>,\n'
+        '  "cache_dir": <Path | None>,\n'
+        '  "destinations": <list[Destination]>,\n'
         '  "encrypt_backup": <bool>,\n'
+        '  "encryption_backend": <str>,\n'
+        '  "encryption_fingerprint": <str | None>,\n'
+        '  "encryption_identity": <Path | None>,\n'
         '  "encryption_recipient": <str | None>,\n'
         '  "exclude": <list[str]>,\n'
+        '  "follow_symlinks": <bool>,\n'
+        '  "gc_time_budget": <float>,\n'
+        '  "ionice_idle": <bool>,\n'
+        '  "nice": <int>,\n'
+        '  "one_file_system": <bool>,\n'
         '  "root_dir": <Path>,\n'
+        '  "s3": <S3Target | None>,\n'
+        '  "scan_time_budget": <float | None>,\n'
+        '  "storage": <str>,\n'
+        '  "throttle_io_pressure": <float | None>,\n'
+        '  "throttle_load": <float | None>,\n'
+        '  "throttle_time_budget": <float>,\n'
         "}"
     )
+
+
+@pytest.mark.parametrize(
+    "setting",
+    [
+        {"gc_time_budget": 0},
+        {"gc_time_budget": -1},
+        {"scan_time_budget": 0},
+        {"scan_time_budget": float("nan")},
+        {"throttle_load": -0.5},
+        {"throttle_load": True},
+        {"throttle_io_pressure": 0},
+        {"throttle_io_pressure": 150},
+        {"throttle_io_pressure": "10"},
+        {"throttle_time_budget": 0},
+        {"throttle_time_budget": float("inf")},
+    ],
+)
+def test_reject_invalid_budgets_and_throttles(config: Config, setting: dict) -> None:
+    with pytest.raises(ConfigError):
+        validate_config(dataclasses.replace(config, **setting))
+
+
+def test_accept_budgets_and_throttles(config: Config) -> None:
+    validate_config(
+        dataclasses.replace(
+            config,
+            gc_time_budget=0.5,
+            scan_time_budget=60,
+            throttle_load=1.5,
+            throttle_io_pressure=100,
+            throttle_time_budget=30,
+        )
+    )
@@ -0,0 +1,77 @@
+import dataclasses
+import json
+import os
+from pathlib import Path
+from typing import Iterator
+from unittest.mock import patch
+
+import pytest
+
+from direnv_backup import configcache
+from direnv_backup.config import Config
+from direnv_backup.configcache import cache_path, read_compiled_config
+from tests.helpers.config import write_config
+
+FINGERPRINT = "0123456789ABCDEF0123456789ABCDEF01234567"
+
+
+@pytest.fixture
+def gpg_lookups() -> Iterator[list[str]]:
+    lookups: list[str] = []
+
+    def fake_lookup(email: str) -> str:
+        lookups.append(email)
+        return FINGERPRINT
+
+    with patch("direnv_backup.encrypt.gpg_key_fingerprint", fake_lookup):
+        yield lookups
+
+
+def test_compiled_config_is_reused(
+    config: Config, config_file: Path, gpg_lookups: list[str]
+) -> None:
+    compiled = read_compiled_config(path=config_file)
+    assert compiled.encryption_fingerprint == FINGERPRINT
+    assert compiled.backup_dir == config.backup_dir
+    assert cache_path(config_file).exists()
+
+    with patch.object(configcache, "read_config") as read_config:
+        assert read_compiled_config(path=config_file) == compiled
+
+    read_config.assert_not_called()
+    assert gpg_lookups == ["john@doe.com"]
+
+
+def test_changed_config_is_compiled_again(
+    config: Config, config_file: Path, gpg_lookups: list[str]
+) -> None:
+    read_compiled_config(path=config_file)
+
+    # Same size and modification time, only the content tells them apart
+    stat = config_file.stat()
+    write_config(path=config_file, config=dataclasses.replace(config, nice=5))
+    os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert read_compiled_config(path=config_file).nice == 5
+
+
+def test_environment_variables_are_interpolated(
+    tmp_path: Path, config_file: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    data = json.loads(config_file.read_text())
+    data.update(root_dir="${PROJECTS}/code", encrypt_backup=False)
+    config_file.write_text(json.dumps(data))
+
+    monkeypatch.setenv("PROJECTS", str(tmp_path / "a"))
+    assert read_compiled_config(path=config_file).root_dir == tmp_path / "a" / "code"
+
+    monkeypatch.setenv("PROJECTS", str(tmp_path / "b"))
+    assert read_compiled_config(path=config_file).root_dir == tmp_path / "b" / "code"
+
+
+def test_failed_key_lookup_is_not_cached(config_file: Path) -> None:
+    with patch("direnv_backup.encrypt.gpg_key_fingerprint", return_value=None):
+        compiled = read_compiled_config(path=config_file)
+
+    assert compiled.encryption_fingerprint is None
+    assert not cache_path(config_file).exists()
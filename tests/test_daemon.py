@@ -0,0 +1,207 @@
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from direnv_backup import daemon
+from direnv_backup.cli.backup import main as backup_main
+from direnv_backup.cli.main import main
+from direnv_backup.config import Config
+from direnv_backup.daemon import BackupDaemon, DaemonError, request
+from tests.helpers.config import write_config
+from tests.helpers.direnv import create_sample_envrc_files
+
+REPO_DIR = Path(__file__).parents[1]
+
+
+@pytest.fixture
+def plain_config(unencrypted_config: Config, config_file: Path) -> Config:
+    config = unencrypted_config
+    write_config(path=config_file, config=config)
+    create_sample_envrc_files(root_dir=config.root_dir)
+    return config
+
+
+@pytest.fixture
+def socket_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "run"))
+    return daemon.default_socket_path()
+
+
+@pytest.fixture
+def running_daemon(
+    plain_config: Config, config_file: Path, socket_path: Path
+) -> Iterator[BackupDaemon]:
+    backup_daemon = BackupDaemon(config_path=config_file, socket_path=socket_path)
+    ready = threading.Event()
+    thread = threading.Thread(target=backup_daemon.serve_forever, args=(ready,))
+    thread.start()
+    assert ready.wait(timeout=5)
+
+    yield backup_daemon
+
+    backup_daemon.shutdown()
+    thread.join()
+
+
+def test_backup_and_list_through_daemon(
+    running_daemon: BackupDaemon, plain_config: Config, config_file: Path
+) -> None:
+    assert backup_main(["--config", str(config_file)]) is None
+    assert running_daemon.last_backup is not None
+    assert running_daemon.last_backup["error"] is None
+    assert len(list(plain_config.backup_dir.glob("*.tar"))) == 1
+
+    response = request(command="list", config_path=config_file)
+    assert response is not None
+    assert sorted(response.result) == [
+        "root_dir/.envrc",
+        "root_dir/bar/.envrc",
+        "root_dir/foo/.envrc",
+    ]
+
+
+def test_scan_index_is_kept_between_backups(
+    running_daemon: BackupDaemon, plain_config: Config, config_file: Path
+) -> None:
+    request(command="backup", config_path=config_file)
+    assert len(running_daemon.scan_index) == 3
+
+    (plain_config.root_dir / "baz").mkdir()
+    (plain_config.root_dir / "baz" / ".envrc").write_text("baz")
+    request(command="backup", config_path=config_file)
+
+    response = request(command="status", config_path=config_file)
+    assert response is not None
+    assert response.result["indexed_dirs"] == 4
+
+
+def test_errors_are_sent_back(running_daemon: BackupDaemon, config_file: Path) -> None:
+    response = request(command="verify", config_path=config_file)
+    assert response == daemon.Response(error="Unknown command 'verify'")
+
+    # Unexpected errors do not stop the daemon
+    response = request(command="list", config_path=config_file)
+    assert response is not None
+    assert response.error is not None
+    assert request(command="status", config_path=config_file) is not None
+
+
+def test_other_config_runs_in_process(
+    running_daemon: BackupDaemon, tmp_path: Path, plain_config: Config
+) -> None:
+    other_config_file = tmp_path / "other.json"
+    write_config(path=other_config_file, config=plain_config)
+
+    assert request(command="backup", config_path=other_config_file) is None
+    assert backup_main(["--config", str(other_config_file)]) is None
+    assert running_daemon.last_backup is None
+
+
+def test_no_daemon(socket_path: Path, config_file: Path) -> None:
+    assert request(command="status", config_path=config_file) is None
+
+
+def test_only_one_daemon_per_socket(
+    running_daemon: BackupDaemon, config_file: Path, socket_path: Path
+) -> None:
+    with pytest.raises(DaemonError, match="already running"):
+        BackupDaemon(config_path=config_file, socket_path=socket_path).serve_forever()
+
+
+def test_restore_relative_file_through_daemon_in_other_cwd(
+    plain_config: Config,
+    config_file: Path,
+    socket_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # Unlike `running_daemon`, a process of its own, with its own working directory
+    process = subprocess.Popen(
+        [sys.executable, "-m", "direnv_backup.cli.main", "daemon"]
+        + ["--config", str(config_file)],
+        cwd="/",
+        env={**os.environ, "PYTHONPATH": str(REPO_DIR)},
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while not daemon.is_listening(socket_path):
+            assert time.monotonic() < deadline, "the daemon did not start"
+            time.sleep(0.05)
+
+        assert request(command="backup", config_path=config_file) == daemon.Response()
+        envrc = plain_config.root_dir / "foo" / ".envrc"
+        envrc.write_text("modified after backup")
+
+        monkeypatch.chdir(envrc.parent)
+        assert (
+            main(["restore", "--config", str(config_file), "--file", ".envrc"]) is None
+        )
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    assert envrc.read_text() == "foo"
+
+
+def test_socket_dir_of_another_user_is_not_trusted(
+    running_daemon: BackupDaemon, config_file: Path, socket_path: Path
+) -> None:
+    socket_path.parent.chmod(0o755)
+
+    assert request(command="status", config_path=config_file) is None
+    with pytest.raises(DaemonError, match="mode 0700"):
+        BackupDaemon(config_path=config_file, socket_path=socket_path).serve_forever()
+
+
+def test_daemon_of_another_user_is_not_trusted(
+    running_daemon: BackupDaemon,
+    config_file: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(daemon, "peer_uid", lambda _: os.getuid() + 1)
+
+    assert request(command="backup", config_path=config_file) is None
+    assert running_daemon.last_backup is None
+
+
+def test_restore_summary_is_sent_back(
+    running_daemon: BackupDaemon,
+    plain_config: Config,
+    config_file: Path,
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    request(command="backup", config_path=config_file)
+    (plain_config.root_dir / "foo" / ".envrc").write_text("modified after backup")
+
+    response = request(command="restore", config_path=config_file)
+    assert response == daemon.Response(
+        result={"unchanged": 2, "updated": 1, "created": 0}
+    )
+
+    (plain_config.root_dir / "foo" / ".envrc").write_text("modified again")
+    caplog.set_level(logging.DEBUG)
+    assert main(["restore", "--config", str(config_file)]) is None
+
+    assert "Request served by the daemon" in caplog.messages
+    assert "Restore summary: 2 unchanged, 1 updated, 0 created" in caplog.messages
+
+
+def test_malformed_response_runs_in_process(
+    running_daemon: BackupDaemon,
+    plain_config: Config,
+    config_file: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(running_daemon, "handle", lambda message: {"unexpected": 1})
+
+    with pytest.raises(DaemonError, match="Malformed response"):
+        request(command="backup", config_path=config_file)
+
+    assert backup_main(["--config", str(config_file)]) is None
+    assert len(list(plain_config.backup_dir.glob("*.tar"))) == 1
@@ -0,0 +1,84 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from direnv_backup.dedup import BLOB_PREFIX, GC_STATE_NAME, DedupStore
+from direnv_backup.store import PackStore
+
+
+@pytest.fixture
+def store(tmp_path: Path) -> DedupStore:
+    return DedupStore(dir=tmp_path / "store", backend=None)
+
+
+def snapshot_files(store: DedupStore, tmp_path: Path, name: str, **files: str) -> None:
+    dir = tmp_path / name
+    for file_name, content in files.items():
+        (dir / file_name).parent.mkdir(parents=True, exist_ok=True)
+        (dir / file_name).write_text(content)
+
+    store.write_snapshot(name=f"{name}.snapshot", dir=dir, base=dir)
+
+
+def blobs(store: DedupStore) -> int:
+    return sum(name.startswith(BLOB_PREFIX) for name in store.packs.names())
+
+
+def read_files(store: DedupStore, name: str) -> dict[str, bytes]:
+    members = store.iter_members(snapshot_name=f"{name}.snapshot")
+    return {member.name: member.content for member in members}
+
+
+def test_identical_files_are_stored_once(store: DedupStore, tmp_path: Path) -> None:
+    snapshot_files(store, tmp_path, "1", a="same", b="same", c="other")
+    snapshot_files(store, tmp_path, "2", a="same", c="other")
+
+    assert blobs(store) == 2
+    assert read_files(store, "1") == {"a": b"same", "b": b"same", "c": b"other"}
+    assert store.snapshots() == ["1.snapshot", "2.snapshot"]
+
+
+def test_gc_frees_only_unreferenced_blobs(store: DedupStore, tmp_path: Path) -> None:
+    snapshot_files(store, tmp_path, "1", a="old", b="shared")
+    snapshot_files(store, tmp_path, "2", a="new", b="shared")
+
+    store.remove_snapshots(["1.snapshot"])
+    summary = store.collect_garbage(time_budget=60)
+
+    assert summary.finished and summary.swept == 1
+    assert blobs(store) == 2
+    assert read_files(store, "2") == {"a": b"new", "b": b"shared"}
+    assert not (store.dir / GC_STATE_NAME).exists()
+
+
+def test_gc_resumes_across_runs(store: DedupStore, tmp_path: Path) -> None:
+    snapshot_files(store, tmp_path, "1", a="old")
+    snapshot_files(store, tmp_path, "2", a="new")
+    store.remove_snapshots(["1.snapshot"])
+
+    for _ in range(3):
+        assert not store.collect_garbage(time_budget=0).finished
+    assert blobs(store) == 2
+
+    # Created mid cycle, and shares the blob of the removed snapshot
+    snapshot_files(store, tmp_path, "3", a="old")
+
+    assert store.collect_garbage(time_budget=60).finished
+    assert read_files(store, "3") == {"a": b"old"}
+    assert blobs(store) == 2
+
+
+def test_interrupted_gc_is_safe(store: DedupStore, tmp_path: Path) -> None:
+    snapshot_files(store, tmp_path, "1", a="old")
+    snapshot_files(store, tmp_path, "2", a="new")
+    store.remove_snapshots(["1.snapshot"])
+
+    with patch.object(PackStore, "remove", side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            store.collect_garbage(time_budget=60)
+    assert (store.dir / GC_STATE_NAME).exists()
+
+    assert store.collect_garbage(time_budget=60).finished
+    assert blobs(store) == 1
+    assert read_files(store, "2") == {"a": b"new"}
@@ -0,0 +1,166 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from direnv_backup.config import Config
+from direnv_backup.encrypt import (
+    EncryptionError,
+    GPGBackend,
+    GPGError,
+    GPGSession,
+    parse_gpg_stderr,
+)
+from tests.helpers.docker import inside_container
+from tests.helpers.environment import AutoCleaningEnvironment
+from tests.helpers.gpg import GPGKey
+
+
+def test_parse_gpg_stderr() -> None:
+    stderr = (
+        "[GNUPG:] FILE_START 3 foo bar.gpg\n"
+        "gpg: no valid OpenPGP data found.\n"
+        "[GNUPG:] NODATA 1\n"
+        "[GNUPG:] FILE_DONE\n"
+    )
+
+    statuses, messages = parse_gpg_stderr(stderr)
+
+    assert [(s.keyword, s.arguments) for s in statuses] == [
+        ("FILE_START", ("3", "foo", "bar.gpg")),
+        ("NODATA", ("1",)),
+        ("FILE_DONE", ()),
+    ]
+    assert messages == ["gpg: no valid OpenPGP data found."]
+
+
+@patch("direnv_backup.encrypt.email_has_gpg_key_associated")
+@patch("direnv_backup.encrypt.is_gpg_installed")
+def test_session_probes_gpg_and_keys_once(
+    mocked_is_gpg_installed: MagicMock,
+    mocked_email_has_gpg_key_associated: MagicMock,
+) -> None:
+    mocked_is_gpg_installed.return_value = True
+    mocked_email_has_gpg_key_associated.return_value = False
+    session = GPGSession()
+
+    for _ in range(3):
+        session.ensure_gpg_installed()
+        with pytest.raises(EncryptionError):
+            session.ensure_recipient_has_key(recipient="john@doe.com")
+
+    assert mocked_is_gpg_installed.call_count == 1
+    assert mocked_email_has_gpg_key_associated.call_count == 1
+
+
+@pytest.mark.skipif(not inside_container(), reason="must run in container")
+def test_encrypt_and_decrypt_many_files_in_one_go(
+    tmp_path: Path, config: Config
+) -> None:
+    assert config.encryption_recipient
+    gpg_key = GPGKey(name="foo", email=config.encryption_recipient)
+
+    paths = [tmp_path / f"item-{i}" for i in range(1000)]
+    for i, path in enumerate(paths):
+        path.write_text(f"export ITEM={i}")
+
+    with AutoCleaningEnvironment(root_dir=config.root_dir, gpg_key=gpg_key):
+        session = GPGSession()
+
+        start = time.monotonic()
+        results = session.encrypt_files(paths, recipient=config.encryption_recipient)
+        assert all(result.ok for result in results)
+
+        encrypted_paths = [path.with_suffix(".gpg") for path in paths]
+        for path in paths:
+            path.unlink()
+        encrypted_paths[1].write_bytes(b"corrupt")
+
+        encrypted = [path.read_bytes() for path in encrypted_paths]
+        decrypted = session.decrypt_many(encrypted[:1] + encrypted[2:])
+        with pytest.raises(GPGError, match="failed to process 1.gpg"):
+            session.decrypt_many(encrypted[:3])
+        elapsed = time.monotonic() - start
+
+    assert decrypted[:2] == [b"export ITEM=0", b"export ITEM=2"]
+    assert len(decrypted) == 999
+    assert elapsed < 30
+
+
+def test_hung_gpg_is_reported_as_gpg_error(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # Mimic a gpg that waits forever on a pinentry that never shows up
+    fake_gpg = tmp_path / "bin" / "gpg"
+    fake_gpg.parent.mkdir()
+    fake_gpg.write_text("#!/bin/sh\nsleep 30\n")
+    fake_gpg.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{fake_gpg.parent}:{os.environ['PATH']}")
+
+    session = GPGSession(timeout=0.5)
+    session._agent_started = True
+
+    start = time.monotonic()
+    with pytest.raises(GPGError, match="timed out after 0.5s"):
+        session.decrypt_bytes(b"foo")
+
+    assert time.monotonic() - start < 5
+
+
+# A gpg that "decrypts" named pipes to named pipes, fails on "corrupt" data, and logs
+# each of its runs
+FAKE_GPG = """#!/bin/sh
+echo run >> "$(dirname "$0")/runs"
+for path in "$@"; do
+    case "$path" in *.gpg) ;; *) continue ;; esac
+    echo "[GNUPG:] FILE_START 3 $path" >&2
+    [ -p "$path" ] && [ -p "${path%.gpg}" ] || exit 2
+    data=$(cat "$path")
+    if [ "$data" = corrupt ]; then
+        echo "[GNUPG:] NODATA 1" >&2
+    else
+        printf %s "$data" > "${path%.gpg}"
+        echo "[GNUPG:] DECRYPTION_OKAY" >&2
+    fi
+    echo "[GNUPG:] FILE_DONE" >&2
+done
+"""
+
+
+@pytest.fixture
+def fake_gpg_backend(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> GPGBackend:
+    fake_gpg = tmp_path / "bin" / "gpg"
+    fake_gpg.parent.mkdir()
+    fake_gpg.write_text(FAKE_GPG)
+    fake_gpg.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{fake_gpg.parent}:{os.environ['PATH']}")
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+
+    backend = GPGBackend(recipient=None)
+    backend.session._gpg_installed = True
+    backend.session._agent_started = True
+    return backend
+
+
+def test_gpg_backend_decrypts_many_frames_in_memory(
+    tmp_path: Path, fake_gpg_backend: GPGBackend
+) -> None:
+    frames = [f"export ITEM={i}".encode() for i in range(20)]
+
+    assert fake_gpg_backend.decrypt_many(frames) == frames
+    assert (tmp_path / "bin" / "runs").read_text() == "run\n"
+    assert [path.name for path in tmp_path.iterdir()] == ["bin"]
+
+
+def test_gpg_backend_reports_frames_that_fail_to_decrypt(
+    tmp_path: Path, fake_gpg_backend: GPGBackend
+) -> None:
+    start = time.monotonic()
+    with pytest.raises(GPGError, match="failed to process 1.gpg"):
+        fake_gpg_backend.decrypt_many([b"export A=1", b"corrupt", b"export B=2"])
+
+    assert time.monotonic() - start < 5
+    assert [path.name for path in tmp_path.iterdir()] == ["bin"]
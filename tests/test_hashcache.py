@@ -0,0 +1,79 @@
+import hashlib
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from direnv_backup import hashcache
+from direnv_backup.backup import backup
+from direnv_backup.config import Config
+from direnv_backup.hashcache import HASH_CACHE_NAME, open_hash_cache
+from tests.helpers.direnv import SAMPLE_ENVRC_FILES, create_sample_envrc_files
+
+
+def write_old_file(path: Path, content: bytes) -> None:
+    path.write_bytes(content)
+    os.utime(path, (1, 1))
+
+
+@pytest.fixture
+def cache_path(tmp_path: Path) -> Path:
+    return tmp_path / "cache" / HASH_CACHE_NAME
+
+
+def test_unchanged_files_are_not_read_again(tmp_path: Path, cache_path: Path) -> None:
+    path = tmp_path / ".envrc"
+    write_old_file(path, b"export FOO=1")
+
+    with open_hash_cache(cache_path) as cache:
+        assert cache.hash_file(path) == hashlib.sha256(b"export FOO=1").hexdigest()
+
+    with patch.object(hashcache, "hash_file") as hash_file:
+        with open_hash_cache(cache_path) as cache:
+            cache.hash_file(path)
+    hash_file.assert_not_called()
+
+    write_old_file(path, b"export FOO=22")
+    with open_hash_cache(cache_path) as cache:
+        assert cache.hash_file(path) == hashlib.sha256(b"export FOO=22").hexdigest()
+        assert cache.misses == 1
+
+
+def test_recently_modified_files_are_not_cached(
+    tmp_path: Path, cache_path: Path
+) -> None:
+    path = tmp_path / ".envrc"
+    path.write_bytes(b"export FOO=1")
+
+    for _ in range(2):
+        with open_hash_cache(cache_path) as cache:
+            cache.hash_file(path)
+            assert cache.misses == 1
+
+
+def test_missing_files_are_evicted(tmp_path: Path, cache_path: Path) -> None:
+    paths = [tmp_path / "a", tmp_path / "b"]
+    for path in paths:
+        write_old_file(path, path.name.encode())
+
+    with open_hash_cache(cache_path) as cache:
+        for path in paths:
+            cache.hash_file(path)
+
+    paths[0].unlink()
+    with open_hash_cache(cache_path) as cache:
+        assert cache.evict_missing() == 1
+
+
+def test_backup_uses_the_cache(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    for envrc in SAMPLE_ENVRC_FILES:
+        os.utime(config.root_dir / envrc.path, (1, 1))
+
+    backup(config=config)
+    with patch.object(hashcache, "hash_file") as hash_file:
+        backup(config=config)
+
+    hash_file.assert_not_called()
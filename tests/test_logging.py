@@ -0,0 +1,63 @@
+import json
+import logging
+import subprocess
+import sys
+from pathlib import Path
+
+from direnv_backup.logging import JsonFormatter
+
+REPO_DIR = Path(__file__).parents[1]
+
+
+def test_json_formatter() -> None:
+    try:
+        raise OSError("disk full")
+    except OSError:
+        record = logging.LogRecord(
+            name="direnv_backup.backup",
+            level=logging.ERROR,
+            pathname=__file__,
+            lineno=1,
+            msg="Failed to copy %s",
+            args=("foo/.envrc",),
+            exc_info=sys.exc_info(),
+        )
+    record.stage = "backup"
+    record.path = "foo/.envrc"
+
+    event = json.loads(JsonFormatter().format(record))
+
+    assert event["level"] == "ERROR"
+    assert event["message"] == "Failed to copy foo/.envrc"
+    assert event["stage"] == "backup"
+    assert event["path"] == "foo/.envrc"
+    assert "bytes" not in event
+    assert "OSError: disk full" in event["traceback"]
+
+
+def test_json_logs_are_written_by_a_background_thread() -> None:
+    code = "\n".join(
+        [
+            "import logging, threading",
+            "from direnv_backup.logging import set_up_logging_config",
+            "set_up_logging_config(debug_mode_on=False, log_format='json')",
+            "logger = logging.getLogger('direnv_backup.backup')",
+            "logger.info('%s backed up', 'foo/.envrc', extra={'bytes': 12})",
+            "logger.debug('not logged')",
+            "logger.info('threads: %d', threading.active_count())",
+        ]
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    events = [json.loads(line) for line in process.stderr.splitlines()]
+    assert [event["message"] for event in events] == [
+        "foo/.envrc backed up",
+        "threads: 2",
+    ]
+    assert events[0]["bytes"] == 12
@@ -0,0 +1,55 @@
+import threading
+import time
+
+import pytest
+
+from direnv_backup.process import (
+    ProcessCancelled,
+    ProcessError,
+    ProcessTimeout,
+    SupervisedProcess,
+    run,
+)
+
+
+def test_run_returns_output() -> None:
+    result = run(["cat"], timeout=5, input=b"foo")
+
+    assert result.returncode == 0
+    assert result.stdout == b"foo"
+
+
+def test_run_raises_structured_error_on_failure() -> None:
+    with pytest.raises(ProcessError) as error:
+        run(["sh", "-c", "echo oops >&2; exit 3"], timeout=5)
+
+    assert error.value.returncode == 3
+    assert error.value.stderr == "oops\n"
+    assert str(error.value) == "'sh -c' failed with exit status 3"
+
+
+def test_hung_process_is_killed_after_timeout() -> None:
+    start = time.monotonic()
+
+    with pytest.raises(ProcessTimeout) as error:
+        run(["sleep", "30"], timeout=0.5)
+
+    assert time.monotonic() - start < 5
+    assert str(error.value) == "'sleep 30' timed out after 0.5s and was killed"
+
+
+def test_process_is_killed_when_cancelled() -> None:
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+
+    with pytest.raises(ProcessCancelled):
+        run(["sleep", "30"], timeout=30, cancel=cancel)
+
+
+def test_streamed_process_is_killed_if_the_reader_fails() -> None:
+    with pytest.raises(ValueError):
+        with SupervisedProcess(["yes"], timeout=30) as process:
+            process.stdout.read(10)
+            raise ValueError()
+
+    assert process.returncode is not None
@@ -0,0 +1,52 @@
+import json
+import pstats
+from pathlib import Path
+
+import pytest
+
+from direnv_backup.cli.main import main
+from direnv_backup.config import Config
+from tests.helpers.config import write_config
+from tests.helpers.direnv import create_sample_envrc_files
+
+
+@pytest.fixture
+def plain_config_file(unencrypted_config: Config, config_file: Path) -> Path:
+    config = unencrypted_config
+    write_config(path=config_file, config=config)
+    create_sample_envrc_files(root_dir=config.root_dir)
+    return config_file
+
+
+def run_profiled(config_file: Path, profile: str) -> Path:
+    args = ["backup", "--config", str(config_file), "--no-daemon", "--profile", profile]
+    assert main(args) is None
+
+    [path] = config_file.parent.glob(f"{config_file.stem}.backup-*")
+    return path
+
+
+def test_cpu_profile(plain_config_file: Path) -> None:
+    path = run_profiled(plain_config_file, profile="cpu")
+
+    assert path.suffix == ".pstats"
+    assert pstats.Stats(str(path)).total_calls > 0
+
+
+def test_alloc_profile(plain_config_file: Path) -> None:
+    path = run_profiled(plain_config_file, profile="alloc")
+
+    assert path.read_text().startswith("Peak: ")
+
+
+def test_trace_profile(plain_config_file: Path) -> None:
+    path = run_profiled(plain_config_file, profile="trace")
+
+    events = json.loads(path.read_text())["traceEvents"]
+    names = [event["name"] for event in events]
+    assert {"backup", "scan", "copy", "archive", "retention"} <= set(names)
+
+    backup = events[names.index("backup")]
+    scan = events[names.index("scan")]
+    assert backup["ts"] <= scan["ts"]
+    assert scan["ts"] + scan["dur"] <= backup["ts"] + backup["dur"]
@@ -0,0 +1,63 @@
+import io
+import logging
+
+import pytest
+
+from direnv_backup import progress
+from direnv_backup.progress import Progress, format_duration
+
+
+class FakeTerminal(io.StringIO):
+    def isatty(self) -> bool:
+        return True
+
+
+def test_format_duration() -> None:
+    assert format_duration(0) == "0:00:00"
+    assert format_duration(3725.4) == "1:02:05"
+
+
+def test_terminal_is_redrawn_at_most_once_per_interval() -> None:
+    terminal = FakeTerminal()
+
+    with Progress(stage="Backup", total=10_000, stream=terminal) as bar:
+        for _ in range(10_000):
+            bar.advance(bytes=1024)
+
+    # Only the final redraw, the loop is faster than the redraw interval
+    lines = terminal.getvalue().split("\r")[1:]
+    assert len(lines) == 1
+    assert "Backup [########################] 10000/10000 files" in lines[0]
+    assert lines[0].endswith("\n")
+
+
+def test_periodic_log_lines_when_not_interactive(
+    monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    monkeypatch.setattr(progress, "LOG_INTERVAL", 0)
+    caplog.set_level(logging.INFO, logger=progress.__name__)
+
+    with Progress(stage="Backup", total=4, stream=io.StringIO()) as bar:
+        bar.advance(bytes=progress.MIB)
+        bar.advance(bytes=progress.MIB)
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages[0].startswith("Backup: 1/4 files, 1.0 MiB, ")
+    assert "ETA" in messages[0]
+    assert messages[-1].startswith("Backup: 2/4 files, 2.0 MiB, ")
+    assert len(messages) == 3
+
+
+def test_no_progress_bar_with_json_logs(
+    monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+) -> None:
+    monkeypatch.setattr(progress, "is_json_logging", lambda: True)
+    caplog.set_level(logging.INFO, logger=progress.__name__)
+    terminal = FakeTerminal()
+
+    with Progress(stage="Backup", total=1, stream=terminal) as bar:
+        bar.advance()
+
+    assert terminal.getvalue() == ""
+    assert caplog.records[-1].getMessage().startswith("Backup: 1/1 files")
+    assert caplog.records[-1].stage == "Backup"
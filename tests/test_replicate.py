@@ -0,0 +1,93 @@
+import dataclasses
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from direnv_backup.backup import backup, remove_old_backups
+from direnv_backup.config import Config, Destination
+from direnv_backup.replicate import ReplicationError
+from tests.helpers.direnv import create_sample_envrc_files
+
+
+@pytest.fixture
+def usb(tmp_path: Path) -> Destination:
+    path = tmp_path / "usb"
+    path.mkdir()
+    return Destination(path=path, keep=1)
+
+
+@pytest.fixture
+def nas(tmp_path: Path) -> Destination:
+    return Destination(path=tmp_path / "nas-not-mounted")
+
+
+def test_backup_is_copied_to_every_destination(
+    unencrypted_config: Config, usb: Destination
+) -> None:
+    config = dataclasses.replace(unencrypted_config, destinations=(usb,))
+    create_sample_envrc_files(root_dir=config.root_dir)
+
+    names = iter(["20220101-000000", "20220101-010000"])
+    with patch("direnv_backup.backup.build_backup_filename", lambda: next(names)):
+        backup(config=config)
+        (config.root_dir / ".envrc").write_text("changed")
+        backup(config=config)
+
+    assert sorted(path.name for path in usb.path.iterdir()) == [
+        "20220101-000000.tar",
+        "20220101-010000.tar",
+    ]
+
+    remove_old_backups(config=config)
+
+    assert len(list(config.backup_dir.glob("*.tar"))) == 2
+    assert [path.name for path in usb.path.iterdir()] == ["20220101-010000.tar"]
+    assert (usb.path / "20220101-010000.tar").read_bytes() == (
+        config.backup_dir / "20220101-010000.tar"
+    ).read_bytes()
+
+
+def test_failing_destination_does_not_stop_the_others(
+    unencrypted_config: Config, usb: Destination, nas: Destination
+) -> None:
+    config = dataclasses.replace(
+        unencrypted_config,
+        destinations=(nas, usb),
+    )
+    create_sample_envrc_files(root_dir=config.root_dir)
+
+    with pytest.raises(ReplicationError, match="nas-not-mounted"):
+        backup(config=config)
+
+    assert len(list(usb.path.glob("*.tar"))) == 1
+    assert not nas.path.exists()
+
+    remove_old_backups(config=config)
+
+
+def test_skipped_backup_is_copied_to_destinations_that_lack_it(
+    unencrypted_config: Config, usb: Destination, nas: Destination
+) -> None:
+    config = dataclasses.replace(
+        unencrypted_config,
+        destinations=(nas, usb),
+    )
+    create_sample_envrc_files(root_dir=config.root_dir)
+
+    names = iter(["20220101-000000", "20220101-010000"])
+    with patch("direnv_backup.backup.build_backup_filename", lambda: next(names)):
+        with pytest.raises(ReplicationError, match="nas-not-mounted"):
+            backup(config=config)
+        backup_path = config.backup_dir / "20220101-000000.tar"
+        usb_copy = usb.path / backup_path.name
+        usb_mtime = usb_copy.stat().st_mtime_ns
+
+        # Nothing changed, but the NAS is mounted now
+        nas.path.mkdir()
+        backup(config=config)
+
+    assert list(config.backup_dir.glob("*.tar")) == [backup_path]
+    assert list(nas.path.iterdir()) == [nas.path / backup_path.name]
+    assert (nas.path / backup_path.name).read_bytes() == backup_path.read_bytes()
+    assert usb_copy.stat().st_mtime_ns == usb_mtime
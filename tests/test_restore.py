@@ -0,0 +1,183 @@
+import datetime
+import io
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from direnv_backup.backup import backup
+from direnv_backup.config import Config
+from direnv_backup.restore import (
+    RestoreError,
+    RestoreSummary,
+    find_backup_at,
+    find_latest_backup,
+    parse_timestamp,
+    restore_backup,
+)
+from tests.helpers.direnv import (
+    SAMPLE_ENVRC_FILES,
+    assert_all_envrc_files_are_in_place,
+    create_sample_envrc_files,
+)
+
+
+def test_restore_only_writes_files_that_differ(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    unchanged, updated, deleted = [
+        config.root_dir / envrc.path for envrc in SAMPLE_ENVRC_FILES
+    ]
+    os.utime(unchanged, ns=(0, 0))
+    updated.write_text("modified after backup")
+    deleted.unlink()
+
+    summary = restore_backup(config=config)
+
+    assert summary == RestoreSummary(unchanged=1, updated=1, created=1)
+    assert unchanged.stat().st_mtime_ns == 0
+    assert_all_envrc_files_are_in_place(root_dir=config.root_dir)
+
+
+def test_restore_dry_run_does_not_write(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    _, updated, deleted = [config.root_dir / envrc.path for envrc in SAMPLE_ENVRC_FILES]
+    updated.write_text("modified after backup")
+    deleted.unlink()
+
+    summary = restore_backup(config=config, dry_run=True)
+
+    assert summary == RestoreSummary(unchanged=1, updated=1, created=1)
+    assert updated.read_text() == "modified after backup"
+    assert not deleted.exists()
+
+
+def test_restore_with_multiple_jobs(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+    for envrc in SAMPLE_ENVRC_FILES:
+        (config.root_dir / envrc.path).unlink()
+
+    summary = restore_backup(config=config, jobs=4)
+
+    assert summary == RestoreSummary(created=len(SAMPLE_ENVRC_FILES))
+    assert_all_envrc_files_are_in_place(root_dir=config.root_dir)
+
+
+def test_restore_reports_all_failures_sorted_by_path(
+    unencrypted_config: Config,
+) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    # A directory in place of a file cannot be overwritten by the restore
+    for name in ["foo", "bar"]:
+        path = config.root_dir / name / ".envrc"
+        path.unlink()
+        path.mkdir()
+
+    with pytest.raises(RestoreError) as error:
+        restore_backup(config=config, jobs=4)
+
+    lines = str(error.value).splitlines()
+    assert lines[0] == "Failed to restore 2 file(s):"
+    assert lines[1].startswith("root_dir/bar/.envrc: ")
+    assert lines[2].startswith("root_dir/foo/.envrc: ")
+
+
+def test_restore_writes_through_symlinks(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    link = config.root_dir / "bar" / ".envrc"
+    target = config.root_dir / "shared.envrc"
+    link.rename(target)
+    link.symlink_to(target)
+    backup(config=config)
+
+    target.write_text("modified after backup")
+
+    summary = restore_backup(config=config)
+
+    assert summary == RestoreSummary(unchanged=2, updated=1)
+    assert link.is_symlink()
+    assert target.read_text() == "bar"
+
+
+def test_find_backup_at_picks_most_recent_backup_before_timestamp(
+    tmp_path: Path,
+) -> None:
+    start = datetime.datetime(2022, 1, 1)
+    for hour in range(1000):
+        name = (start + datetime.timedelta(hours=hour)).strftime("%Y%m%d-%H%M%S")
+        (tmp_path / f"{name}.gpg").touch()
+
+    at = datetime.datetime(2022, 1, 21, 19, 59, 59)
+    result = find_backup_at(dir=tmp_path, extension=".gpg", at=at)
+    assert result == tmp_path / "20220121-190000.gpg"
+
+    with pytest.raises(RestoreError):
+        find_backup_at(dir=tmp_path, extension=".gpg", at=start - datetime.timedelta(1))
+
+
+def test_restore_single_file_at_timestamp(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    path = config.root_dir / "foo/.envrc"
+
+    for name, content in [
+        ("20220101-000000", "first"),
+        ("20220102-000000", "second"),
+        ("20220103-000000", "third"),
+    ]:
+        path.write_text(content)
+        backup(config=config)
+        latest_backup = find_latest_backup(dir=config.backup_dir, extension=".tar")
+        latest_backup.rename(latest_backup.with_stem(name))
+
+    path.write_text("broken")
+    other_path = config.root_dir / "bar/.envrc"
+    other_path.write_text("modified after backup")
+
+    summary = restore_backup(
+        config=config, at=parse_timestamp("2022-01-02T12:00"), file=path
+    )
+
+    assert summary == RestoreSummary(updated=1)
+    assert path.read_text() == "second"
+    assert other_path.read_text() == "modified after backup"
+
+
+def test_restore_single_file_missing_in_backup(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    with pytest.raises(RestoreError, match="not found in backup"):
+        restore_backup(config=config, file=config.root_dir / "baz/.envrc")
+
+    assert not config.tmp_dir.exists()
+
+
+def test_restore_rejects_members_outside_root_dir(unencrypted_config: Config) -> None:
+    config = unencrypted_config
+    config.backup_dir.mkdir(parents=True, exist_ok=True)
+    outside = config.root_dir.parent / "outside.envrc"
+
+    content = b"export EVIL=1"
+    with tarfile.open(config.backup_dir / "20220101-000000.tar", "w") as tar:
+        member = tarfile.TarInfo(name=f"{config.root_dir.name}/../outside.envrc")
+        member.size = len(content)
+        tar.addfile(member, io.BytesIO(content))
+
+    with pytest.raises(RestoreError, match="outside.envrc: RestoreError"):
+        restore_backup(config=config)
+
+    assert not outside.exists()
@@ -0,0 +1,118 @@
+import dataclasses
+from pathlib import Path
+from typing import Any, Iterator
+
+import pytest
+
+from direnv_backup.backup import backup
+from direnv_backup.config import Config, S3Target
+from direnv_backup.metrics import metrics
+from direnv_backup.replicate import ReplicationError, upload_to_s3
+from tests.helpers.direnv import create_sample_envrc_files
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+s3 = pytest.importorskip("direnv_backup.s3")
+
+MIB = 1024 * 1024
+BUCKET = "backups"
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch) -> Iterator[Any]:
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def target() -> S3Target:
+    return S3Target(bucket=BUCKET, prefix="laptop/", part_size=5 * MIB, concurrency=1)
+
+
+def keys(client: Any) -> list[str]:
+    objects = client.list_objects_v2(Bucket=BUCKET).get("Contents", [])
+    return sorted(obj["Key"] for obj in objects)
+
+
+def test_only_new_backups_are_uploaded(
+    unencrypted_config: Config, client: Any, target: S3Target
+) -> None:
+    config = dataclasses.replace(unencrypted_config, s3=target)
+    config.backup_dir.mkdir()
+    (config.backup_dir / "20220101-000000.tar").write_bytes(b"old")
+    upload_to_s3(config=config)
+
+    (config.backup_dir / "20220102-000000.tar").write_bytes(b"new")
+    metrics.clear()
+    upload_to_s3(config=config)
+
+    assert keys(client) == ["laptop/20220101-000000.tar", "laptop/20220102-000000.tar"]
+    assert metrics.get("s3.objects_uploaded") == 1
+    assert metrics.get("s3.objects_skipped") == 1
+    assert metrics.get("s3.bytes_uploaded") == 3
+
+
+def test_interrupted_multipart_upload_resumes(
+    tmp_path: Path, client: Any, target: S3Target
+) -> None:
+    path = tmp_path / "20220101-000000.tar"
+    content = bytes(range(256)) * (11 * MIB // 256)
+    path.write_bytes(content)
+    item = s3.UploadItem(key="laptop/big.tar", path=path, size=len(content))
+
+    class FailingClient:
+        """Loses the connection while uploading the third part"""
+
+        def __getattr__(self, name: str) -> Any:
+            return getattr(client, name)
+
+        def upload_part(self, **kwargs: Any) -> Any:
+            if kwargs["PartNumber"] == 3:
+                raise OSError("Connection reset")
+            return client.upload_part(**kwargs)
+
+    state_dir = tmp_path / "state"
+    failing = s3.S3Uploader(target=target, state_dir=state_dir, client=FailingClient())
+    assert failing.upload(items=[item]).failed == 1
+
+    uploader = s3.S3Uploader(target=target, state_dir=state_dir, client=client)
+    summary = uploader.upload(items=[item])
+
+    assert summary.uploaded == 1
+    assert summary.bytes == len(content) - 10 * MIB
+    assert client.get_object(Bucket=BUCKET, Key=item.key)["Body"].read() == content
+
+
+def test_dedup_uploads_only_new_blobs(
+    unencrypted_config: Config, client: Any, target: S3Target
+) -> None:
+    config = dataclasses.replace(unencrypted_config, storage="dedup", s3=target)
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+    upload_to_s3(config=config)
+    before = set(keys(client))
+
+    (config.root_dir / ".envrc").write_text("changed")
+    backup(config=config)
+    upload_to_s3(config=config)
+
+    new_blobs = [key for key in set(keys(client)) - before if "blob-" in key]
+    assert len(new_blobs) == 1
+
+
+def test_failed_upload_is_reported(unencrypted_config: Config, client: Any) -> None:
+    config = dataclasses.replace(
+        unencrypted_config,
+        s3=S3Target(bucket="missing-bucket"),
+    )
+    config.backup_dir.mkdir()
+    (config.backup_dir / "20220101-000000.tar").write_bytes(b"old")
+
+    with pytest.raises(ReplicationError, match="missing-bucket"):
+        upload_to_s3(config=config)
@@ -0,0 +1,103 @@
+import dataclasses
+import os
+
+import pytest
+
+from direnv_backup.backup import SCAN_CHECKPOINT_NAME, backup, scan_direnv_files
+from direnv_backup.config import Config
+from direnv_backup.restore import restore_backup
+from direnv_backup.seekable import SeekableArchive
+from tests.helpers.direnv import create_sample_envrc_files
+
+
+@pytest.fixture
+def budgeted_config(config: Config) -> Config:
+    # Every run visits a single directory
+    config = dataclasses.replace(config, scan_time_budget=0)
+    create_sample_envrc_files(root_dir=config.root_dir)
+    config.backup_dir.mkdir()
+    return config
+
+
+def scanned(config: Config) -> set[str]:
+    snapshot = scan_direnv_files(config=config)
+    return {str(path.relative_to(config.root_dir)) for path in snapshot.files}
+
+
+def test_scan_resumes_most_recently_modified_first(budgeted_config: Config) -> None:
+    root_dir = budgeted_config.root_dir
+    os.utime(root_dir / "foo", (1, 1))
+    os.utime(root_dir / "bar", (2, 2))
+
+    assert scanned(budgeted_config) == {".envrc"}
+    assert scanned(budgeted_config) == {".envrc", "bar/.envrc"}
+    assert scanned(budgeted_config) == {".envrc", "bar/.envrc", "foo/.envrc"}
+
+
+def test_unfinished_scan_keeps_files_of_last_complete_scan(
+    budgeted_config: Config,
+) -> None:
+    for _ in range(3):
+        scan_direnv_files(config=budgeted_config)
+
+    # A new scan starts from the top, the files it did not reach yet are still backed up
+    (budgeted_config.root_dir / "foo" / ".envrc").unlink()
+    assert scanned(budgeted_config) == {".envrc", "bar/.envrc"}
+
+
+def test_checkpoint_only_with_time_budget(config: Config) -> None:
+    create_sample_envrc_files(root_dir=config.root_dir)
+    config.backup_dir.mkdir()
+
+    assert len(scanned(config)) == 3
+    assert not (config.backup_dir / SCAN_CHECKPOINT_NAME).exists()
+
+
+def test_symlinked_folders_are_scanned_once(config: Config) -> None:
+    create_sample_envrc_files(root_dir=config.root_dir)
+    (config.root_dir / "foo" / "loop").symlink_to(config.root_dir)
+    (config.root_dir / "foo-link").symlink_to(config.root_dir / "foo")
+
+    assert scanned(config) == {".envrc", "bar/.envrc", "foo/.envrc"}
+
+    config = dataclasses.replace(config, follow_symlinks=False)
+    assert scanned(config) == {".envrc", "bar/.envrc", "foo/.envrc"}
+
+
+@pytest.mark.parametrize("archive_format", ["tar", "seekable"])
+def test_hardlinked_files_are_backed_up_once(
+    unencrypted_config: Config, archive_format: str
+) -> None:
+    config = dataclasses.replace(unencrypted_config, archive_format=archive_format)
+    create_sample_envrc_files(root_dir=config.root_dir)
+    root_dir = config.root_dir
+    (root_dir / "foo-copy").mkdir()
+    os.link(root_dir / "foo" / ".envrc", root_dir / "foo-copy" / ".envrc")
+    (root_dir / "bar-link").mkdir()
+    (root_dir / "bar-link" / ".envrc").symlink_to("../bar/.envrc")
+
+    assert scanned(config) == {
+        ".envrc",
+        "bar/.envrc",
+        "bar-link/.envrc",
+        "foo/.envrc",
+        "foo-copy/.envrc",
+    }
+
+    backup(config=config)
+    if archive_format == "seekable":
+        [backup_path] = config.backup_dir.glob(f"*{config.backup_extension}")
+        with SeekableArchive(path=backup_path, backend=None) as archive:
+            index = archive.index
+        # The content of the hard link is stored once
+        assert index["root_dir/foo/.envrc"] == index["root_dir/foo-copy/.envrc"]
+
+    for name in ["foo", "foo-copy", "bar", "bar-link"]:
+        (root_dir / name / ".envrc").unlink()
+
+    restore_backup(config=config)
+
+    for name in ["foo", "foo-copy"]:
+        assert (root_dir / name / ".envrc").read_text() == "foo"
+    for name in ["bar", "bar-link"]:
+        assert (root_dir / name / ".envrc").read_text() == "bar"
@@ -0,0 +1,117 @@
+import dataclasses
+import json
+from pathlib import Path
+
+import pytest
+
+from direnv_backup.backup import backup
+from direnv_backup.config import Config
+from direnv_backup.restore import (
+    RestoreSummary,
+    find_latest_backup,
+    list_backup,
+    restore_backup,
+)
+from direnv_backup.seekable import (
+    INDEX_VERSION,
+    SeekableArchive,
+    SeekableArchiveError,
+    decode_index,
+)
+from direnv_backup.verify import verify_backup
+from tests.helpers.direnv import (
+    SAMPLE_ENVRC_FILES,
+    assert_all_envrc_files_are_in_place,
+    create_sample_envrc_files,
+    delete_envrc_files,
+)
+
+
+@pytest.fixture
+def seekable_config(unencrypted_config: Config) -> Config:
+    return dataclasses.replace(unencrypted_config, archive_format="seekable")
+
+
+@pytest.fixture
+def backup_path(seekable_config: Config) -> Path:
+    create_sample_envrc_files(root_dir=seekable_config.root_dir)
+    backup(config=seekable_config)
+    return find_latest_backup(dir=seekable_config.backup_dir, extension=".dba")
+
+
+def member_name(config: Config, path: Path) -> str:
+    return str(Path(config.root_dir.name) / path)
+
+
+def test_backup_and_restore(seekable_config: Config, backup_path: Path) -> None:
+    config = seekable_config
+    assert [path.name for path in config.backup_dir.iterdir()] == [backup_path.name]
+    delete_envrc_files(root_dir=config.root_dir)
+
+    summary = restore_backup(config=config)
+
+    assert summary == RestoreSummary(created=len(SAMPLE_ENVRC_FILES))
+    assert_all_envrc_files_are_in_place(root_dir=config.root_dir)
+
+
+def test_list_backup(seekable_config: Config, backup_path: Path) -> None:
+    names = list_backup(config=seekable_config)
+
+    assert names == sorted(
+        member_name(seekable_config, envrc.path) for envrc in SAMPLE_ENVRC_FILES
+    )
+
+
+def test_single_file_restore_only_reads_its_frame(
+    seekable_config: Config, backup_path: Path
+) -> None:
+    config = seekable_config
+    wanted, *others = [envrc.path for envrc in SAMPLE_ENVRC_FILES]
+
+    # Corrupt the frames of every other member, restoring `wanted` must not notice
+    with SeekableArchive(path=backup_path, backend=None) as archive:
+        entries = [archive.index[member_name(config, path)] for path in others]
+    with backup_path.open("r+b") as f:
+        for entry in entries:
+            f.seek(entry.offset)
+            f.write(b"?" * entry.length)
+
+    delete_envrc_files(root_dir=config.root_dir)
+
+    restore_backup(config=config, file=config.root_dir / wanted)
+
+    assert (config.root_dir / wanted).exists()
+    assert not any((config.root_dir / path).exists() for path in others)
+
+    result = verify_backup(backup=backup_path, backend=None)
+    assert result.errors == [
+        f"{member_name(config, path)}: hash does not match the manifest"
+        for path in sorted(others, key=lambda path: member_name(config, path))
+    ]
+
+
+def test_truncated_archive(seekable_config: Config, backup_path: Path) -> None:
+    backup_path.write_bytes(backup_path.read_bytes()[:-1])
+
+    with pytest.raises(SeekableArchiveError):
+        list_backup(config=seekable_config)
+
+    result = verify_backup(backup=backup_path, backend=None)
+    assert not result.ok
+    assert result.errors[0].startswith("corrupt or truncated archive")
+
+
+@pytest.mark.parametrize(
+    "files",
+    [
+        [],
+        {"foo": {"offset": 0}},
+        {"foo": {"offset": -1, "length": 1, "mode": 0o600, "sha256": "abc"}},
+        {"foo": {"offset": 0, "length": "1", "mode": 0o600, "sha256": "abc"}},
+    ],
+)
+def test_corrupt_index(files: object) -> None:
+    content = json.dumps({"version": INDEX_VERSION, "files": files}).encode()
+
+    with pytest.raises(SeekableArchiveError, match="Corrupt archive index"):
+        decode_index(content)
@@ -0,0 +1,128 @@
+import dataclasses
+from pathlib import Path
+
+import pytest
+
+from direnv_backup.backup import backup, remove_old_backups
+from direnv_backup.config import Config
+from direnv_backup.restore import list_backups, restore_backup
+from direnv_backup.store import PackStore, PackStoreError
+from direnv_backup.verify import verify_backups
+from tests.helpers.direnv import (
+    assert_all_envrc_files_are_in_place,
+    create_sample_envrc_files,
+    delete_envrc_files,
+)
+
+
+@pytest.fixture
+def store(tmp_path: Path) -> PackStore:
+    return PackStore(dir=tmp_path / "store", max_pack_size=100)
+
+
+def add_bytes(store: PackStore, tmp_path: Path, name: str, content: bytes) -> None:
+    source = tmp_path / name
+    source.write_bytes(content)
+    store.add(name=name, source=source)
+
+
+def read_bytes(store: PackStore, tmp_path: Path, name: str) -> bytes:
+    output = tmp_path / f"{name}.out"
+    store.extract(name=name, output=output)
+    return output.read_bytes()
+
+
+def test_backups_share_few_packs(store: PackStore, tmp_path: Path) -> None:
+    for i in range(10):
+        add_bytes(store, tmp_path, name=f"backup-{i}", content=bytes([i]) * 30)
+
+    assert store.names() == [f"backup-{i}" for i in range(10)]
+    assert read_bytes(store, tmp_path, "backup-3") == bytes([3]) * 30
+    assert len(list(store.dir.glob("*.pack"))) == 3
+
+
+def test_compaction_only_rewrites_mostly_garbage_packs(
+    store: PackStore, tmp_path: Path
+) -> None:
+    for i in range(8):
+        add_bytes(store, tmp_path, name=f"backup-{i}", content=bytes([i]) * 30)
+
+    # pack 1 holds backups 0-3 and pack 2 backups 4-7
+    store.remove(["backup-0", "backup-1", "backup-2", "backup-4"])
+    packs_before = {usage.pack for usage in store.usage()}
+
+    summary = store.compact(threshold=0.5)
+
+    assert summary.packs_rewritten == 1
+    assert summary.bytes_freed == 90
+    assert store.names() == ["backup-3", "backup-5", "backup-6", "backup-7"]
+    assert read_bytes(store, tmp_path, "backup-3") == bytes([3]) * 30
+    assert len(packs_before - {usage.pack for usage in store.usage()}) == 1
+
+    with pytest.raises(PackStoreError):
+        store.extract(name="backup-0", output=tmp_path / "missing")
+
+
+def test_interrupted_compaction_keeps_one_copy(
+    store: PackStore, tmp_path: Path
+) -> None:
+    add_bytes(store, tmp_path, name="a", content=b"a" * 10)
+    add_bytes(store, tmp_path, name="b", content=b"b" * 10)
+    store.remove(["b"])
+
+    # Compaction copied the live backups to a new pack, but did not get to delete the
+    # old pack
+    old_pack = store.dir / store.usage()[0].pack
+    old_index = store._index_path(old_pack.name)
+    saved = old_pack.read_bytes(), old_index.read_bytes()
+    store.compact(threshold=0.5)
+    old_pack.write_bytes(saved[0])
+    old_index.write_bytes(saved[1])
+
+    assert store.names() == ["a"]
+    assert read_bytes(store, tmp_path, "a") == b"a" * 10
+    assert [usage.live for usage in store.usage()] == [0, 10]
+
+    # The next compaction removes the leftover pack
+    store.compact(threshold=0.5)
+    assert [usage.live for usage in store.usage()] == [10]
+    assert read_bytes(store, tmp_path, "a") == b"a" * 10
+
+
+def test_backup_and_restore_with_pack_storage(unencrypted_config: Config) -> None:
+    config = dataclasses.replace(unencrypted_config, storage="packs")
+    create_sample_envrc_files(root_dir=config.root_dir)
+
+    for _ in range(3):
+        backup(config=config)
+
+    assert {path.suffix for path in config.backup_dir.iterdir()} == {
+        ".pack",
+        ".json",
+        ".lock",
+    }
+    assert len(list_backups(config=config)) >= 1
+
+    delete_envrc_files(root_dir=config.root_dir)
+    restore_backup(config=config)
+    assert_all_envrc_files_are_in_place(root_dir=config.root_dir)
+
+    assert all(result.ok for result in verify_backups(config=config))
+
+    remove_old_backups(config=config)
+    assert list_backups(config=config)
+
+
+def test_dedup_backup_restore_and_retention(unencrypted_config: Config) -> None:
+    config = dataclasses.replace(unencrypted_config, storage="dedup")
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    delete_envrc_files(root_dir=config.root_dir)
+    restore_backup(config=config)
+    assert_all_envrc_files_are_in_place(root_dir=config.root_dir)
+
+    assert all(result.ok for result in verify_backups(config=config))
+
+    remove_old_backups(config=config)
+    assert len(list_backups(config=config)) == 1
@@ -0,0 +1,84 @@
+import os
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from direnv_backup import throttle
+from direnv_backup.metrics import metrics
+from direnv_backup.throttle import LoadThrottle, lower_priority, read_io_pressure
+
+
+def test_read_io_pressure(tmp_path: Path) -> None:
+    path = tmp_path / "io"
+    path.write_text(
+        "some avg10=12.50 avg60=3.00 avg300=1.00 total=2277731\n"
+        "full avg10=10.00 avg60=2.00 avg300=1.00 total=2005984\n"
+    )
+
+    with patch.object(throttle, "IO_PRESSURE_PATH", path):
+        assert read_io_pressure() == 12.5
+
+    with patch.object(throttle, "IO_PRESSURE_PATH", tmp_path / "missing"):
+        assert read_io_pressure() is None
+
+
+def test_throttle_pauses_while_busy(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(throttle, "LOAD_CHECK_INTERVAL", 0.01)
+    pressures = iter([90.0, 90.0, 5.0])
+    monkeypatch.setattr(throttle, "read_io_pressure", lambda: next(pressures))
+    metrics.clear()
+
+    LoadThrottle(max_io_pressure=50).pause_if_busy()
+
+    assert metrics.get("throttle.seconds") >= 0.02
+
+
+def test_throttle_gives_up_after_max_pause(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(throttle, "LOAD_CHECK_INTERVAL", 0.01)
+    monkeypatch.setattr(throttle, "MAX_PAUSE", 0.05)
+    monkeypatch.setattr(throttle, "read_load_per_cpu", lambda: 100.0)
+    metrics.clear()
+
+    LoadThrottle(max_load=1).pause_if_busy()
+
+    assert 0.05 <= metrics.get("throttle.seconds") < 1
+
+
+def test_throttle_stops_after_max_total_pause(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(throttle, "LOAD_CHECK_INTERVAL", 0.01)
+    monkeypatch.setattr(throttle, "read_load_per_cpu", lambda: 100.0)
+    metrics.clear()
+
+    load_throttle = LoadThrottle(max_load=1, max_total_pause=0.05)
+    for _ in range(10):
+        load_throttle._last_check = 0
+        load_throttle.pause_if_busy()
+
+    assert 0.05 <= metrics.get("throttle.seconds") < 0.5
+
+
+def test_throttle_does_not_pause_past_deadline(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(throttle, "LOAD_CHECK_INTERVAL", 0.01)
+    monkeypatch.setattr(throttle, "read_load_per_cpu", lambda: 100.0)
+    metrics.clear()
+
+    LoadThrottle(max_load=1).pause_if_busy(deadline=time.monotonic() - 1)
+    LoadThrottle(max_load=1).pause_if_busy(deadline=time.monotonic() + 0.05)
+
+    assert 0.01 <= metrics.get("throttle.seconds") < 1
+
+
+def test_lower_priority() -> None:
+    with patch.object(os, "nice") as nice, patch.object(throttle.process, "run") as run:
+        lower_priority(nice=10, ionice_idle=True)
+
+    nice.assert_called_once_with(10)
+    assert run.call_args.args[0] == [
+        "ionice",
+        "--class",
+        "idle",
+        "--pid",
+        str(os.getpid()),
+    ]
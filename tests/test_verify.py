@@ -0,0 +1,145 @@
+import dataclasses
+import io
+import tarfile
+import time
+from pathlib import Path
+
+import pytest
+
+from direnv_backup.archive import MANIFEST_NAME
+from direnv_backup.backup import backup
+from direnv_backup.cli.verify import main
+from direnv_backup.config import SNAPSHOT_EXTENSION, Config
+from direnv_backup.restore import find_latest_backup
+from direnv_backup.store import PACK_PREFIX, PACK_SUFFIX, PackStore
+from direnv_backup.throttle import BandwidthLimiter
+from direnv_backup.verify import verify_backup, verify_backups
+from tests.helpers.config import write_config
+from tests.helpers.direnv import create_sample_envrc_files
+
+
+@pytest.fixture
+def backup_path(unencrypted_config: Config) -> Path:
+    create_sample_envrc_files(root_dir=unencrypted_config.root_dir)
+    backup(config=unencrypted_config)
+    return find_latest_backup(dir=unencrypted_config.backup_dir, extension=".tar")
+
+
+def rewrite_member(archive: Path, name: str, content: bytes) -> None:
+    with tarfile.open(archive, "r") as tar:
+        members = [(info, tar.extractfile(info).read()) for info in tar]  # type: ignore
+
+    with tarfile.open(archive, "w") as tar:
+        for info, data in members:
+            if info.name == name:
+                data = content
+                info.size = len(content)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_verify_backup(backup_path: Path) -> None:
+    result = verify_backup(backup=backup_path, backend=None)
+
+    assert result.ok
+    assert result.has_manifest
+    assert result.members == 3
+
+
+def test_verify_backup_with_modified_member(backup_path: Path) -> None:
+    rewrite_member(archive=backup_path, name="root_dir/foo/.envrc", content=b"oops")
+
+    result = verify_backup(backup=backup_path, backend=None)
+
+    assert result.errors == ["root_dir/foo/.envrc: hash does not match the manifest"]
+
+
+def test_verify_truncated_backup(backup_path: Path) -> None:
+    data = backup_path.read_bytes()
+    backup_path.write_bytes(data[:700])
+
+    result = verify_backup(backup=backup_path, backend=None)
+
+    assert not result.ok
+    assert result.errors[0].startswith("corrupt or truncated archive: ")
+
+
+@pytest.mark.parametrize("manifest", [b"{", b'{"files": ["foo"]}', b"[]"])
+def test_verify_backup_with_corrupt_manifest(
+    backup_path: Path, manifest: bytes
+) -> None:
+    rewrite_member(archive=backup_path, name=MANIFEST_NAME, content=manifest)
+
+    result = verify_backup(backup=backup_path, backend=None)
+
+    assert result.errors == ["corrupt or truncated archive: Corrupt manifest"]
+
+
+def test_verify_all_backups_in_parallel(
+    unencrypted_config: Config, backup_path: Path
+) -> None:
+    corrupt_backup = backup_path.with_stem("20000101-000000")
+    corrupt_backup.write_bytes(b"not a tar file")
+
+    results = verify_backups(config=unencrypted_config, jobs=2)
+
+    assert [result.backup for result in results] == [corrupt_backup, backup_path]
+    assert [result.ok for result in results] == [False, True]
+
+
+def test_verify_truncated_pack(unencrypted_config: Config) -> None:
+    config = dataclasses.replace(unencrypted_config, storage="packs")
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    [pack] = config.backup_dir.glob(f"{PACK_PREFIX}*{PACK_SUFFIX}")
+    pack.write_bytes(pack.read_bytes()[:-10])
+
+    [result] = verify_backups(config=config)
+
+    assert result.errors == [
+        "corrupt or missing data: Unexpected end of file while copying"
+    ]
+
+
+def test_verify_damaged_snapshot(unencrypted_config: Config) -> None:
+    config = dataclasses.replace(unencrypted_config, storage="dedup")
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    store = PackStore(dir=config.backup_dir)
+    [(name, entry)] = [
+        (name, entry)
+        for name, entry in store.entries().items()
+        if name.endswith(SNAPSHOT_EXTENSION)
+    ]
+    with (config.backup_dir / entry.pack).open("r+b") as pack:
+        pack.seek(entry.offset)
+        pack.write(b"x" * entry.length)
+
+    [result] = verify_backups(config=config)
+
+    assert result.backup.name == name
+    assert result.errors == ["corrupt or missing data: Corrupt snapshot"]
+
+
+def test_verify_cli_exit_value(
+    tmp_path: Path, unencrypted_config: Config, backup_path: Path
+) -> None:
+    config_path = tmp_path / "config.json"
+    write_config(path=config_path, config=unencrypted_config)
+    backup_path.with_stem("20000101-000000").write_bytes(b"not a tar file")
+
+    exit_value = main(["--config", str(config_path), "--jobs", "2"])
+
+    assert exit_value == "1 of 2 backups failed verification"
+
+
+def test_bandwidth_limiter_waits_once_the_budget_is_spent() -> None:
+    limiter = BandwidthLimiter(bytes_per_second=1000)
+
+    start = time.monotonic()
+    limiter.consume(1000)
+    limiter.consume(500)
+    elapsed = time.monotonic() - start
+
+    assert 0.4 < elapsed < 1
@@ -0,0 +1,107 @@
+import dataclasses
+import io
+from pathlib import Path
+
+import pytest
+
+from direnv_backup.backup import backup
+from direnv_backup.config import Config
+from direnv_backup.encrypt import EncryptionError
+from direnv_backup.restore import find_latest_backup, restore_backup
+from tests.helpers.direnv import (
+    SAMPLE_ENVRC_FILES,
+    assert_all_envrc_files_are_in_place,
+    create_sample_envrc_files,
+)
+
+x25519 = pytest.importorskip("direnv_backup.x25519")
+
+
+@pytest.fixture
+def x25519_config(tmp_path: Path, config: Config) -> Config:
+    identity = tmp_path / "identity"
+    recipient = x25519.generate_identity(path=identity)
+    return dataclasses.replace(
+        config,
+        encryption_backend="x25519",
+        encryption_recipient=recipient,
+        encryption_identity=identity,
+    )
+
+
+def encrypt_bytes(data: bytes, recipient: str) -> bytes:
+    output = io.BytesIO()
+    x25519.encrypt_stream(source=io.BytesIO(data), output=output, recipient=recipient)
+    return output.getvalue()
+
+
+def decrypt_bytes(data: bytes, identity: Path) -> bytes:
+    source = io.BytesIO(data)
+    reader = x25519.DecryptingReader(source, x25519.load_identity(identity))
+    return reader.read()
+
+
+def test_backup_and_restore_with_x25519_backend(x25519_config: Config) -> None:
+    config = x25519_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+
+    backup(config=config)
+
+    files_in_backup_dir = [p for p in config.backup_dir.rglob("*") if p.is_file()]
+    assert [path.suffix for path in files_in_backup_dir] == [".x25519"]
+
+    for envrc in SAMPLE_ENVRC_FILES:
+        (config.root_dir / envrc.path).unlink()
+
+    restore_backup(config=config)
+
+    assert_all_envrc_files_are_in_place(root_dir=config.root_dir)
+
+
+@pytest.mark.parametrize("size", [0, 1, x25519.CHUNK_SIZE, 3 * x25519.CHUNK_SIZE + 7])
+def test_round_trip(x25519_config: Config, size: int) -> None:
+    assert x25519_config.encryption_recipient and x25519_config.encryption_identity
+    data = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+
+    encrypted = encrypt_bytes(data, recipient=x25519_config.encryption_recipient)
+
+    assert decrypt_bytes(encrypted, x25519_config.encryption_identity) == data
+
+
+def test_truncated_and_modified_data_fail_to_decrypt(x25519_config: Config) -> None:
+    assert x25519_config.encryption_recipient and x25519_config.encryption_identity
+    data = b"x" * (2 * x25519.CHUNK_SIZE)
+    encrypted = encrypt_bytes(data, recipient=x25519_config.encryption_recipient)
+
+    truncated = encrypted[: -x25519.ENCRYPTED_CHUNK_SIZE]
+    modified = encrypted[:-1] + bytes([encrypted[-1] ^ 1])
+
+    for corrupt in [truncated, modified]:
+        with pytest.raises(EncryptionError):
+            decrypt_bytes(corrupt, x25519_config.encryption_identity)
+
+
+def test_restore_fails_without_identity(x25519_config: Config) -> None:
+    config = x25519_config
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+    assert find_latest_backup(dir=config.backup_dir, extension=".x25519")
+
+    with pytest.raises(EncryptionError):
+        restore_backup(config=dataclasses.replace(config, encryption_identity=None))
+
+
+def test_seekable_backup_and_single_file_restore(x25519_config: Config) -> None:
+    config = dataclasses.replace(x25519_config, archive_format="seekable")
+    create_sample_envrc_files(root_dir=config.root_dir)
+    backup(config=config)
+
+    files_in_backup_dir = [p for p in config.backup_dir.rglob("*") if p.is_file()]
+    assert [path.suffix for path in files_in_backup_dir] == [".dba"]
+
+    envrc = SAMPLE_ENVRC_FILES[1]
+    (config.root_dir / envrc.path).unlink()
+
+    restore_backup(config=config, file=config.root_dir / envrc.path)
+
+    assert_all_envrc_files_are_in_place(root_dir=config.root_dir)